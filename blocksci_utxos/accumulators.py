@@ -0,0 +1,292 @@
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+# File with the size statistics saved in the stores of inputs with resolved script sizes (see load_size_stats)
+SIZE_STATS_FILE = "size_stats.bin"
+# Header of a serialized SizeAccumulator: count, sum, sum of squares, min, max, bucket width and number of buckets
+_HEADER = struct.Struct("<QddddII")
+
+
+class SizeAccumulator(object):
+    """
+    Streaming sufficient statistics of a series of sizes: count, sum, sum of squares, min, max and a histogram with
+    num_buckets fixed-width buckets (bucket b counts sizes in [b * bucket_width, (b + 1) * bucket_width), the last
+    bucket also counts all larger sizes).
+
+    Accumulators use constant memory, can be merged (e.g. the accumulators of different shards, checkpoints or
+    batches) and are serialized in a few bytes, so estimates can be computed without keeping every size.
+    """
+
+    def __init__(self, bucket_width=8, num_buckets=128):
+        """
+        :param bucket_width: width of the histogram buckets
+        :param num_buckets: number of histogram buckets
+        """
+        self.bucket_width = bucket_width
+        self.num_buckets = num_buckets
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.histogram = np.zeros(num_buckets, dtype=np.uint64)
+
+    def add(self, sizes):
+        """
+        :param sizes: size or sequence (numpy array, list) of sizes
+        """
+        sizes = np.atleast_1d(np.asarray(sizes, dtype=np.float64))
+        if not len(sizes):
+            return
+        self.count += len(sizes)
+        self.sum += float(sizes.sum())
+        self.sumsq += float((sizes ** 2).sum())
+        self.min = min(self.min, float(sizes.min()))
+        self.max = max(self.max, float(sizes.max()))
+        buckets = np.minimum(sizes // self.bucket_width, self.num_buckets - 1).astype(np.int64)
+        self.histogram += np.bincount(buckets, minlength=self.num_buckets).astype(np.uint64)
+
+    def merge(self, other):
+        """
+        :param other: SizeAccumulator with the same buckets
+        """
+        assert (self.bucket_width, self.num_buckets) == (other.bucket_width, other.num_buckets)
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram += other.histogram
+
+    def mean(self):
+        return self.sum / self.count if self.count else np.nan
+
+    def std(self, ddof=0):
+        """
+        :param ddof: delta degrees of freedom (as in np.std)
+        :return: standard deviation
+        """
+        if self.count <= ddof:
+            return np.nan
+        var = (self.sumsq - self.sum ** 2 / self.count) / (self.count - ddof)
+        return float(np.sqrt(max(var, 0.0)))
+
+    def quantile(self, q):
+        """
+        :param q: quantile, between 0 and 1
+        :return: upper limit of the histogram bucket containing the quantile (approximate quantile), the maximum size
+                 for quantiles in the last bucket
+        """
+        if not self.count:
+            return np.nan
+        b = int(np.searchsorted(np.cumsum(self.histogram), q * self.count))
+        if b >= self.num_buckets - 1:
+            return self.max
+        return min((b + 1) * self.bucket_width, self.max)
+
+    def to_bytes(self):
+        header = _HEADER.pack(self.count, self.sum, self.sumsq, self.min, self.max, self.bucket_width,
+                              self.num_buckets)
+        return header + zlib.compress(self.histogram.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        (count, s, sumsq, mn, mx, bucket_width, num_buckets) = _HEADER.unpack_from(data)
+        acc = cls(bucket_width, num_buckets)
+        acc.count, acc.sum, acc.sumsq, acc.min, acc.max = count, s, sumsq, mn, mx
+        acc.histogram = np.frombuffer(zlib.decompress(data[_HEADER.size:]), dtype=np.uint64).copy()
+        return acc
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+def load_size_stats(store_path):
+    """
+    :param store_path: directory of a store of inputs with resolved script sizes (e.g. COIN_non_std_inputs)
+    :return: SizeAccumulator with the statistics of the resolved script sizes (None if they have not been saved)
+    """
+    path = os.path.join(store_path, SIZE_STATS_FILE)
+    return SizeAccumulator.load(path) if os.path.exists(path) else None
+
+
+class RangeIndex(object):
+    """
+    Prefix sums of the count, sum and sum of squares of sizes, by block height and series (e.g. input types, public
+    key sizes, or input types and size buckets). Row h of each array holds the totals of all the heights below h, so
+    the statistics of any window of heights are the difference of two rows, and window means and standard deviations
+    are computed in constant time whatever the length of the window.
+
+    Arrays are dense (one row per height and one column per series), so the size of an index grows with the number of
+    series. Sums of integer sizes are exact (float64 prefix sums hold integers up to 2 ** 53).
+
+    On disk, an index is a directory with the arrays (counts.npy, sums.npy and sumsqs.npy, that can be memory-mapped)
+    and the series keys (keys.json).
+    """
+
+    def __init__(self, keys, counts, sums, sumsqs):
+        """
+        :param keys: list with the key of each series
+        :param counts: numpy array (num_heights + 1, len(keys)), prefix sums of the counts
+        :param sums: numpy array (num_heights + 1, len(keys)), prefix sums of the sizes
+        :param sumsqs: numpy array (num_heights + 1, len(keys)), prefix sums of the squared sizes
+        """
+        self.keys = keys
+        self.counts = counts
+        self.sums = sums
+        self.sumsqs = sumsqs
+
+    @classmethod
+    def build(cls, heights, sizes, weights=None, series=None, keys=None, num_heights=None, bucket_width=None,
+              num_buckets=16):
+        """
+        :param heights: numpy array with the height of each size
+        :param sizes: numpy array of sizes
+        :param weights: numpy array with the number of occurrences of each size (defaults to one)
+        :param series: numpy array with the series of each size, as positions in keys (defaults to a single series)
+        :param keys: list with the key of each series (defaults to their positions)
+        :param num_heights: number of heights (defaults to the last height with sizes + 1)
+        :param bucket_width: if set, each series is also split in size buckets of bucket_width (the last of the
+                             num_buckets buckets also holds all larger sizes), with (key, bucket start) keys. Only
+                             buckets with sizes get a column.
+        :param num_buckets: maximum number of buckets of each series
+        :return: RangeIndex object
+        """
+
+        heights = np.asarray(heights, dtype=np.int64)
+        sizes = np.asarray(sizes, dtype=np.float64)
+        weights = np.ones(len(sizes)) if weights is None else np.asarray(weights, dtype=np.float64)
+        series = np.zeros(len(sizes), dtype=np.int64) if series is None else np.asarray(series, dtype=np.int64)
+        if keys is None:
+            keys = list(range(int(series.max()) + 1 if len(series) else 1))
+        if num_heights is None:
+            num_heights = int(heights.max()) + 1 if len(heights) else 0
+
+        if bucket_width:
+            buckets = np.minimum(sizes // bucket_width, num_buckets - 1).astype(np.int64)
+            pairs, series = np.unique(np.stack([series, buckets], axis=1), axis=0, return_inverse=True)
+            series = series.reshape(-1)
+            keys = [(keys[s], b * bucket_width) for s, b in pairs.tolist()]
+
+        num_series = len(keys)
+        cells = heights * num_series + series
+
+        def prefix_sums(w):
+            totals = np.bincount(cells, weights=w, minlength=num_heights * num_series).reshape(num_heights, num_series)
+            return np.concatenate([np.zeros((1, num_series)), np.cumsum(totals, axis=0)])
+
+        return cls(keys, prefix_sums(weights), prefix_sums(weights * sizes), prefix_sums(weights * sizes ** 2))
+
+    @property
+    def num_heights(self):
+        return len(self.counts) - 1
+
+    def _columns(self, series):
+        if series is None:
+            return slice(None)
+        # Series of size buckets are also selected by the key of their series
+        return [k for k, key in enumerate(self.keys) if key in series or (isinstance(key, tuple) and key[0] in series)]
+
+    def window(self, first=0, last=None, series=None):
+        """
+        :param first: first height of the window
+        :param last: last height of the window, included (None for the last height of the index)
+        :param series: list with the keys of the series to aggregate (None aggregates all of them)
+        :return: tuple, count, sum and sum of squares of the sizes found in the window
+        """
+        first = max(first, 0)
+        last = self.num_heights - 1 if last is None else min(last, self.num_heights - 1)
+        if last < first:
+            return 0.0, 0.0, 0.0
+        columns = self._columns(series)
+        return tuple([float(np.sum(a[last + 1, columns] - a[first, columns]))
+                      for a in (self.counts, self.sums, self.sumsqs)])
+
+    def count(self, first=0, last=None, series=None):
+        return self.window(first, last, series)[0]
+
+    def mean(self, first=0, last=None, series=None):
+        """
+        :return: mean size in the window (see window for the parameters), nan if it is empty
+        """
+        count, s, _ = self.window(first, last, series)
+        return s / count if count else np.nan
+
+    def std(self, first=0, last=None, series=None, ddof=0):
+        """
+        :param ddof: delta degrees of freedom (as in np.std)
+        :return: standard deviation of the sizes in the window (see window for the other parameters)
+        """
+        count, s, sumsq = self.window(first, last, series)
+        if count <= ddof:
+            return np.nan
+        return float(np.sqrt(max((sumsq - s ** 2 / count) / (count - ddof), 0.0)))
+
+    def height_totals(self, series=None):
+        """
+        :param series: list with the keys of the series to aggregate (None aggregates all of them)
+        :return: tuple of numpy arrays, count and sum of the sizes at each height
+        """
+        columns = self._columns(series)
+        return np.diff(self.counts[:, columns].sum(axis=1)), np.diff(self.sums[:, columns].sum(axis=1))
+
+    def height_means(self, series=None):
+        """
+        :param series: list with the keys of the series to aggregate (None aggregates all of them)
+        :return: numpy array with the mean size at each height (nan for heights without sizes)
+        """
+        counts, sums = self.height_totals(series)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sums / counts
+
+    def forward_filled_means(self, series=None, initial=np.nan):
+        """
+        :param series: list with the keys of the series to aggregate (None aggregates all of them)
+        :param initial: value of the heights before the first height with sizes
+        :return: numpy array with the mean size at each height, heights without sizes take the mean of the previous
+                 height with sizes
+        """
+        means = self.height_means(series)
+        last_valid = np.maximum.accumulate(np.where(np.isnan(means), -1, np.arange(len(means))))
+        return np.where(last_valid >= 0, means[np.maximum(last_valid, 0)], initial)
+
+    def save(self, path):
+        """
+        :param path: index directory
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in ["counts", "sums", "sumsqs"]:
+            with open(os.path.join(path, name + ".npy.tmp"), "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(os.path.join(path, name + ".npy.tmp"), os.path.join(path, name + ".npy"))
+        with open(os.path.join(path, "keys.json"), "w") as f:
+            json.dump(self.keys, f)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "keys.json"))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param path: index directory
+        :param mmap_mode: numpy mmap_mode (None loads the index in memory)
+        :return: RangeIndex object
+        """
+        with open(os.path.join(path, "keys.json")) as f:
+            # Keys of size buckets are saved as lists
+            keys = [tuple(key) if isinstance(key, list) else key for key in json.load(f)]
+        return cls(keys, *[np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+                           for name in ["counts", "sums", "sumsqs"]])
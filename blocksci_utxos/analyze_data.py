@@ -1,66 +1,96 @@
+import gzip
 import itertools
 import json
+import os
 import operator
 import pickle
+from collections import namedtuple
 from math import sqrt
 import numpy as np
 
 from external_apis import *
 from constants import *
+from results_store import *
+from accumulators import *
 
 
 def flatten_dict_values(d):
     return list(itertools.chain(*d.values()))
 
 
-def dump_estimations_to_json(coin=BITCOIN, input_type="ALL"):
+# Input types with STATUS estimation files, and suffix of each file (see estimation_file)
+ESTIMATION_FILES = {"P2PKH": "_p2pkh_pubkey_avg_size_height_output", "P2SH": "_p2sh", "NONSTD": "_nonstd",
+                    "P2WSH": "_p2wsh"}
+# Number of heights written at once by streaming exports
+EXPORT_CHUNK_SIZE = 10000
+
+
+def estimation_file(coin, input_type, compact=False):
+    """
+    :param coin: studied coin
+    :param input_type: input type ("P2PKH", "P2SH", "NONSTD" or "P2WSH")
+    :param compact: boolean, compact export (see dump_estimations_to_json)
+    :return: path of the STATUS estimation file of the input type
+    """
+    if compact and input_type == "P2PKH":
+        return coin_file(coin, ESTIMATION_FILES[input_type] + "_dense.json.gz")
+    return coin_file(coin, ESTIMATION_FILES[input_type] + ".json")
+
+
+def dump_estimations_to_json(coin=BITCOIN, input_type="ALL", compact=STATUS_COMPACT_EXPORT, executor=None):
     """
     Dumps estimation data from pickle_files to json files (that can be loaded into STATUS for computing
     non-profitability metrics).
 
+    Per-height estimations (P2PKH) are computed as numpy arrays and streamed to the json file in chunks of
+    EXPORT_CHUNK_SIZE heights, so the export never holds the whole json document in memory. With compact, they are
+    written instead as a dense json array indexed by height (gzip compressed, see estimation_file). Files are written
+    atomically: a failed export leaves the previous file untouched.
+
     :param coin: coin: studied coin
     :param input_type: type of input to dump ("ALL", "P2PKH", "P2SH", "NONSTD" or "P2WSH")
+    :param compact: boolean, write per-height estimations as a gzip compressed dense array
+    :param executor: process pool where, with "ALL", each input type is dumped (e.g. the pool of the chain scans, see
+                     utxo_journal_main.scan_pool). Pools are not created here, since forking from a stage thread can
+                     deadlock the child. None dumps the input types one after the other.
     :return:
     """
 
-    if input_type in ["ALL", "P2PKH"]:
-
-        pickle_file = COIN_STR[coin] + "_pk_sizes_out"
+    input_types = list(ESTIMATION_FILES) if input_type == "ALL" else [input_type]
+    if executor is not None and len(input_types) > 1:
+        list(executor.map(_dump_estimation, [coin] * len(input_types), input_types, [compact] * len(input_types)))
+    else:
+        for t in input_types:
+            _dump_estimation(coin, t, compact)
 
-        def avg_from_dict(d):
-            avg_pksize = 0
-            counter = 0
-            for k, v in d.items():
-                avg_pksize += k * v
-                counter += v
 
-            return avg_pksize / float(counter) if counter != 0 else np.nan
+def _dump_estimation(coin, input_type, compact):
+    path = estimation_file(coin, input_type, compact)
 
+    if input_type == "P2PKH":
+        pickle_file = coin_file(coin, "_pk_sizes_out")
         (pubkey_sizes_outs, unknowns_outs) = pickle.load(open(pickle_file+".pickle", "rb"))
-        p2pkh_pubkey_avg_size_height_output = {}
-        last_not_nan = 65
-        for k, v in pubkey_sizes_outs.items():
-            avg = avg_from_dict(v)
-            if not np.isnan(avg):
-                last_not_nan = avg
-
-            p2pkh_pubkey_avg_size_height_output[k] = last_not_nan
-
-        f = open(COIN_STR[coin]+"_p2pkh_pubkey_avg_size_height_output.json", "w")
-        f.write(json.dumps(p2pkh_pubkey_avg_size_height_output))
-        f.close()
+        heights = np.fromiter(pubkey_sizes_outs.keys(), dtype=np.int64, count=len(pubkey_sizes_outs))
+        # Average public key size of the outputs of each height, heights without spent P2PKH outputs take the last
+        # known average (uncompressed keys before the first one)
+        means = p2pkh_range_index(pubkey_sizes_outs).forward_filled_means(initial=65)
+        del pubkey_sizes_outs
+        if compact:
+            dense = np.full(int(heights.max()) + 1 if len(heights) else 0, np.nan)
+            dense[heights] = means[heights]
+            _write_atomic(path, _json_array_chunks(dense), compress=True)
+        else:
+            _write_atomic(path, _json_height_dict_chunks(heights, means[heights]))
 
-    if input_type in ["ALL", "P2SH"]:
-        pickle_file = COIN_STR[coin] + "_p2sh"
+    elif input_type == "P2SH":
+        pickle_file = coin_file(coin, "_p2sh")
         (p2sh, others_in_p2sh) = pickle.load(open(pickle_file + ".pickle", "rb"))
-        avg_per_type, std_per_type, avg_abs, std_abs, avg_per_height = p2sh_average_size(p2sh)
-        f = open(COIN_STR[coin]+"_p2sh.json", "w")
-        f.write(json.dumps(avg_abs))
-        f.close()
+        avg_per_type, std_per_type, avg_abs, std_abs, avg_per_height = p2sh_average_size(p2sh_histogram(p2sh))
+        _write_atomic(path, [json.dumps(avg_abs)])
 
-    if input_type in ["ALL", "NONSTD"]:
+    elif input_type == "NONSTD":
 
-        pickle_file = COIN_STR[coin] + "_non_std_inputs"
+        pickle_file = coin_file(coin, "_non_std_inputs")
 
         # Legacy code: DELETE when bitcoin non-std has been analyzed with the new code!!
         # (scripts) = pickle.load(open(pickle_file+".pickle", "rb"))
@@ -68,22 +98,161 @@ def dump_estimations_to_json(coin=BITCOIN, input_type="ALL"):
         # flatt_lens = flatten_dict_values(script_lens)
         # print("The average non-std input script len. is: {}".format(np.mean(flatt_lens)))
 
-        # New code:
-        (nonstd_sizes_outs, nonstd_sizes_scripts, nonstd_sizes_lens) = pickle.load(open(pickle_file+".pickle", "rb"))
-        flatt_lens = flatten_dict_values(nonstd_sizes_lens)
-        non_std_mean = np.mean(flatt_lens)
-        f = open(COIN_STR[coin]+"_nonstd.json", "w")
-        f.write(json.dumps(non_std_mean))
-        f.close()
+        # New code: estimates come from the size statistics accumulated while resolving script sizes
+        non_std_mean = _size_mean(pickle_file)
+        _write_atomic(path, [json.dumps(non_std_mean)])
+
+    elif input_type == "P2WSH":
+        pickle_file = coin_file(coin, "_p2wsh_inputs")
+        p2wsh_mean = _size_mean(pickle_file)
+        _write_atomic(path, [json.dumps(p2wsh_mean)])
+
+
+def _json_height_dict_chunks(heights, values):
+    # Same text as json.dumps({h: v}), EXPORT_CHUNK_SIZE heights at a time
+    yield "{"
+    for first in range(0, len(heights), EXPORT_CHUNK_SIZE):
+        items = zip(heights[first:first + EXPORT_CHUNK_SIZE].tolist(), values[first:first + EXPORT_CHUNK_SIZE].tolist())
+        yield (", " if first else "") + ", ".join(['"{}": {}'.format(h, json.dumps(v)) for h, v in items])
+    yield "}"
+
+
+def _json_array_chunks(values):
+    yield "["
+    for first in range(0, len(values), EXPORT_CHUNK_SIZE):
+        chunk = values[first:first + EXPORT_CHUNK_SIZE].tolist()
+        # Heights without estimation are null
+        yield ("," if first else "") + ",".join([json.dumps(v) if v == v else "null" for v in chunk])
+    yield "]"
+
+
+def _write_atomic(path, chunks, compress=False):
+    """
+    :param path: file written
+    :param chunks: iterable of strings, written one after another to a temporary file that replaces path at the end
+    :param compress: boolean, gzip compress the file
+    """
+    tmp = path + ".tmp"
+    with (gzip.open(tmp, "wt") if compress else open(tmp, "w")) as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp, path)
+
+
+def _size_mean(pickle_file):
+    stats = load_size_stats(pickle_file)
+    if stats is None:
+        # Stores resolved before size statistics were saved
+        return float(np.mean(HeightColumns.load(pickle_file)["size"]))
+    return stats.mean()
+
+
+def p2pkh_range_index(pubkey_sizes_outs):
+    """
+    :param pubkey_sizes_outs: dictionary, keys are output heights and values dictionaries {public key size: counter}
+                              (as stored by blocksci_find_pk_in_p2pkh)
+    :return: RangeIndex of public key sizes by output height, with a series for each public key size (33 and 65)
+    """
+
+    heights, sizes, counts = [], [], []
+    for h, v in pubkey_sizes_outs.items():
+        for size, n in v.items():
+            heights.append(h)
+            sizes.append(size)
+            counts.append(n)
+    keys = sorted(set(sizes))
+    num_heights = max(pubkey_sizes_outs) + 1 if pubkey_sizes_outs else 0
+
+    return RangeIndex.build(heights, sizes, weights=counts, series=np.searchsorted(keys, sizes), keys=keys,
+                            num_heights=num_heights)
+
+
+def p2sh_range_index(p2sh, bucket_width=None):
+    """
+    :param p2sh: dictionary with block height as keys (or P2SHHistogram)
+    :param bucket_width: if set, series are also split in size buckets (see RangeIndex.build)
+    :return: RangeIndex of P2SH input script sizes by height, with a series for each type of P2SH_TYPES (others are
+             left empty, their size is unknown)
+    """
+
+    hist = p2sh_histogram(p2sh)
+    num_heights = max(hist.height_keys) + 1 if hist.height_keys else 0
+    heights, types, counts, sizes = _without_others(hist)
+
+    return RangeIndex.build(heights, sizes, weights=counts, series=types, keys=list(P2SH_TYPES),
+                            num_heights=num_heights, bucket_width=bucket_width)
+
+
+def store_range_index(pickle_file, bucket_width=None):
+    """
+    :param pickle_file: store of inputs with resolved script sizes (e.g. COIN_non_std_inputs)
+    :param bucket_width: if set, sizes are also split in size buckets (see RangeIndex.build)
+    :return: RangeIndex of script sizes by height, with a single series (size)
+    """
+
+    store = HeightColumns.load(pickle_file)
+    return RangeIndex.build(store.heights(), store["size"], keys=["size"], num_heights=store.num_heights,
+                            bucket_width=bucket_width)
+
+
+# Range indexes of each input type, saved in the directory COIN_range_index (see build_range_indexes)
+RANGE_INDEX_TYPES = ["P2PKH", "P2SH", "NONSTD", "P2WSH"]
+
+
+def build_range_indexes(coin=BITCOIN, bucket_width=None):
+    """
+    Builds the prefix-sum indexes (see RangeIndex) of the estimation data of each input type, so that averages over
+    any window of heights are answered without reloading the extracted data, e.g.:
+
+        # average public key size of the P2PKH outputs created between heights a and b
+        load_range_index(coin, "P2PKH").mean(a, b)
+        # average P2SH input script size since segwit, and standard deviation of multisig ones in [a, b]
+        p2sh = load_range_index(coin, "P2SH")
+        p2sh.mean(SEGWIT_ACTIVATION_HEIGHT)
+        p2sh.std(a, b, series=["multisig"], ddof=1)
+
+    Indexes are saved in the directory COIN_range_index, one subdirectory per type of RANGE_INDEX_TYPES (P2PKH by
+    output height, the other types by input height). NONSTD and P2WSH indexes need resolved script sizes.
+
+    :param coin: studied coin
+    :param bucket_width: if set, series are also split in size buckets (P2SH, NONSTD and P2WSH)
+    :return:
+    """
+
+    path = coin_file(coin, "_range_index")
+
+    (pubkey_sizes_outs, unknowns_outs) = pickle.load(open(coin_file(coin, "_pk_sizes_out") + ".pickle", "rb"))
+    p2pkh_range_index(pubkey_sizes_outs).save(os.path.join(path, "P2PKH"))
 
-    if input_type in ["ALL", "P2WSH"]:
-        pickle_file = COIN_STR[coin] + "_p2wsh_inputs"
-        (p2wsh_sizes_outs, p2wsh_sizes_scripts, p2wsh_sizes_lens) = pickle.load(open(pickle_file + ".pickle", "rb"))
-        flatt_lens = flatten_dict_values(p2wsh_sizes_lens)
-        p2wsh_mean = np.mean(flatt_lens)
-        f = open(COIN_STR[coin]+"_p2wsh.json", "w")
-        f.write(json.dumps(p2wsh_mean))
-        f.close()
+    (p2sh, others_in_p2sh) = pickle.load(open(coin_file(coin, "_p2sh") + ".pickle", "rb"))
+    p2sh_range_index(p2sh, bucket_width).save(os.path.join(path, "P2SH"))
+
+    for input_type, suffix in [("NONSTD", "_non_std_inputs"), ("P2WSH", "_p2wsh_inputs")]:
+        store_range_index(coin_file(coin, suffix), bucket_width).save(os.path.join(path, input_type))
+
+
+def load_range_index(coin, input_type, mmap_mode="r"):
+    """
+    :param coin: studied coin
+    :param input_type: input type ("P2PKH", "P2SH", "NONSTD" or "P2WSH")
+    :param mmap_mode: numpy mmap_mode (None loads the index in memory)
+    :return: RangeIndex saved by build_range_indexes
+    """
+    return RangeIndex.load(os.path.join(coin_file(coin, "_range_index"), input_type), mmap_mode)
+
+
+def native_segwit_spent_counts(store):
+    """
+    Computes the number of spent and unspent outputs per output height of a native segwit outputs store (as stored by
+    blocksci_find_native_segwit_outputs).
+
+    :param store: HeightColumns object with an is_spent column
+    :return: dictionary, keys are block heights and values dictionaries {True: #spent, False: #unspent}
+    """
+
+    spent = np.bincount(store.heights(), weights=store["is_spent"], minlength=store.num_heights).astype(np.int64)
+    total = store.counts()
+    return {h: {True: s, False: t - s} for h, (s, t) in enumerate(zip(spent.tolist(), total.tolist()))}
 
 
 def p2sh_compute_script_size(v, ty):
@@ -131,44 +300,97 @@ def p2sh_compute_script_size(v, ty):
         return float('nan')
 
 
-def p2sh_agg_height_dict(p2sh):
+# P2SH redeem script types, as stored by blocksci_find_p2sh_inputs. Types in P2SH_COUNTED_TYPES only store a counter,
+# the other ones store a dictionary with keys (subtypes or lengths) and counters.
+P2SH_TYPES = ["multisig", "nonstandard", "pubkey", "pubkeyhash", "scripthash", "P2WPKH", "P2WSH", "others"]
+P2SH_COUNTED_TYPES = ["P2WPKH", "P2WSH", "others"]
+
+P2SHHistogram = namedtuple("P2SHHistogram", ["heights", "types", "keys", "counts", "sizes", "height_keys"])
+P2SHHistogram.__doc__ = """
+Flat version of a p2sh dictionary (see p2sh_histogram), with one element per (height, type, key) found:
+    heights, types, counts: numpy arrays with the block height, the type (position in P2SH_TYPES) and the counter
+    keys: list with the keys (None for types in P2SH_COUNTED_TYPES)
+    sizes: numpy array with the estimated input script size (p2sh_compute_script_size) of each key
+    height_keys: list with the block heights of the p2sh dictionary
+"""
+
+
+def p2sh_histogram(p2sh):
     """
-    Aggregates a p2sh dictionary (as stored by blocksci_find_p2shinputs), omitting info about block height.
+    Flattens a p2sh dictionary (as stored by blocksci_find_p2sh_inputs) into a P2SHHistogram, so that statistics can
+    be computed with vectorized reductions. The script size of each (type, key) is only computed once.
 
     :param p2sh: dictionary with block height as keys
-    :return: dictionary with script types as keys
+    :return: P2SHHistogram
     """
 
-    r = {"multisig": {}, 'nonstandard': {}, 'pubkey': {}, "pubkeyhash": {}, "scripthash": {},
-         "P2WPKH": 0, "P2WSH": 0, "others": 0}
+    if isinstance(p2sh, P2SHHistogram):
+        return p2sh
 
+    type_codes = {ty: t for t, ty in enumerate(P2SH_TYPES)}
+    heights, types, keys, counts, sizes = [], [], [], [], []
+    key_sizes = {}
     for h, v in p2sh.items():
         for ty, ctr in v.items():
-            if type(ctr) == dict:
-                for inner_dict_k, inner_dict_v in ctr.items():
-                    if inner_dict_k in r[ty].keys():
-                        r[ty][inner_dict_k] += inner_dict_v
-                    else:
-                        r[ty][inner_dict_k] = inner_dict_v
-            else:
-                r[ty] += ctr
+            items = ctr.items() if type(ctr) == dict else [(None, ctr)]
+            for k, n in items:
+                if not n:
+                    continue
+                if (ty, k) not in key_sizes:
+                    key_sizes[(ty, k)] = p2sh_compute_script_size(k, ty) if ty != "others" else np.nan
+                heights.append(h)
+                types.append(type_codes[ty])
+                keys.append(k)
+                counts.append(n)
+                sizes.append(key_sizes[(ty, k)])
+
+    return P2SHHistogram(np.array(heights, dtype=np.int64), np.array(types, dtype=np.int64), keys,
+                         np.array(counts, dtype=np.int64), np.array(sizes, dtype=np.float64), list(p2sh.keys()))
+
+
+def _without_others(hist):
+    mask = hist.types != P2SH_TYPES.index("others")
+    return hist.heights[mask], hist.types[mask], hist.counts[mask].astype(np.float64), hist.sizes[mask]
+
+
+def p2sh_agg_height_dict(p2sh):
+    """
+    Aggregates a p2sh dictionary (as stored by blocksci_find_p2shinputs), omitting info about block height.
+
+    :param p2sh: dictionary with block height as keys (or P2SHHistogram)
+    :return: dictionary with script types as keys
+    """
+
+    hist = p2sh_histogram(p2sh)
+    r = {ty: 0 if ty in P2SH_COUNTED_TYPES else {} for ty in P2SH_TYPES}
+
+    for t, k, n in zip(hist.types.tolist(), hist.keys, hist.counts.tolist()):
+        ty = P2SH_TYPES[t]
+        if ty in P2SH_COUNTED_TYPES:
+            r[ty] += n
+        elif k in r[ty]:
+            r[ty][k] += n
+        else:
+            r[ty][k] = n
 
     return r
 
 
 def p2sh_average_size(p2sh, with_vectors=False):
     """
-    Aggregates P2SH data by type and height, and computes overall averages.
+    Aggregates P2SH data by type and height, and computes overall averages. All statistics are weighted by the
+    number of inputs of each (type, key), and computed with vectorized reductions over a P2SHHistogram.
 
-    :param p2sh:
+    :param p2sh: dictionary with block height as keys (or P2SHHistogram)
     :param with_vectors:
-    :return:
+    :return: tuple, average and standard deviation per type (dictionaries), overall average and standard deviation,
+             and average per height (dictionary)
     """
 
-    agg_data = p2sh_agg_height_dict(p2sh)
-
-    assert agg_data["others"] == 0
-    del agg_data["others"]
+    hist = p2sh_histogram(p2sh)
+    assert hist.counts[hist.types == P2SH_TYPES.index("others")].sum() == 0
+    heights, types, counts, sizes = _without_others(hist)
+    num_types = len(P2SH_TYPES)
 
     ###################################################
     # average per type
@@ -180,82 +402,44 @@ def p2sh_average_size(p2sh, with_vectors=False):
     if with_vectors:
         # slower, but nice to check the other implementation ;)
 
-        non = [v * [k] for k, v in agg_data["nonstandard"].items()]
-        merged = list(itertools.chain(*non))
+        non = types == P2SH_TYPES.index("nonstandard")
+        merged = np.repeat(sizes[non], counts[non].astype(np.int64))
         np.mean(merged)
         np.std(merged)
     else:
-        for in_type, data_dict in agg_data.items():
-            if type(data_dict) == dict:
-                ctr = 0
-                type_average = 0
-                for k, v in data_dict.items():
-                    type_average += v * p2sh_compute_script_size(k, in_type)
-                    ctr += v
-                avg_per_type[in_type] = type_average / float(ctr)
-            else:
-                avg_per_type[in_type] = p2sh_compute_script_size(None, in_type)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ctr_per_type = np.bincount(types, weights=counts, minlength=num_types)
+            type_average = np.bincount(types, weights=counts * sizes, minlength=num_types) / ctr_per_type
+            type_std = np.sqrt(np.bincount(types, weights=counts * (sizes - type_average[types]) ** 2,
+                                           minlength=num_types) / (ctr_per_type - 1))
 
-        for in_type, data_dict in agg_data.items():
-            if type(data_dict) == dict:
-                ctr = 0
-                type_std = 0
-                for k, v in data_dict.items():
-                    type_std += v * pow((p2sh_compute_script_size(k, in_type) - avg_per_type[in_type]), 2)
-                    ctr += v
-                std_per_type[in_type] = sqrt(type_std / float(ctr - 1))
-            else:
+        for t, in_type in enumerate(P2SH_TYPES):
+            if in_type == "others":
+                continue
+            if in_type in P2SH_COUNTED_TYPES:
+                avg_per_type[in_type] = p2sh_compute_script_size(None, in_type)
                 std_per_type[in_type] = 0
+            else:
+                avg_per_type[in_type] = float(type_average[t])
+                std_per_type[in_type] = float(type_std[t])
 
     ###################################################
     # overall average
     ###################################################
-    avg_abs = 0
-    std_abs = 0
-    ctr = 0
-    for in_type, data_dict in agg_data.items():
-        if type(data_dict) == dict:
-            for k, v in data_dict.items():
-                avg_abs += v * p2sh_compute_script_size(k, in_type)
-                ctr += v
-        else:
-            avg_abs += data_dict * p2sh_compute_script_size(None, in_type)
-            ctr += data_dict
-    avg_abs = avg_abs / float(ctr)
-
-    for in_type, data_dict in agg_data.items():
-        if type(data_dict) == dict:
-            for k, v in data_dict.items():
-                std_abs += v * pow((p2sh_compute_script_size(k, in_type) - avg_abs), 2)
-        else:
-            std_abs += data_dict * pow((p2sh_compute_script_size(None, in_type) - avg_abs), 2)
-
-    std_abs = sqrt(std_abs / float(ctr - 1))
 
+    ctr = counts.sum()
+    avg_abs = float((counts * sizes).sum() / ctr)
+    std_abs = sqrt((counts * (sizes - avg_abs) ** 2).sum() / (ctr - 1))
 
     ###################################################
     # average per height?
     ###################################################
 
-    avg_per_height = {}
-    for h, v in p2sh.items():
-        this_height_avg = 0
-        ctr = 0
-        for in_type, data_dict in v.items():
-            if in_type == "others":
-                pass
-            elif type(data_dict) == dict:
-                for k, v in data_dict.items():
-                    this_height_avg += v * p2sh_compute_script_size(k, in_type)
-                    ctr += v
-            else:
-                this_height_avg += data_dict * p2sh_compute_script_size(None, in_type)
-                ctr += data_dict
-
-        if ctr:
-            avg_per_height[h] = this_height_avg/ctr
-        else:
-            avg_per_height[h] = np.nan
+    num_heights = max(hist.height_keys) + 1 if hist.height_keys else 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        height_avg = (np.bincount(heights, weights=counts * sizes, minlength=num_heights) /
+                      np.bincount(heights, weights=counts, minlength=num_heights))
+    avg_per_height = {h: float(height_avg[h]) for h in hist.height_keys}
 
     #pickle.dump((avg_per_height), open("p2sh_avg_per_height.pickle", "wb"))
     return avg_per_type, std_per_type, avg_abs, std_abs, avg_per_height
@@ -265,21 +449,16 @@ def p2sh_num_inputs_per_redeem_script_type(p2sh):
     """
     Prints a summary of script types nested in P2SH inputs
 
-    :param p2sh: p2sh dictionary, as created by blocksci_find_p2sh_inputs function
+    :param p2sh: p2sh dictionary, as created by blocksci_find_p2sh_inputs function (or P2SHHistogram)
     :return:
     """
 
-    num_multisig = sum([sum(h_v["multisig"].values()) for h_v in p2sh.values()])
-    num_nonstd = sum([sum(h_v["nonstandard"].values()) for h_v in p2sh.values()])
-    num_pubkey = sum([sum(h_v["pubkey"].values()) for h_v in p2sh.values()])
-    num_pubkeyhash = sum([sum(h_v["pubkeyhash"].values()) for h_v in p2sh.values()])
-    num_scripthash = sum([sum(h_v["scripthash"].values()) for h_v in p2sh.values()])
-
-    num_P2WPKH = sum([h_v["P2WPKH"] for h_v in p2sh.values()])
-    num_P2WSH = sum([h_v["P2WSH"] for h_v in p2sh.values()])
-    num_others = sum([h_v["others"] for h_v in p2sh.values()])
+    hist = p2sh_histogram(p2sh)
+    per_type = np.bincount(hist.types, weights=hist.counts, minlength=len(P2SH_TYPES)).astype(np.int64).tolist()
+    (num_multisig, num_nonstd, num_pubkey, num_pubkeyhash, num_scripthash, num_P2WPKH, num_P2WSH,
+     num_others) = per_type
 
-    t = num_multisig + num_nonstd + num_pubkey + num_pubkeyhash + num_scripthash + num_P2WPKH + num_P2WSH + num_others
+    t = sum(per_type)
 
     print("P2SH redeem scripts:")
     print("   Multisig: {}".format(num_multisig))
@@ -305,17 +484,19 @@ def p2sh_analysis(coin=BITCOIN):
     print("--------------------------")
 
 
-    pickle_file = COIN_STR[coin] + "_p2sh"
+    pickle_file = coin_file(coin, "_p2sh")
     (p2sh, others_in_p2sh) = pickle.load(open(pickle_file + ".pickle", "rb"))
+    # Flattened once, and shared by all the statistics below
+    hist = p2sh_histogram(p2sh)
 
     # Number of redeem scripts per type
-    p2sh_num_inputs_per_redeem_script_type(p2sh)
+    p2sh_num_inputs_per_redeem_script_type(hist)
 
-    avg_per_type, std_per_type, avg_abs, std_abs, avg_per_height = p2sh_average_size(p2sh)
+    avg_per_type, std_per_type, avg_abs, std_abs, avg_per_height = p2sh_average_size(hist)
 
     # Multisig scripts
-    agg_data = p2sh_agg_height_dict(p2sh)
-    pickle.dump((agg_data), open("p2sh_agg_data.pickle", "wb"))
+    agg_data = p2sh_agg_height_dict(hist)
+    pickle.dump((agg_data), open(os.path.join(OUTPUT_DIRS.get(coin, ""), "p2sh_agg_data.pickle"), "wb"))
     sorted_x = sorted(agg_data["multisig"].items(), key=operator.itemgetter(1))
     print(sorted_x)
 
@@ -346,32 +527,26 @@ def non_std_analysis(coin=BITCOIN):
 
     print("Non-std analysis")
     print("--------------------------")
+    print_first_x = 10
 
-    pickle_file = COIN_STR[coin] + "_non_std_inputs"
-    (nonstd_sizes_outs, nonstd_sizes_scripts, nonstd_sizes_lens) = pickle.load(open(pickle_file + ".pickle", "rb"))
+    pickle_file = coin_file(coin, "_non_std_inputs")
+    nonstd = HeightColumns.load(pickle_file)
+    scripts = ScriptDictionary.load(os.path.join(pickle_file, SCRIPTS_DIR))
 
-    flatt_lens = flatten_dict_values(nonstd_sizes_lens)
+    flatt_lens = nonstd["size"]
     print("The average non-std input script len. is: {}".format(np.mean(flatt_lens)))
-    print("There are {} empty scripts".format(sum([1 for e in flatt_lens if e == 0])))
-    print("There are {} scripts of len 1".format(sum([1 for e in flatt_lens if e == 1])))
-    print("There are {} different scripts".format(len(set(flatt_lens))))
-
-    avg_per_height = {}
-    for k, v in nonstd_sizes_lens.items():
-        avg_per_height[k] = np.mean(v)
-    diff_heights = sum([1 for v in avg_per_height.values() if not np.isnan(v)])
+    print("There are {} empty scripts".format(np.count_nonzero(flatt_lens == 0)))
+    print("There are {} scripts of len 1".format(np.count_nonzero(flatt_lens == 1)))
+    # Distinct scripts are stored once, with their number of occurrences, so these do not need to read the scripts
+    print("There are {} different script lengths".format(len(np.unique(scripts.sizes()))))
+    print("There are {} different scripts".format(len(scripts)))
+    most_common = np.argsort(scripts.counts)[::-1][:print_first_x]
+    print("Most common scripts: {}".format([(scripts[i].hex(), int(scripts.counts[i])) for i in most_common]))
+
+    diff_heights = np.count_nonzero(nonstd.counts())
     print("Non-std scripts can be found in {} different blocks".format(diff_heights))
 
     # Are non-std scripts with len 0 misslabelled segwit inputs?
-    flatt_outs = flatten_dict_values(nonstd_sizes_outs)
-    print_first_x = 10
-    ctr = 0
-    for o, l in zip(flatt_outs, flatt_lens):
-        if l == 0:
-            print(o)
-            ctr += 1
-        if ctr == print_first_x:
-            break
+    for pos in np.flatnonzero(flatt_lens == 0)[:print_first_x]:
+        print((nonstd["txid"][pos].tobytes().hex(), int(nonstd["index"][pos])))
     # ... it does not seem so for bitcoin, but indeed they are for litecoin!
-
-
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import external_apis
+
+
+class _StubServer(object):
+    # Local HTTP server answering GET requests with the value returned by self.response(path). The next num_errors
+    # requests are answered with a 503 error instead (e.g. to test retries).
+
+    def __init__(self, latency=0.0, port=0):
+        self.latency = latency
+        self.num_requests = 0
+        self.num_errors = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ExplorerStub(_StubServer):
+    """
+    Local HTTP server answering the explorer endpoints used by external_apis (blockchain.info rawtx, insight api/tx and
+    chainz tx.raw.dws) for the transactions of a synthetic chain. Scripts and witnesses are deterministic pseudo-random
+    byte strings, drawn from a pool of num_scripts distinct scripts (so repeated scripts also appear), and each
+    response can be delayed by latency seconds to emulate network round trips.
+    """
+
+    def __init__(self, chain, num_scripts=1000, max_script_size=200, latency=0.0, port=0):
+        """
+        :param chain: synthetic_chain.Blockchain object
+        :param num_scripts: number of distinct scripts (and witnesses)
+        :param max_script_size: maximum script size, in bytes
+        :param latency: delay of each response, in seconds
+        :param port: local port (0 picks a free one)
+        """
+        super(ExplorerStub, self).__init__(latency, port)
+        self.chain = chain
+        self.num_scripts = num_scripts
+        self.max_script_size = max_script_size
+
+    def script(self, txid, input_ind, kind="script"):
+        """
+        :param txid: transaction id
+        :param input_ind: input index
+        :param kind: "script" or "witness"
+        :return: hex string with the script (or witness) of the input
+        """
+        digest = hashlib.sha256("{}:{}:{}".format(kind, txid, input_ind).encode()).digest()
+        script_id = int.from_bytes(digest[:8], "little") % self.num_scripts
+        seed = hashlib.sha256("{}:{}".format(kind, script_id).encode()).digest()
+        size = 1 + int.from_bytes(seed[:4], "little") % self.max_script_size
+        return (seed * (size // len(seed) + 1))[:size].hex()
+
+    def response(self, path):
+        """
+        :param path: request path (with query string)
+        :return: decoded JSON response (None for unknown transactions or endpoints)
+        """
+        url = urlparse(path)
+        if url.path.startswith("/rawtx/"):
+            txid, provider = url.path[len("/rawtx/"):], "blockchain.info"
+        elif url.path.startswith("/api/tx/"):
+            txid, provider = url.path[len("/api/tx/"):], "insight"
+        elif url.path == "/explorer/tx.raw.dws":
+            txid, provider = parse_qs(url.query).get("id", [""])[0], "chainz"
+        else:
+            return None
+        tx = self.chain.tx(txid)
+        if tx is None:
+            return None
+
+        inputs = range(len(tx.ins))
+        if provider == "blockchain.info":
+            return {"hash": txid,
+                    "inputs": [{"script": self.script(txid, i), "witness": self.script(txid, i, "witness")}
+                               for i in inputs]}
+        elif provider == "insight":
+            return {"txid": txid, "vin": [{"n": i, "scriptSig": {"hex": self.script(txid, i)}} for i in inputs]}
+        else:
+            # A single data push with the whole witness
+            return {"txid": txid, "vin": [{"txinwitness": [self.script(txid, i, "witness")]} for i in inputs]}
+
+    def install(self):
+        """
+        Points every provider of external_apis to the stub, without rate limits.
+        """
+        external_apis.PROVIDER_URLS = {
+            "blockchain.info": self.url + "/rawtx/{}",
+            "insight.litecore.io": self.url + "/api/tx/{}",
+            "bitcoincash.blockexplorer.com": self.url + "/api/tx/{}",
+            "chainz.cryptoid.info": self.url + "/explorer/tx.raw.dws?coin=ltc&id={}&fmt.js"}
+        external_apis.EXTERNAL_API_RATE_LIMITS = {provider: 10.0 ** 6 for provider in external_apis.PROVIDER_URLS}
+
+
+class ArchiveStub(_StubServer):
+    """
+    Local HTTP server answering explorer requests with the responses of an archive recorded by external_apis (see
+    EXTERNAL_API_ARCHIVE_MODE), so that the real fetch path (sessions, rate limiters, retries and response parsing) can
+    be load-tested offline. Each provider is served under its own path, /PROVIDER/TXID.
+    """
+
+    def __init__(self, archive, latency=0.0, port=0):
+        """
+        :param archive: response_cache.ResponseArchive object
+        :param latency: delay of each response, in seconds
+        :param port: local port (0 picks a free one)
+        """
+        super(ArchiveStub, self).__init__(latency, port)
+        self.archive = archive
+
+    def response(self, path):
+        """
+        :param path: request path
+        :return: archived response body (bytes), None for responses not in the archive
+        """
+        parts = urlparse(path).path.strip("/").split("/")
+        if len(parts) != 2:
+            return None
+        return self.archive.get(*parts)
+
+    def install(self, rate_limits=None):
+        """
+        Points every provider of external_apis to the stub.
+
+        :param rate_limits: requests per second allowed by each provider (None removes rate limits)
+        """
+        external_apis.PROVIDER_URLS = dict([(provider, "{}/{}/{{}}".format(self.url, provider))
+                                            for provider in external_apis.PROVIDER_URLS])
+        external_apis.EXTERNAL_API_RATE_LIMITS = rate_limits or \
+            dict([(provider, 10.0 ** 6) for provider in external_apis.PROVIDER_URLS])
+
+
+def _handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        # Keeps connections alive, as the explorers do
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, Nagle's algorithm would delay each response
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            with stub.lock:
+                stub.num_requests += 1
+                error = stub.num_errors > 0
+                stub.num_errors -= error
+            if stub.latency:
+                time.sleep(stub.latency)
+            response = stub.response(self.path) if not error else None
+            if isinstance(response, bytes):
+                body = response
+            else:
+                body = json.dumps(response).encode() if response is not None else b"{}"
+            self.send_response(503 if error else 200 if response is not None else 404)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    # Serves an archive recorded by external_apis, e.g. to load-test a run from another machine:
+    #     python -m benchmarks.explorer_stub explorer_archive.bin --port 8000
+    import argparse
+    from response_cache import ResponseArchive
+
+    parser = argparse.ArgumentParser(description="Serve an archive of explorer responses over HTTP")
+    parser.add_argument("archive", help="archive file (see EXTERNAL_API_ARCHIVE_FILE)")
+    parser.add_argument("--port", type=int, default=8000, help="local port")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of each response, in seconds")
+    args = parser.parse_args()
+
+    stub = ArchiveStub(ResponseArchive(args.archive), args.latency, args.port)
+    print("Serving {} responses at {}/PROVIDER/TXID".format(len(stub.archive), stub.url))
+    stub.server.serve_forever()
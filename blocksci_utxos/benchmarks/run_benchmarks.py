@@ -0,0 +1,287 @@
+"""
+Benchmarks every blocksci_find_* extractor, the script size resolution and every analysis function on a synthetic
+chain (see synthetic_chain), with a local explorer stub (see explorer_stub) instead of the web APIs.
+
+Run from the blocksci_utxos folder:
+
+    python -m benchmarks.run_benchmarks --blocks 2000
+
+Each benchmark runs in its own (forked) process, in a temporary working directory shared by all of them (analyses
+read the files written by the extractors). A report with blocks/sec, inputs/sec, peak RSS and output size of each
+benchmark is saved in the results directory, and compared with the previous report found there.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from functools import partial
+
+import numpy as np
+
+from benchmarks import synthetic_chain
+from benchmarks.explorer_stub import ExplorerStub
+from profiling import git_commit
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# Metrics compared between reports, higher values being regressions
+REGRESSION_METRICS = ["seconds", "peak_rss_mb", "output_bytes"]
+
+
+def _benchmarks(chain):
+    """
+    :param chain: synthetic_chain.Blockchain object
+    :return: list of tuples (name, function to benchmark, tuple with the number of blocks and inputs it processes), in
+             execution order
+    """
+
+    synthetic_chain.install()
+    import analyze_data
+    import get_blocksci_data
+    import spent_index
+    import utxo_set
+
+    # Native segwit inputs are collected from SegWit activation on, at chain.segwit_height in the synthetic chain
+    get_blocksci_data.NativeSegwitInputsCollector.start_height = chain.segwit_height
+
+    ty = synthetic_chain.address_type
+    whole_chain = (len(chain), chain.num_inputs)
+    after_segwit = (len(chain) - chain.segwit_height, chain.count_inputs(chain.segwit_height))
+    resolved = (len(chain), chain.count_inputs(types=[ty.nonstandard, ty.witness_scripthash]) +
+                chain.count_inputs(types=[ty.scripthash], wrapped_types=[ty.nonstandard, ty.scripthash]))
+
+    benchmarks = [(name, partial(getattr(get_blocksci_data, name), chain), whole_chain)
+                  for name in ["blocksci_find_pk_in_p2pkh", "blocksci_find_p2sh_inputs", "blocksci_find_nonstd_inputs",
+                               "blocksci_find_p2wsh_inputs", "blocksci_find_native_segwit_outputs"]]
+    benchmarks += [
+        ("blocksci_find_native_segwit_inputs",
+         partial(get_blocksci_data.blocksci_find_native_segwit_inputs, chain), after_segwit),
+        ("blocksci_find_all", partial(get_blocksci_data.blocksci_find_all, chain), whole_chain),
+        ("blocksci_resolve_script_sizes", get_blocksci_data.blocksci_resolve_script_sizes, resolved),
+        ("dump_estimations_to_json", analyze_data.dump_estimations_to_json, whole_chain),
+        ("p2sh_analysis", analyze_data.p2sh_analysis, whole_chain),
+        ("non_std_analysis", analyze_data.non_std_analysis, whole_chain),
+        ("blocksci_count_input_by_type", partial(get_blocksci_data.blocksci_count_input_by_type, chain), whole_chain),
+        ("blocksci_utxo_set_size", partial(get_blocksci_data.blocksci_utxo_set_size, chain), whole_chain),
+        ("utxo_set_evolution", lambda: utxo_set.utxo_set_evolution(chain).save("utxo_set"), whole_chain),
+        ("build_spent_index", partial(spent_index.build_spent_index, chain, "spent_index"), whole_chain)]
+
+    return benchmarks
+
+
+def _rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def _run_child(function, workdir, queue):
+    # Progress is printed to /dev/null: writes are still paid for (as in runs under nohup), without flooding the report
+    os.chdir(workdir)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    try:
+        start_rss = _rss_mb()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        sys.stdout.flush()
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+        queue.put({"seconds": seconds, "start_rss_mb": start_rss, "peak_rss_mb": peak_rss})
+    except Exception:
+        queue.put({"error": traceback.format_exc()})
+
+
+def _snapshot(path):
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            st = os.stat(os.path.join(root, name))
+            files[os.path.join(root, name)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def run_benchmark(function, work, workdir):
+    """
+    Runs a benchmark in a forked process (so that peak RSS is measured for that benchmark only).
+
+    :param function: function to benchmark, called without arguments
+    :param work: tuple, number of blocks and inputs processed by function
+    :param workdir: working directory of the process
+    :return: dictionary with the metrics of the benchmark
+    """
+
+    before = _snapshot(workdir)
+    queue = multiprocessing.get_context("fork").Queue()
+    process = multiprocessing.get_context("fork").Process(target=_run_child, args=(function, workdir, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if "error" in result:
+        return result
+
+    after = _snapshot(workdir)
+    (blocks, inputs) = work
+    result.update({"blocks": blocks, "inputs": inputs, "blocks_per_sec": blocks / result["seconds"],
+                   "inputs_per_sec": inputs / result["seconds"],
+                   "output_bytes": sum([size for path, (size, mtime) in after.items()
+                                        if before.get(path) != (size, mtime)])})
+    return result
+
+
+def run_benchmarks(chain_params, stub_params, workdir=None):
+    """
+    :param chain_params: dictionary, parameters of synthetic_chain.Blockchain
+    :param stub_params: dictionary, parameters of explorer_stub.ExplorerStub (except the chain)
+    :param workdir: working directory (defaults to a temporary directory, removed at the end)
+    :return: dictionary, report with the environment, parameters and metrics of each benchmark
+    """
+
+    start = time.perf_counter()
+    chain = synthetic_chain.Blockchain(**chain_params)
+    print("Synthetic chain: {} blocks, {} inputs (generated in {:.1f}s)".format(len(chain), chain.num_inputs,
+                                                                              time.perf_counter() - start))
+    benchmarks = _benchmarks(chain)
+    stub = ExplorerStub(chain, **stub_params).start()
+    stub.install()
+
+    remove_workdir = workdir is None
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="blocksci_utxos_benchmarks_"))
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    results = {}
+    try:
+        for name, function, work in benchmarks:
+            results[name] = run_benchmark(function, work, workdir)
+            if "error" in results[name]:
+                print("{} failed:\n{}".format(name, results[name]["error"]))
+            else:
+                print("{}: {:.2f}s".format(name, results[name]["seconds"]))
+    finally:
+        stub.stop()
+        if remove_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "python": platform.python_version(),
+            "numpy": np.__version__, "machine": platform.machine(), "cpus": os.cpu_count(),
+            "chain": dict(chain_params, num_inputs=chain.num_inputs, num_outputs=int(chain.output_offsets[-1])),
+            "explorer_stub": dict(stub_params, num_requests=stub.num_requests), "benchmarks": results}
+
+
+def save_report(report, results_dir=RESULTS_DIR):
+    """
+    :param report: dictionary, as returned by run_benchmarks
+    :param results_dir: directory of the reports
+    :return: path of the saved report
+    """
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    path = os.path.join(results_dir, "{}-{}.json".format(report["created"].replace(":", ""), report["commit"]))
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    return path
+
+
+def latest_report(results_dir=RESULTS_DIR):
+    """
+    :param results_dir: directory of the reports
+    :return: dictionary, last report saved in results_dir (None if there is none)
+    """
+    paths = sorted(glob.glob(os.path.join(results_dir, "*.json")))
+    if not paths:
+        return None
+    with open(paths[-1]) as f:
+        return json.load(f)
+
+
+def compare_reports(previous, report, threshold=0.1):
+    """
+    :param previous: dictionary, report of a previous run
+    :param report: dictionary, report of the current run
+    :param threshold: relative increase of a metric (in REGRESSION_METRICS) considered a regression
+    :return: list of tuples (benchmark name, metric, previous value, current value, relative change), one per
+             regression
+    """
+
+    regressions = []
+    for name, result in report["benchmarks"].items():
+        old = previous["benchmarks"].get(name)
+        if not old or "error" in old or "error" in result:
+            continue
+        for metric in REGRESSION_METRICS:
+            if old[metric] and (result[metric] - old[metric]) / old[metric] > threshold:
+                regressions.append((name, metric, old[metric], result[metric], result[metric] / old[metric] - 1))
+
+    return regressions
+
+
+def print_report(report, previous=None):
+    """
+    :param report: dictionary, as returned by run_benchmarks
+    :param previous: dictionary, report to compare with (None does not show changes)
+    """
+    print("{:<38} {:>9} {:>11} {:>11} {:>9} {:>10} {:>8}".format("benchmark", "seconds", "blocks/s", "inputs/s",
+                                                                  "RSS MB", "output KB", "change"))
+    for name, result in report["benchmarks"].items():
+        if "error" in result:
+            print("{:<38} failed".format(name))
+            continue
+        old = previous["benchmarks"].get(name, {}) if previous else {}
+        change = "{:+.0%}".format(result["seconds"] / old["seconds"] - 1) if old.get("seconds") else ""
+        print("{:<38} {:>9.3f} {:>11.0f} {:>11.0f} {:>9.1f} {:>10.1f} {:>8}".format(
+            name, result["seconds"], result["blocks_per_sec"], result["inputs_per_sec"], result["peak_rss_mb"],
+            result["output_bytes"] / 2 ** 10, change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the extractors and analyses on a synthetic chain")
+    parser.add_argument("--blocks", type=int, default=2000, help="number of blocks of the synthetic chain")
+    parser.add_argument("--txs-per-block", type=int, default=20)
+    parser.add_argument("--inputs-per-tx", type=int, default=2)
+    parser.add_argument("--outputs-per-tx", type=int, default=2)
+    parser.add_argument("--segwit-height", type=int, default=None, help="defaults to half the chain")
+    parser.add_argument("--output-mix", type=json.loads, default=None,
+                        help='JSON object with output address types and weights, e.g. \'{"pubkeyhash": 0.9, '
+                             '"scripthash": 0.1}\' (defaults to synthetic_chain.OUTPUT_TYPE_MIX)')
+    parser.add_argument("--p2sh-mix", type=json.loads, default=None,
+                        help="JSON object with P2SH redeem script types and weights")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num-scripts", type=int, default=1000, help="distinct scripts served by the explorer stub")
+    parser.add_argument("--latency", type=float, default=0.0, help="explorer stub latency, in seconds")
+    parser.add_argument("--workdir", default=None, help="working directory (kept), defaults to a temporary one")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--compare", default=None, help="report to compare with (defaults to the latest one)")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative increase reported as a regression")
+    args = parser.parse_args(argv)
+
+    chain_params = {"num_blocks": args.blocks, "txs_per_block": args.txs_per_block,
+                    "inputs_per_tx": args.inputs_per_tx, "outputs_per_tx": args.outputs_per_tx,
+                    "output_mix": args.output_mix, "p2sh_mix": args.p2sh_mix, "segwit_height": args.segwit_height,
+                    "seed": args.seed}
+    stub_params = {"num_scripts": args.num_scripts, "latency": args.latency}
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    else:
+        previous = latest_report(args.results_dir)
+    if previous and {k: previous["chain"].get(k) for k in chain_params} != chain_params:
+        print("Previous report was run with a different synthetic chain, not comparing")
+        previous = None
+
+    report = run_benchmarks(chain_params, stub_params, args.workdir)
+    print("Report saved in {}".format(save_report(report, args.results_dir)))
+    print_report(report, previous)
+    if previous:
+        for (name, metric, old, new, change) in compare_reports(previous, report, args.threshold):
+            print("Regression in {} {}: {:.4g} -> {:.4g} ({:+.0%})".format(name, metric, old, new, change))
+
+
+if __name__ == "__main__":
+    main()
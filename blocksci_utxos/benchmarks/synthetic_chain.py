@@ -0,0 +1,313 @@
+"""
+Synthetic in-memory stand-in for the subset of the blocksci API used by the extractors and analyses: Blockchain
+(len, iteration, block ranges), blocks, transactions, inputs and outputs, and the address_type enum. install()
+registers this module as blocksci, so the pipeline modules can be imported and benchmarked without a BlockSci parse.
+"""
+import enum
+import hashlib
+import random
+import sys
+
+import numpy as np
+
+
+class address_type(enum.Enum):
+    # Same codes as blocksci.address_type. As the blocksci (pybind11) enum, members convert to int but are not ints
+    # (e.g. they are not valid JSON keys).
+    nonstandard = 0
+    pubkey = 1
+    pubkeyhash = 2
+    multisig_pubkey = 3
+    scripthash = 4
+    multisig = 5
+    nulldata = 6
+    witness_pubkeyhash = 7
+    witness_scripthash = 8
+    witness_unknown = 9
+
+    def __int__(self):
+        return self.value
+
+    __index__ = __int__
+
+
+# Address types of the outputs created by the synthetic chain and their weights (inputs have the address type of the
+# output they spend). Witness types are only created from segwit_height on (replaced by pubkeyhash before).
+OUTPUT_TYPE_MIX = {"pubkeyhash": 0.78, "scripthash": 0.12, "witness_pubkeyhash": 0.05, "witness_scripthash": 0.01,
+                   "pubkey": 0.01, "multisig": 0.005, "nonstandard": 0.005, "nulldata": 0.02}
+# Redeem script types of P2SH inputs and their weights (witness types replaced by multisig before segwit_height)
+P2SH_WRAPPED_MIX = {"multisig": 0.55, "witness_pubkeyhash": 0.3, "witness_scripthash": 0.08, "pubkeyhash": 0.02,
+                    "pubkey": 0.01, "nonstandard": 0.02, "scripthash": 0.01}
+# (required, total) keys of P2SH multisig redeem scripts and their weights
+MULTISIG_MIX = {(2, 3): 0.6, (2, 2): 0.25, (1, 2): 0.05, (3, 4): 0.04, (1, 1): 0.04, (2, 4): 0.02}
+
+WITNESS_TYPES = (address_type.witness_pubkeyhash, address_type.witness_scripthash, address_type.witness_unknown)
+
+_PUBKEYS = {33: b"\x02" * 33, 65: b"\x04" * 65}
+
+
+class _Attributes(object):
+    # Read-only bag of attributes (addresses and scripts are shared by all the inputs with the same data)
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class TxOut(object):
+    __slots__ = ["address_type", "value", "spending_tx"]
+
+    def __init__(self, address_type, value):
+        self.address_type = address_type
+        self.value = value
+        self.spending_tx = None
+
+    @property
+    def is_spent(self):
+        return self.spending_tx is not None
+
+
+class TxIn(object):
+    __slots__ = ["address_type", "value", "address", "spent_tx", "age"]
+
+    def __init__(self, address_type, value, address, spent_tx, age):
+        self.address_type = address_type
+        self.value = value
+        self.address = address
+        self.spent_tx = spent_tx
+        self.age = age
+
+
+class Tx(object):
+    __slots__ = ["hash", "index", "block_height", "ins", "outs"]
+
+    def __init__(self, hash, index, block_height):
+        self.hash = hash
+        self.index = index
+        self.block_height = block_height
+        self.ins = []
+        self.outs = []
+
+
+class Block(list):
+    """
+    List of transactions, with the block height and the number of transactions, inputs and outputs.
+    """
+
+    def __init__(self, height, txs):
+        super(Block, self).__init__(txs)
+        self.height = height
+        self.tx_count = len(txs)
+        self.input_count = sum([len(tx.ins) for tx in txs])
+        self.output_count = sum([len(tx.outs) for tx in txs])
+
+
+class _ItemRange(object):
+    # Vectorized attributes of the inputs (or outputs) of a block range
+    def __init__(self, arrays, first, last):
+        self.arrays = arrays
+        self.first = first
+        self.last = last
+
+    def __getattr__(self, name):
+        if name not in self.arrays:
+            raise AttributeError(name)
+        return self.arrays[name][self.first:self.last]
+
+    def __len__(self):
+        return self.last - self.first
+
+
+class BlockRange(list):
+    """
+    List of consecutive blocks, with numpy arrays of the counts of each block and of the attributes of their inputs and
+    outputs (as blocksci block ranges).
+    """
+
+    def __init__(self, chain, first, last):
+        super(BlockRange, self).__init__(chain.blocks[first:last])
+        self.chain = chain
+        self.first = first
+        self.last = last
+
+    @property
+    def tx_count(self):
+        return self.chain.tx_counts[self.first:self.last]
+
+    @property
+    def input_count(self):
+        return self.chain.input_counts[self.first:self.last]
+
+    @property
+    def output_count(self):
+        return self.chain.output_counts[self.first:self.last]
+
+    @property
+    def inputs(self):
+        offsets = self.chain.input_offsets
+        return _ItemRange(self.chain.input_arrays, offsets[self.first], offsets[self.last])
+
+    @property
+    def outputs(self):
+        offsets = self.chain.output_offsets
+        return _ItemRange(self.chain.output_arrays, offsets[self.first], offsets[self.last])
+
+
+class Blockchain(object):
+    """
+    Deterministic random chain (the same parameters always generate the same chain). Each block has a coinbase
+    transaction and on average txs_per_block other transactions, with on average inputs_per_tx inputs (spending random
+    unspent outputs) and outputs_per_tx outputs, whose address types follow output_mix.
+    """
+
+    def __init__(self, path=None, num_blocks=2000, txs_per_block=20, inputs_per_tx=2, outputs_per_tx=2,
+                 output_mix=None, p2sh_mix=None, compressed_ratio=0.9, segwit_height=None, seed=0):
+        """
+        :param path: ignored (blocksci.Blockchain takes the path to the parsed data)
+        :param num_blocks: number of blocks
+        :param txs_per_block: average number of non-coinbase transactions per block
+        :param inputs_per_tx: average number of inputs per transaction
+        :param outputs_per_tx: average number of outputs per transaction
+        :param output_mix: dictionary, address type names and weights of the created outputs (defaults to
+                           OUTPUT_TYPE_MIX)
+        :param p2sh_mix: dictionary, redeem script type names and weights of P2SH inputs (defaults to
+                         P2SH_WRAPPED_MIX)
+        :param compressed_ratio: fraction of P2PKH inputs revealing compressed (33 bytes) public keys
+        :param segwit_height: first height with witness outputs (defaults to num_blocks // 2)
+        :param seed: random seed
+        """
+        self.segwit_height = num_blocks // 2 if segwit_height is None else segwit_height
+        rnd = random.Random(seed)
+        output_types, output_weights = _mix(output_mix or OUTPUT_TYPE_MIX)
+        legacy_types = [ty if ty not in WITNESS_TYPES else address_type.pubkeyhash for ty in output_types]
+        p2sh_addresses, p2sh_weights = self._p2sh_addresses(p2sh_mix or P2SH_WRAPPED_MIX, False)
+        segwit_p2sh_addresses, _ = self._p2sh_addresses(p2sh_mix or P2SH_WRAPPED_MIX, True)
+        p2pkh_addresses = [_Attributes(pubkey=_PUBKEYS[l], script=None) for l in (33, 65)]
+        no_address = _Attributes(pubkey=None, script=None)
+
+        self.blocks = []
+        # Unspent outputs that can be spent (tuples transaction, output), spent ones are swapped with the last one
+        utxos = []
+        num_txs = 0
+        for h in range(num_blocks):
+            segwit = h >= self.segwit_height
+            txs = []
+            for k in range(1 + rnd.randint(0, 2 * txs_per_block)):
+                tx = Tx(hashlib.sha256(b"%d:%d" % (seed, num_txs)).hexdigest(), num_txs, h)
+                num_txs += 1
+                if k > 0:
+                    for _ in range(min(rnd.randint(1, 2 * inputs_per_tx - 1), len(utxos))):
+                        j = rnd.randrange(len(utxos))
+                        utxos[j], utxos[-1] = utxos[-1], utxos[j]
+                        spent_tx, txout = utxos.pop()
+                        txout.spending_tx = tx
+                        if txout.address_type == address_type.pubkeyhash:
+                            address = p2pkh_addresses[rnd.random() >= compressed_ratio]
+                        elif txout.address_type == address_type.scripthash:
+                            address = rnd.choices(segwit_p2sh_addresses if segwit else p2sh_addresses, p2sh_weights)[0]
+                        else:
+                            address = no_address
+                        tx.ins.append(TxIn(txout.address_type, txout.value, address, spent_tx,
+                                           h - spent_tx.block_height))
+                num_outputs = 1 if k == 0 else rnd.randint(1, 2 * outputs_per_tx - 1)
+                for ty in rnd.choices(output_types if segwit else legacy_types, output_weights, k=num_outputs):
+                    txout = TxOut(ty, rnd.randint(546, 10 ** 8))
+                    tx.outs.append(txout)
+                    if ty != address_type.nulldata:
+                        utxos.append((tx, txout))
+                txs.append(tx)
+            self.blocks.append(Block(h, txs))
+
+        self._build_arrays()
+
+    @staticmethod
+    def _p2sh_addresses(p2sh_mix, segwit):
+        # Shared P2SH addresses, one per redeem script type (and multisig key), and their weights
+        addresses, weights = [], []
+        for name, weight in p2sh_mix.items():
+            ty = address_type[name]
+            keys = MULTISIG_MIX if ty == address_type.multisig else {None: 1.0}
+            if not segwit and ty in WITNESS_TYPES:
+                # Same number of addresses (and weights) before and after segwit_height
+                ty = address_type.multisig
+            for key, key_weight in keys.items():
+                (required, total) = key or (2, 3)
+                wrapped_script = _Attributes(pubkey=_PUBKEYS[33], required=required, total=total)
+                script = _Attributes(wrapped_address=_Attributes(type=ty), wrapped_script=wrapped_script)
+                addresses.append(_Attributes(pubkey=None, script=script))
+                weights.append(weight * key_weight)
+        return addresses, weights
+
+    def _build_arrays(self):
+        # Flat arrays (in chain order) read by block ranges
+        self.tx_counts = np.array([b.tx_count for b in self.blocks], dtype=np.int64)
+        self.input_counts = np.array([b.input_count for b in self.blocks], dtype=np.int64)
+        self.output_counts = np.array([b.output_count for b in self.blocks], dtype=np.int64)
+        self.input_offsets = np.concatenate([[0], np.cumsum(self.input_counts)])
+        self.output_offsets = np.concatenate([[0], np.cumsum(self.output_counts)])
+
+        inputs = [txin for b in self.blocks for tx in b for txin in tx.ins]
+        outputs = [txout for b in self.blocks for tx in b for txout in tx.outs]
+        self.input_arrays = {
+            "address_type": np.array([int(txin.address_type) for txin in inputs], dtype=np.int64),
+            "value": np.array([txin.value for txin in inputs], dtype=np.int64),
+            "age": np.array([txin.age for txin in inputs], dtype=np.int64),
+            # Redeem script type of P2SH inputs (-1 for other inputs)
+            "wrapped_type": np.array([int(txin.address.script.wrapped_address.type) if txin.address.script else -1
+                                      for txin in inputs], dtype=np.int64)}
+        self.output_arrays = {
+            "address_type": np.array([int(txout.address_type) for txout in outputs], dtype=np.int64),
+            "value": np.array([txout.value for txout in outputs], dtype=np.int64),
+            "is_spent": np.array([txout.is_spent for txout in outputs], dtype=bool),
+            "spending_tx_index": np.array([txout.spending_tx.index if txout.is_spent else 0 for txout in outputs],
+                                          dtype=np.int64)}
+
+    @property
+    def num_inputs(self):
+        return int(self.input_offsets[-1])
+
+    def count_inputs(self, first_height=0, types=None, wrapped_types=None):
+        """
+        :param first_height: only count inputs at this height or above
+        :param types: only count inputs of these address types (None counts all of them)
+        :param wrapped_types: only count P2SH inputs with these redeem script types
+        :return: integer, number of inputs
+        """
+        first = self.input_offsets[first_height]
+        mask = np.ones(self.num_inputs - first, dtype=bool)
+        if types is not None:
+            mask &= np.isin(self.input_arrays["address_type"][first:], [int(ty) for ty in types])
+        if wrapped_types is not None:
+            mask &= np.isin(self.input_arrays["wrapped_type"][first:], [int(ty) for ty in wrapped_types])
+        return int(np.count_nonzero(mask))
+
+    def tx(self, txid):
+        """
+        :param txid: transaction hash
+        :return: Tx object (None if it is not in the chain)
+        """
+        if not hasattr(self, "txs_by_hash"):
+            self.txs_by_hash = {tx.hash: tx for b in self.blocks for tx in b}
+        return self.txs_by_hash.get(str(txid))
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            first, last, _ = k.indices(len(self.blocks))
+            return BlockRange(self, first, max(first, last))
+        return self.blocks[k]
+
+
+def _mix(mix):
+    return [address_type[name] for name in mix], list(mix.values())
+
+
+def install():
+    """
+    Registers this module as blocksci, so that modules importing blocksci use the synthetic chain. Must be called
+    before importing them.
+    """
+    sys.modules["blocksci"] = sys.modules[__name__]
@@ -1,3 +1,5 @@
+import os
+
 BITCOIN = 0
 BITCOIN_CASH = 1
 LITECOIN = 2
@@ -7,6 +9,64 @@ COIN_STR = {
     BITCOIN_CASH: "bch",
     LITECOIN: "ltc"}
 
+# Folder where the results of each coin are written (coins not listed write them in the current folder), see coin_file
+OUTPUT_DIRS = {}
+
+
+def coin_file(coin, suffix):
+    """
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :param suffix: file name suffix (e.g. "_p2sh.pickle")
+    :return: path of a results file of the coin, in its output folder (see OUTPUT_DIRS)
+    """
+    return os.path.join(OUTPUT_DIRS.get(coin, ""), COIN_STR[coin] + suffix)
+
+
 SAVE_HEIGHT_INTERVAL = 100000
 
-EXTERNAL_API_DELAY = 1
\ No newline at end of file
+EXTERNAL_API_DELAY = 1
+
+# External explorers: maximum number of simultaneous requests, requests per second allowed by each provider
+# (defaults to one request each EXTERNAL_API_DELAY seconds), request timeout and retries with exponential backoff
+EXTERNAL_API_CONCURRENCY = 8
+EXTERNAL_API_RATE_LIMITS = {
+    "blockchain.info": 1.0 / EXTERNAL_API_DELAY,
+    "insight.litecore.io": 1.0 / EXTERNAL_API_DELAY,
+    "bitcoincash.blockexplorer.com": 1.0 / EXTERNAL_API_DELAY,
+    "chainz.cryptoid.info": 1.0 / EXTERNAL_API_DELAY}
+EXTERNAL_API_TIMEOUT = 30
+EXTERNAL_API_MAX_RETRIES = 10
+EXTERNAL_API_BACKOFF = 2
+EXTERNAL_API_MAX_BACKOFF = 3600
+
+# Persistent cache of explorer data (None disables it), maximum number of cached transactions and whether the cache
+# is fully loaded in memory when opened
+EXTERNAL_API_CACHE_FILE = "explorer_cache.sqlite"
+EXTERNAL_API_CACHE_MAX_TXS = 5000000
+EXTERNAL_API_CACHE_WARM_START = False
+
+# Archive of raw explorer responses (see response_cache.ResponseArchive): None disables it, "record" stores every
+# response in EXTERNAL_API_ARCHIVE_FILE, and "replay" answers requests from the archive, without rate limits. In replay
+# mode, requests missing from the archive are sent (and recorded), or fail if EXTERNAL_API_ARCHIVE_STRICT is set.
+EXTERNAL_API_ARCHIVE_MODE = None
+EXTERNAL_API_ARCHIVE_FILE = "explorer_archive.bin"
+EXTERNAL_API_ARCHIVE_STRICT = False
+
+# Folders with the block files (blk*.dat) of the nodes of each coin, e.g. {BITCOIN: "/home/bitcoin/.bitcoin/blocks"}.
+# Scripts and witnesses of the coins listed are read from these files instead of the external explorers (see
+# raw_blocks.RawBlocks), using a transaction index built once in COIN_raw_blocks_index.
+RAW_BLOCKS_DIRS = {}
+
+# Number of inputs resolved at once with external APIs
+EXTERNAL_API_BATCH_SIZE = 1000
+
+# Progress of long running stages (chain scans, script resolution): seconds between progress lines, file where
+# metrics are written (JSON lines, or a Prometheus textfile if its name ends with .prom; None disables it) and
+# seconds between writes of the metrics file
+PROGRESS_INTERVAL = 10
+METRICS_FILE = "metrics.jsonl"
+METRICS_FLUSH_INTERVAL = 60
+
+# STATUS estimation files: write per-height estimations as gzip compressed dense arrays indexed by height, instead of
+# json dictionaries keyed by height (see analyze_data.dump_estimations_to_json)
+STATUS_COMPACT_EXPORT = False
@@ -1,123 +1,378 @@
-from time import sleep
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
 import requests
+from requests.adapters import HTTPAdapter
 
 from constants import *
+from progress import METRICS
+from raw_blocks import RawBlocks, build_raw_blocks_index, serialize_witness, witness_pushes
+from response_cache import ResponseArchive, ScriptCache
 
-cache_response, cache_txid = None, None
+# Explorer used for each (coin, data kind), data kind being "script" (scriptSig) or "witness"
+PROVIDERS = {
+    (BITCOIN, "script"): "blockchain.info",
+    (BITCOIN, "witness"): "blockchain.info",
+    (LITECOIN, "script"): "insight.litecore.io",
+    # These APIs do not seem to include witness scripts
+    # url = "https://chain.so/api/v2/get_tx_inputs/LTC/"
+    # url = "https://api.blockcypher.com/v1/ltc/main/txs/{}/?instart={}&limit=1".format(txid, input_ind)
+    # url = "https://insight.litecore.io/api/tx/{}".format(txid)
+    (LITECOIN, "witness"): "chainz.cryptoid.info",
+    (BITCOIN_CASH, "script"): "bitcoincash.blockexplorer.com",
+}
 
+PROVIDER_URLS = {
+    "blockchain.info": "https://blockchain.info/rawtx/{}",
+    "insight.litecore.io": "https://insight.litecore.io/api/tx/{}",
+    "bitcoincash.blockexplorer.com": "https://bitcoincash.blockexplorer.com/api/tx/{}",
+    "chainz.cryptoid.info": "https://chainz.cryptoid.info/explorer/tx.raw.dws?coin=ltc&id={}&fmt.js",
+}
 
-def get_script_size_API(list_of_inputs, coin):
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter: allows rate requests per second on average, with bursts of up to burst
+    requests.
     """
-    Queries blockchain.info API for input script length.
 
-    :param list_of_inputs: list of tuples (transaction id, input index)
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+_sessions = {}
+_rate_limiters = {}
+_providers_lock = threading.Lock()
+_script_cache = None
+_response_archive = None
+_raw_blocks = {}
+_raw_blocks_lock = threading.Lock()
+
+
+def _get_session(provider):
+    """
+    :param provider: provider name
+    :return: tuple, requests session (keeping connections alive) and rate limiter shared by all calls to provider
+    """
+    with _providers_lock:
+        if provider not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=EXTERNAL_API_CONCURRENCY)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[provider] = session
+            rate = EXTERNAL_API_RATE_LIMITS.get(provider, 1.0 / EXTERNAL_API_DELAY)
+            _rate_limiters[provider] = TokenBucket(rate, burst=max(1, int(rate)))
+        return _sessions[provider], _rate_limiters[provider]
+
+
+def get_script_cache():
+    """
+    :return: ScriptCache used by fetch_input_scripts (opened on first use), None if EXTERNAL_API_CACHE_FILE is None
+    """
+    global _script_cache
+    with _providers_lock:
+        if _script_cache is None and EXTERNAL_API_CACHE_FILE:
+            _script_cache = ScriptCache(EXTERNAL_API_CACHE_FILE, EXTERNAL_API_CACHE_MAX_TXS,
+                                        EXTERNAL_API_CACHE_WARM_START)
+        return _script_cache
+
+
+def set_script_cache(cache):
+    """
+    Replaces the ScriptCache used by fetch_input_scripts (e.g. to open it with warm_start). None disables caching.
+    """
+    global _script_cache
+    with _providers_lock:
+        _script_cache = cache
+
+
+def get_response_archive():
+    """
+    :return: ResponseArchive used by fetch_tx (opened on first use), None if EXTERNAL_API_ARCHIVE_MODE is None
+    """
+    global _response_archive
+    with _providers_lock:
+        if _response_archive is None and EXTERNAL_API_ARCHIVE_MODE:
+            _response_archive = ResponseArchive(EXTERNAL_API_ARCHIVE_FILE)
+        return _response_archive
+
+
+def set_response_archive(archive):
+    """
+    Replaces the ResponseArchive used by fetch_tx (e.g. to record to another file). EXTERNAL_API_ARCHIVE_MODE still
+    sets whether it is recorded or replayed.
+    """
+    global _response_archive
+    with _providers_lock:
+        _response_archive = archive
+
+
+def get_raw_blocks(coin):
+    """
     :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
-    :return: tuple, list with script lengths and list with scripts
+    :return: RawBlocks reading the block files of the coin (opened on first use, building its index if it does not
+             exist yet), None if RAW_BLOCKS_DIRS has no folder for the coin
     """
+    with _raw_blocks_lock:
+        if coin not in _raw_blocks:
+            raw_blocks = None
+            if RAW_BLOCKS_DIRS.get(coin):
+                path = coin_file(coin, "_raw_blocks_index")
+                if not RawBlocks.exists(path):
+                    build_raw_blocks_index(RAW_BLOCKS_DIRS[coin], path)
+                raw_blocks = RawBlocks.load(path)
+            _raw_blocks[coin] = raw_blocks
+        return _raw_blocks[coin]
 
-    def get_script(txid, input_ind, coin):
 
-        global cache_response, cache_txid
+def update_raw_blocks_index(coin, executor=None):
+    """
+    Builds the transaction index of the block files of the coin (see RAW_BLOCKS_DIRS), or extends it with the blocks
+    added since it was built.
 
-        def get_url(txid, input_ind, coin):
-            if coin == BITCOIN:
-                return "https://blockchain.info/rawtx/{}".format(txid)
-            elif coin == LITECOIN:
-                return "https://insight.litecore.io/api/tx/{}".format(txid)
-            elif coin == BITCOIN_CASH:
-                return "https://bitcoincash.blockexplorer.com/api/tx/{}".format(txid)
-            else:
-                raise Exception
-
-        def get_hex_script_from_json(response, txid, input_ind):
-            if coin == BITCOIN:
-                return response["inputs"][input_ind]["script"]
-            elif coin == LITECOIN:
-                assert response["vin"][input_ind]["n"] == input_ind
-                return response["vin"][input_ind]["scriptSig"]["hex"]
-            elif coin == BITCOIN_CASH:
-                assert response["vin"][input_ind]["n"] == input_ind
-                return response["vin"][input_ind]["scriptSig"]["hex"]
-            else:
-                raise Exception
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :param executor: process pool where block files are parsed (see build_raw_blocks_index)
+    :return:
+    """
+    with _raw_blocks_lock:
+        old = _raw_blocks.pop(coin, None)
+        if old is not None:
+            old.close()
+        build_raw_blocks_index(RAW_BLOCKS_DIRS[coin], coin_file(coin, "_raw_blocks_index"), executor=executor)
 
-        if str(cache_txid) == str(txid):
-            response = cache_response
-        else:
-            url = get_url(txid, input_ind, coin)
-            req = requests.request('GET', url)
-            response = req.json()
-            cache_response, cache_txid = response, txid
-            sleep(EXTERNAL_API_DELAY)
 
-        script = get_hex_script_from_json(response, txid, input_ind)
-        return script
+def get_provider(coin, kind):
+    if (coin, kind) not in PROVIDERS:
+        raise Exception("No {} provider for coin {}".format(kind, COIN_STR.get(coin, coin)))
+    return PROVIDERS[(coin, kind)]
 
-    sizes = []
-    scripts = []
 
-    for inp in list_of_inputs:
-        (txid, input_ind) = inp
+def fetch_tx(txid, coin, kind="script"):
+    """
+    Gets a transaction from the explorer of the given coin and data kind. Requests to the same provider are rate
+    limited and failed requests are retried with exponential backoff (from EXTERNAL_API_BACKOFF seconds up to
+    EXTERNAL_API_MAX_BACKOFF seconds, at most EXTERNAL_API_MAX_RETRIES times).
+
+    Responses are recorded in the response archive, or replayed from it, depending on EXTERNAL_API_ARCHIVE_MODE (see
+    get_response_archive).
+
+    :param txid: transaction id
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :param kind: "script" or "witness"
+    :return: decoded JSON response
+    """
+
+    provider = get_provider(coin, kind)
+    archive = get_response_archive() if EXTERNAL_API_ARCHIVE_MODE else None
+    if archive is not None and EXTERNAL_API_ARCHIVE_MODE == "replay":
+        body = archive.get(provider, txid)
+        if body is not None:
+            METRICS.inc("archive_hits")
+            return json.loads(body)
+        METRICS.inc("archive_misses")
+        if EXTERNAL_API_ARCHIVE_STRICT:
+            raise Exception("No archived {} response for {}".format(provider, txid))
+
+    url = PROVIDER_URLS[provider].format(txid)
+    session, rate_limiter = _get_session(provider)
+
+    backoff = EXTERNAL_API_BACKOFF
+    for attempt in range(EXTERNAL_API_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        METRICS.inc("api_calls")
+        start = time()
         try:
-            script = get_script(txid, input_ind, coin)
-        except:
-            print("sleeping for an hour...")
-            sleep(3600)
-            script = get_script(txid, input_ind, coin)
-        scripts.append(script)
-        sizes.append(len(script)/2)
+            req = session.get(url, timeout=EXTERNAL_API_TIMEOUT)
+            req.raise_for_status()
+            response = req.json()
+            METRICS.observe("api_latency", time() - start)
+            if archive is not None:
+                archive.put(provider, txid, req.content)
+            return response
+        except (requests.RequestException, ValueError) as e:
+            METRICS.inc("api_errors")
+            if attempt == EXTERNAL_API_MAX_RETRIES:
+                raise
+            print("{} request for {} failed ({}), retrying in {}s...".format(provider, txid, e, backoff))
+            sleep(backoff)
+            backoff = min(backoff * 2, EXTERNAL_API_MAX_BACKOFF)
 
-    return sizes, scripts
 
+def get_hex_script_from_json(response, input_ind, coin, kind="script"):
+    """
+    Extracts the input script (or witness) of an input from an explorer response.
 
-def get_witness_size_API(list_of_inputs, coin):
+    :param response: decoded JSON response, as returned by fetch_tx
+    :param input_ind: input index
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :param kind: "script" or "witness"
+    :return: hex string with the script
+    """
+
+    provider = get_provider(coin, kind)
+    if provider == "blockchain.info":
+        return response["inputs"][input_ind][kind]
+    elif provider in ["insight.litecore.io", "bitcoincash.blockexplorer.com"]:
+        assert response["vin"][input_ind]["n"] == input_ind
+        return response["vin"][input_ind]["scriptSig"]["hex"]
+    elif provider == "chainz.cryptoid.info":
+        data_pushes_script = response["vin"][input_ind]["txinwitness"]
+        # This API returns a list with data pushes in the witness, so we need to reconstruct the script:
+        return witness_script([bytes.fromhex(d) for d in data_pushes_script], coin)
+    else:
+        raise Exception
+
+
+def witness_script(items, coin):
+    """
+    Builds the witness script of an input from its items, in the format of the witness explorer of the coin (see
+    PROVIDERS), so that witness sizes are the same whatever the source of the witness (explorer or block files):
+        - chainz.cryptoid.info: non-empty data pushes, each preceded by its size
+        - blockchain.info (and coins without witness explorer): serialized witness, with the item count
+
+    :param items: list with the items (bytes) of the witness
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :return: hex string with the witness script
+    """
+    if PROVIDERS.get((coin, "witness")) == "chainz.cryptoid.info":
+        return witness_pushes(items).hex()
+    return serialize_witness(items).hex()
+
+
+def get_all_scripts_from_json(response, coin, provider):
     """
-    Queries blockchain.info API for witness script lenght.
+    Extracts the input scripts (and/or witnesses) of every input of a transaction from an explorer response.
+
+    :param response: decoded JSON response, as returned by fetch_tx
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :param provider: provider that returned the response
+    :return: dictionary, keys are the data kinds served by provider for coin ("script" and/or "witness") and values
+             lists with the hex script of each input (None if not available)
+    """
+
+    num_inputs = len(response["inputs"]) if provider == "blockchain.info" else len(response["vin"])
+    scripts_by_kind = {}
+    for kind in ["script", "witness"]:
+        if PROVIDERS.get((coin, kind)) == provider:
+            scripts = []
+            for input_ind in range(num_inputs):
+                try:
+                    scripts.append(get_hex_script_from_json(response, input_ind, coin, kind))
+                except (KeyError, IndexError, TypeError, AssertionError):
+                    scripts.append(None)
+            scripts_by_kind[kind] = scripts
+
+    return scripts_by_kind
+
+
+def fetch_tx_scripts(txid, coin, kind="script"):
+    """
+    Gets the input scripts (or witnesses) of every input of a transaction, from the persistent cache if available or
+    from the explorer otherwise (storing them in the cache).
+
+    :param txid: transaction id
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :param kind: "script" or "witness"
+    :return: list with the hex script of each input of the transaction (None if not available)
+    """
+
+    cache = get_script_cache()
+    if cache:
+        scripts = cache.get(coin, txid, kind)
+        if scripts is not None:
+            METRICS.inc("cache_hits")
+            return scripts
+        METRICS.inc("cache_misses")
+
+    scripts_by_kind = get_all_scripts_from_json(fetch_tx(txid, coin, kind), coin, get_provider(coin, kind))
+    if cache:
+        cache.put(coin, txid, scripts_by_kind)
+    return scripts_by_kind[kind]
+
+
+def fetch_input_scripts(list_of_inputs, coin, kind="script", concurrency=None):
+    """
+    Gets the input scripts (or witnesses) of a batch of inputs. Each transaction is requested only once, even if
+    several of its inputs are in the batch, and up to concurrency transactions are requested at the same time.
+    Transactions found in the persistent cache (see get_script_cache) are not requested, and neither are the ones
+    found in the local block files of the coin (see get_raw_blocks), which are read from disk.
 
     :param list_of_inputs: list of tuples (transaction id, input index)
-    :param coin: BITCOIN or LITECOIN
-    :return: tuple, list with script lengths and list with scripts
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :param kind: "script" or "witness"
+    :param concurrency: maximum number of simultaneous requests (defaults to EXTERNAL_API_CONCURRENCY)
+    :return: tuple, list with script lengths and list with scripts (in the same order as list_of_inputs)
     """
 
-    def get_script(txid, input_ind, coin):
+    txids = list(dict.fromkeys([str(txid) for (txid, _) in list_of_inputs]))
 
-        if coin == BITCOIN:
-            url = "https://blockchain.info/rawtx/"
-            req = requests.request('GET', url + str(txid))
-            response = req.json()
-            script = response["inputs"][input_ind]["witness"]
-            sleep(EXTERNAL_API_DELAY)
-        elif coin == LITECOIN:
-            # These APIs do not seem to include witness scripts
-            # url = "https://chain.so/api/v2/get_tx_inputs/LTC/"
-            # url = "https://api.blockcypher.com/v1/ltc/main/txs/{}/?instart={}&limit=1".format(txid, input_ind)
-            # url = "https://insight.litecore.io/api/tx/{}".format(txid)
-
-            url = "https://chainz.cryptoid.info/explorer/tx.raw.dws?coin=ltc&id={}&fmt.js".format(txid)
-            req = requests.request('GET', url)
-            response = req.json()
-            data_pushes_script = response["vin"][input_ind]["txinwitness"]
-            # This API returns a list with data pushes in the witness, so we need to reconstruct the script:
-            script = "".join(["{:02x}{}".format(int(len(d)/2), d) for d in data_pushes_script if d != ""])
-            sleep(EXTERNAL_API_DELAY)
-        else:
-            raise Exception
+    tx_scripts = {}
+    raw_blocks = get_raw_blocks(coin)
+    if raw_blocks is not None:
+        # Transactions missing from the block files (e.g. in blocks not indexed yet) are requested to the explorers
+        for txid, scripts in raw_blocks.tx_scripts(txids).items():
+            if kind == "witness":
+                tx_scripts[txid] = [witness_script([bytes.fromhex(item) for item in items], coin)
+                                    for items in scripts["witness"]]
+            else:
+                tx_scripts[txid] = scripts["script"]
+        METRICS.inc("raw_block_reads", len(tx_scripts))
+        txids = [txid for txid in txids if txid not in tx_scripts]
 
-        return script
+    if len(txids) == 1:
+        tx_scripts[txids[0]] = fetch_tx_scripts(txids[0], coin, kind)
+    elif txids:
+        with ThreadPoolExecutor(max_workers=concurrency or EXTERNAL_API_CONCURRENCY) as executor:
+            tx_scripts.update(zip(txids, executor.map(lambda txid: fetch_tx_scripts(txid, coin, kind), txids)))
 
-    sizes = []
     scripts = []
+    for (txid, input_ind) in list_of_inputs:
+        script = tx_scripts[str(txid)][input_ind]
+        if script is None:
+            raise Exception("No {} found for input {} of {}".format(kind, input_ind, txid))
+        scripts.append(script)
+    sizes = [len(script) / 2 for script in scripts]
 
-    for inp in list_of_inputs:
-        (txid, input_ind) = inp
-        try:
-            script = get_script(txid, input_ind, coin)
-        except:
-            print("sleeping for an hour...")
-            sleep(3600)
-            script = get_script(txid, input_ind, coin)
+    return sizes, scripts
 
-        scripts.append(script)
-        sizes.append(len(script) / 2)
 
-    return sizes, scripts
\ No newline at end of file
+def get_script_size_API(list_of_inputs, coin):
+    """
+    Queries blockchain.info API (or the local block files, see RAW_BLOCKS_DIRS) for input script length.
+
+    :param list_of_inputs: list of tuples (transaction id, input index)
+    :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+    :return: tuple, list with script lengths and list with scripts
+    """
+
+    return fetch_input_scripts(list_of_inputs, coin, "script")
+
+
+def get_witness_size_API(list_of_inputs, coin):
+    """
+    Queries blockchain.info API (or the local block files, see RAW_BLOCKS_DIRS) for witness script lenght.
+
+    :param list_of_inputs: list of tuples (transaction id, input index)
+    :param coin: BITCOIN or LITECOIN
+    :return: tuple, list with script lengths and list with scripts
+    """
+
+    return fetch_input_scripts(list_of_inputs, coin, "witness")
@@ -1,7 +1,18 @@
+import json
+import os
 import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
 
 import blocksci
+import numpy as np
 from external_apis import *
+from accumulators import *
+from progress import *
+from profiling import *
+from results_store import *
+from type_counts import *
 
 from constants import *
 
@@ -23,20 +34,13 @@ def blocksci_count_input_by_type(chain):
         address_type.witness_scripthash: 2}
 
 
+    Per height counts (of inputs and outputs) can be obtained with type_counts.count_by_type.
+
     :param chain: blocksci chain object
     :return: dictionary, keys are input types, values are number of occurrences
     """
 
-    input_spending_type = {}
-    for block in chain:
-        for tx in block:
-            for txin in tx.ins:
-                if txin.address_type in input_spending_type.keys():
-                    input_spending_type[txin.address_type] += 1
-                else:
-                    input_spending_type[txin.address_type] = 1
-
-    return input_spending_type
+    return type_totals(count_by_type(chain, "inputs"))
 
 
 def blocksci_utxo_set_size(chain):
@@ -46,21 +50,872 @@ def blocksci_utxo_set_size(chain):
     Note: it does not compute how many of the current UTXOs are found at a given height, but the number of UTXOs
     existing when we were at that height!
 
+    The number of UTXOs of each address type can be obtained with type_counts.utxo_set_size_by_type, and the exact
+    composition of the UTXO set at each height (value, address types, creation heights) with
+    utxo_set.utxo_set_evolution.
+
+    :param chain: blocksci chain object
+    :return: list of tuples (block height, number of UTXOs)
+    """
+
+    num_inputs, num_outputs = block_counts(chain)
+    utxo_set_size = cumulative_counts(num_outputs - num_inputs)
+
+    return list(zip(range(len(utxo_set_size)), utxo_set_size.tolist()))
+
+
+SEGWIT_ACTIVATION_HEIGHT = 481824
+
+
+class ChainCollector(object):
+    """
+    Visitor fed by blocksci_scan. Each blocksci_find_* extractor is implemented as a collector, so that several of
+    them can share a single traversal of the chain.
+
+    A collector declares the address types of the inputs (input_types) and outputs (output_types) it is interested in.
+    The scan engine reads the address type of every input/output only once and dispatches it to the collectors that
+    registered that type.
+
+    Collectors with checkpoints save their progress as append-only segments: each checkpoint writes only the state
+    for the heights processed since the previous one (in the directory pickle_file + "_segments", whose
+    manifest.json lists the covered height ranges), and then starts again with an empty state. When the scan
+    finishes, segments are merged into the final results and removed.
+
+    In update mode (see start_update), a collector loads the results of a previous run and only processes the blocks
+    above the last height they cover.
+    """
+
+    pickle_file = None
+    input_types = ()
+    output_types = ()
+    start_height = 0
+    checkpoints = True
+
+    def __init__(self, coin=BITCOIN):
+        self.coin = coin
+
+    def start(self, chain, restart_from_height=None, heights=None, resume=True):
+        """
+        Initializes the collector state. If there are checkpoint segments from a previous (interrupted) run, the scan
+        resumes after the last complete segment.
+
+        :param chain: blocksci chain object
+        :param restart_from_height: only resume from segments ending at or before this height (None resumes from the
+                                    last segment)
+        :param heights: range of heights covered by the state (defaults to the whole chain)
+        :param resume: boolean, resume from existing segments
+        :return: integer, last block height already processed
+        """
+        heights = heights if heights is not None else range(len(chain))
+        self.num_heights = heights.stop
+        self.first_height = heights.start
+        self.segments = []
+
+        if resume and self.checkpoints:
+            manifest = _load_json(os.path.join(self.segments_dir(), "manifest.json"), {"segments": []})
+            for first, last, name in manifest["segments"]:
+                if first != self.first_height or (restart_from_height is not None and last > restart_from_height):
+                    break
+                self.segments.append([first, last, name])
+                self.first_height = last + 1
+
+        self.reset(range(self.first_height, self.num_heights))
+        return self.first_height - 1
+
+    def start_update(self, chain):
+        """
+        Initializes the collector state with the results of a previous (complete) run, so that only blocks above the
+        last height they cover are processed. If there are no previous results, the collector starts from scratch.
+
+        :param chain: blocksci chain object
+        :return: integer, last block height already processed
+        """
+        self.num_heights = len(chain)
+        self.segments = []
+        last_height = self.load_previous()
+        if last_height is None:
+            return self.start(chain, resume=False)
+        self.first_height = last_height + 1
+        return last_height
+
+    def load_previous(self):
+        """
+        Loads the results dumped by a previous run and resets the state for the heights above them.
+
+        :return: integer, last height covered by the previous results (None if there are no previous results)
+        """
+        raise NotImplementedError
+
+    def segments_dir(self):
+        return self.pickle_file + "_segments"
+
+    def reset(self, heights):
+        raise NotImplementedError
+
+    def state(self):
+        raise NotImplementedError
+
+    def merge(self, state):
+        """
+        Merges the state of a collector that processed a later range of heights into this one.
+
+        :param state: tuple, as returned by state()
+        :return:
+        """
+        raise NotImplementedError
+
+    def checkpoint(self, last_height):
+        """
+        Appends a segment with the state for the heights processed since the previous checkpoint (up to last_height)
+        and starts again with an empty state.
+
+        :param last_height: last processed height
+        :return:
+        """
+        path = self.segments_dir()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        name = "{}-{}.pickle".format(self.first_height, last_height)
+        _atomic_write(os.path.join(path, name), pickle.dumps(self.state()))
+        self.segments.append([self.first_height, last_height, name])
+        _atomic_write(os.path.join(path, "manifest.json"), json.dumps({"segments": self.segments}).encode())
+
+        self.first_height = last_height + 1
+        self.reset(range(self.first_height, self.num_heights))
+        INSTRUMENTATION.snapshot("checkpoint {} {}".format(self.pickle_file, last_height))
+
+    def finish(self):
+        """
+        Compacts the checkpoint segments and the current state into the final results, dumps them and removes the
+        segments.
+
+        :return:
+        """
+        if self.segments:
+            tail = self.state()
+            self.reset(range(self.num_heights))
+            for _, _, name in self.segments:
+                self.merge(pickle.load(open(os.path.join(self.segments_dir(), name), "rb")))
+            self.merge(tail)
+
+        self.dump()
+        if self.checkpoints:
+            shutil.rmtree(self.segments_dir(), ignore_errors=True)
+            self.segments = []
+
+    def begin_block(self, block):
+        pass
+
+    def visit_input(self, block, tx, i, txin, address_type):
+        pass
+
+    def visit_output(self, block, tx, i, txout, address_type):
+        pass
+
+    def end_block(self, block):
+        pass
+
+    def dump(self):
+        pickle.dump(self.state(), open(self.pickle_file + ".pickle", "wb"))
+
+
+def _load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def _atomic_write(path, data):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+class HeightColumnsCollector(ChainCollector):
+    """
+    Collector storing its results in sparse columnar stores (see results_store.HeightColumns) instead of pickled
+    dictionaries of lists. Results are saved in the directory pickle_file, with one store per entry of the columns
+    dictionary (the store named "" is saved in the directory itself).
+    """
+
+    columns = {}
+    # Stores loaded from a previous run (update mode), new values are appended to them when dumping
+    previous = None
+
+    def reset(self, heights):
+        self.num_heights = heights.stop
+        self.stores = {name: HeightColumnsBuilder(dtypes) for name, dtypes in self.columns.items()}
+
+    def load_previous(self):
+        paths = {name: os.path.join(self.pickle_file, name) for name in self.columns}
+        if not all([os.path.exists(os.path.join(path, "offsets.npy")) for path in paths.values()]):
+            return None
+        self.previous = {name: HeightColumns.load(path, mmap_mode=None) for name, path in paths.items()}
+        last_height = min([store.num_heights for store in self.previous.values()]) - 1
+        self.reset(range(last_height + 1, self.num_heights))
+        return last_height
+
+    def state(self):
+        return self.num_heights, self.stores
+
+    def merge(self, state):
+        (_, stores) = state
+        for name, store in stores.items():
+            self.stores[name].extend(store)
+
+    def dump(self):
+        for name, store in self.stores.items():
+            store = store.build(self.num_heights)
+            if self.previous:
+                store = self.previous[name].concatenate(store)
+            store.save(os.path.join(self.pickle_file, name))
+
+
+INPUT_COLUMNS = {"txid": TXID_DTYPE, "index": np.uint32}
+OUTPUT_COLUMNS = {"txid": TXID_DTYPE, "index": np.uint32, "is_spent": np.bool_}
+# Inputs whose script size has to be resolved with external APIs (see blocksci_resolve_script_sizes)
+PENDING_COLUMNS = {"txid": TXID_DTYPE, "index": np.uint32, "category": np.uint8}
+# P2SH redeem script types whose size is resolved with external APIs, and their category in PENDING_COLUMNS
+P2SH_DEFERRED_TYPES = ["nonstandard", "scripthash"]
+
+
+class P2PKHPubkeyCollector(ChainCollector):
+    """
+    Sizes of the public keys revealed by P2PKH inputs, indexed both by input and by output height
+    (see blocksci_find_pk_in_p2pkh).
+    """
+
+    input_types = (blocksci.address_type.pubkeyhash,)
+
+    def __init__(self, coin=BITCOIN):
+        super(P2PKHPubkeyCollector, self).__init__(coin)
+        self.pickle_file = coin_file(coin, "_pk_sizes_in")
+        self.pickle_file_out = coin_file(coin, "_pk_sizes_out")
+
+    def reset(self, heights):
+        self.num_heights = heights.stop
+        self.pubkey_sizes = {}
+        self.unknowns = 0
+        # Outputs spent in heights can be found in any previous block. Only output heights with spent outputs are
+        # kept (the dumped results have every height, see dump).
+        self.pubkey_sizes_outs = {}
+        self.unknowns_outs = 0
+
+    def state(self):
+        return self.pubkey_sizes, self.unknowns, self.pubkey_sizes_outs, self.unknowns_outs
+
+    def load_previous(self):
+        if not (os.path.exists(self.pickle_file + ".pickle") and os.path.exists(self.pickle_file_out + ".pickle")):
+            return None
+        (pubkey_sizes, unknowns) = pickle.load(open(self.pickle_file + ".pickle", "rb"))
+        (pubkey_sizes_outs, unknowns_outs) = pickle.load(open(self.pickle_file_out + ".pickle", "rb"))
+        last_height = max(pubkey_sizes.keys())
+        self.reset(range(last_height + 1, self.num_heights))
+        # New inputs spending old outputs update the counters of previous output heights
+        self.pubkey_sizes, self.unknowns, self.unknowns_outs = pubkey_sizes, unknowns, unknowns_outs
+        self.pubkey_sizes_outs.update(pubkey_sizes_outs)
+        return last_height
+
+    def merge(self, state):
+        (pubkey_sizes, unknowns, pubkey_sizes_outs, unknowns_outs) = state
+        self.pubkey_sizes.update(pubkey_sizes)
+        self.unknowns += unknowns
+        for h, sizes in pubkey_sizes_outs.items():
+            if h not in self.pubkey_sizes_outs:
+                self.pubkey_sizes_outs[h] = {33: 0, 65: 0}
+            for l, n in sizes.items():
+                self.pubkey_sizes_outs[h][l] += n
+        self.unknowns_outs += unknowns_outs
+
+    def begin_block(self, block):
+        self.this_block = {}
+
+    def visit_input(self, block, tx, i, txin, address_type):
+        # pubkey = txin.address.script.pubkey  # v0.4
+        pubkey = txin.address.pubkey
+        if pubkey:
+            l = len(pubkey)
+            if l in self.this_block:
+                self.this_block[l] += 1
+            else:
+                self.this_block[l] = 1
+            h = txin.spent_tx.block_height
+            if h not in self.pubkey_sizes_outs:
+                self.pubkey_sizes_outs[h] = {33: 0, 65: 0}
+            self.pubkey_sizes_outs[h][l] += 1
+        else:
+            self.unknowns += 1
+            self.unknowns_outs += 1
+
+    def end_block(self, block):
+        self.pubkey_sizes[block.height] = self.this_block
+
+    def dump(self):
+        pubkey_sizes_outs = dict([(h, self.pubkey_sizes_outs.get(h, {33: 0, 65: 0})) for h in range(self.num_heights)])
+        pickle.dump((self.pubkey_sizes, self.unknowns), open(self.pickle_file + ".pickle", "wb"))
+        pickle.dump((pubkey_sizes_outs, self.unknowns_outs), open(self.pickle_file_out + ".pickle", "wb"))
+
+
+class P2SHCollector(ChainCollector):
+    """
+    Redeem script types (and sizes, when available) of P2SH inputs, indexed by input height
+    (see blocksci_find_p2sh_inputs).
+
+    Inputs whose size can only be obtained from external APIs (P2SH_DEFERRED_TYPES) are recorded in a pending store,
+    saved next to the pickle file, and their sizes are added by blocksci_resolve_script_sizes.
+    """
+
+    input_types = (blocksci.address_type.scripthash,)
+    # Pending store loaded from a previous run (update mode)
+    previous_pending = None
+
+    def __init__(self, coin=BITCOIN):
+        super(P2SHCollector, self).__init__(coin)
+        self.pickle_file = coin_file(coin, "_p2sh")
+
+    def reset(self, heights):
+        self.p2sh = {}
+        self.others_in_p2sh = []
+        self.pending = HeightColumnsBuilder(PENDING_COLUMNS)
+
+    def state(self):
+        return self.p2sh, self.others_in_p2sh, self.pending
+
+    def merge(self, state):
+        (p2sh, others_in_p2sh, pending) = state
+        self.p2sh.update(p2sh)
+        self.others_in_p2sh.extend(others_in_p2sh)
+        self.pending.extend(pending)
+
+    def load_previous(self):
+        if not (os.path.exists(self.pickle_file + ".pickle") and os.path.exists(self.pickle_file + "_pending")):
+            return None
+        self.previous_pending = HeightColumns.load(self.pickle_file + "_pending", mmap_mode=None)
+        last_height = self.previous_pending.num_heights - 1
+        self.reset(range(last_height + 1, self.num_heights))
+        (self.p2sh, self.others_in_p2sh) = pickle.load(open(self.pickle_file + ".pickle", "rb"))
+        return last_height
+
+    def dump(self):
+        pickle.dump((self.p2sh, self.others_in_p2sh), open(self.pickle_file + ".pickle", "wb"))
+        pending = self.pending.build(self.num_heights)
+        if self.previous_pending:
+            pending = self.previous_pending.concatenate(pending)
+        pending.save(self.pickle_file + "_pending")
+
+    def begin_block(self, block):
+        self.p2sh_sizes = {"multisig": {}, 'nonstandard': {}, 'pubkey': {}, "pubkeyhash": {}, "scripthash": {},
+                           "P2WPKH": 0, "P2WSH": 0, "others": 0}
+
+    def visit_input(self, block, tx, i, txin, address_type):
+        p2sh_sizes = self.p2sh_sizes
+        script = txin.address.script
+        wrapped_type = script.wrapped_address.type
+
+        if wrapped_type == blocksci.address_type.multisig:
+            wrapped_script = script.wrapped_script
+            key, ty = (wrapped_script.required, wrapped_script.total), "multisig"
+        elif wrapped_type == blocksci.address_type.nonstandard:
+            self.pending.append(block.height, txid=txid_bytes(tx.hash), index=i,
+                                category=P2SH_DEFERRED_TYPES.index("nonstandard"))
+            return
+        elif wrapped_type == blocksci.address_type.pubkey:
+            key, ty = len(script.wrapped_script.pubkey), "pubkey"
+        elif wrapped_type == blocksci.address_type.pubkeyhash:
+            key, ty = len(script.wrapped_script.pubkey), "pubkeyhash"
+        elif wrapped_type == blocksci.address_type.scripthash:
+            self.pending.append(block.height, txid=txid_bytes(tx.hash), index=i,
+                                category=P2SH_DEFERRED_TYPES.index("scripthash"))
+            return
+        elif wrapped_type == blocksci.address_type.witness_pubkeyhash:
+            p2sh_sizes["P2WPKH"] += 1
+            return
+        elif wrapped_type == blocksci.address_type.witness_scripthash:
+            p2sh_sizes["P2WSH"] += 1
+            return
+        else:
+            p2sh_sizes["others"] += 1
+            self.others_in_p2sh.append((tx.hash, i))
+            return
+
+        if key in p2sh_sizes[ty]:
+            p2sh_sizes[ty][key] += 1
+        else:
+            p2sh_sizes[ty][key] = 1
+
+    def end_block(self, block):
+        self.p2sh[block.height] = self.p2sh_sizes
+
+
+class ScriptSizeCollector(HeightColumnsCollector):
+    """
+    Input identifiers of the inputs of a given type, indexed by input height (see blocksci_find_nonstd_inputs and
+    blocksci_find_p2wsh_inputs). Their scripts and script sizes are added by blocksci_resolve_script_sizes.
+    """
+
+    columns = {"": INPUT_COLUMNS}
+
+    def __init__(self, coin, pickle_suffix, input_type):
+        super(ScriptSizeCollector, self).__init__(coin)
+        self.pickle_file = coin_file(coin, pickle_suffix)
+        self.input_types = (input_type,)
+
+    def visit_input(self, block, tx, i, txin, address_type):
+        self.stores[""].append(block.height, txid=txid_bytes(tx.hash), index=i)
+
+
+def nonstd_inputs_collector(coin=BITCOIN):
+    return ScriptSizeCollector(coin, "_non_std_inputs", blocksci.address_type.nonstandard)
+
+
+def p2wsh_inputs_collector(coin=BITCOIN):
+    return ScriptSizeCollector(coin, "_p2wsh_inputs", blocksci.address_type.witness_scripthash)
+
+
+class NativeSegwitOutputsCollector(HeightColumnsCollector):
+    """
+    Native segwit (P2WSH and P2WPKH) outputs and their spent status, indexed by output height
+    (see blocksci_find_native_segwit_outputs).
+    """
+
+    output_types = (blocksci.address_type.witness_scripthash, blocksci.address_type.witness_pubkeyhash)
+    columns = {"p2wsh": OUTPUT_COLUMNS, "p2wpkh": OUTPUT_COLUMNS}
+
+    def __init__(self, coin=BITCOIN):
+        super(NativeSegwitOutputsCollector, self).__init__(coin)
+        self.pickle_file = coin_file(coin, "_nativesegwit_outputs")
+
+    def load_previous(self):
+        last_height = super(NativeSegwitOutputsCollector, self).load_previous()
+        if last_height is not None:
+            # New native segwit inputs may spend outputs in the previous results
+            self.input_types = self.output_types
+        return last_height
+
+    def visit_output(self, block, tx, i, txout, address_type):
+        name = "p2wsh" if address_type == blocksci.address_type.witness_scripthash else "p2wpkh"
+        self.stores[name].append(block.height, txid=txid_bytes(tx.hash), index=i, is_spent=txout.is_spent)
+
+    def visit_input(self, block, tx, i, txin, address_type):
+        # Only registered in update mode: patches the spent status of the previous outputs of the spent transaction
+        store = self.previous["p2wsh" if address_type == blocksci.address_type.witness_scripthash else "p2wpkh"]
+        spent_tx = txin.spent_tx
+        h = spent_tx.block_height
+        if h >= store.num_heights:
+            return
+        txid = np.frombuffer(txid_bytes(spent_tx.hash), dtype=np.uint8)
+        for k in range(store.offsets[h], store.offsets[h + 1]):
+            if not store["is_spent"][k] and np.array_equal(store["txid"][k], txid):
+                store["is_spent"][k] = spent_tx.outs[int(store["index"][k])].is_spent
+
+
+class NativeSegwitInputsCollector(HeightColumnsCollector):
+    """
+    Native segwit (P2WSH and P2WPKH) inputs, indexed by input height (see blocksci_find_native_segwit_inputs).
+    """
+
+    input_types = (blocksci.address_type.witness_scripthash, blocksci.address_type.witness_pubkeyhash)
+    columns = {"p2wsh": INPUT_COLUMNS, "p2wpkh": INPUT_COLUMNS}
+    # SegWit was activated in block 481824
+    start_height = SEGWIT_ACTIVATION_HEIGHT
+
+    def __init__(self, coin=BITCOIN):
+        super(NativeSegwitInputsCollector, self).__init__(coin)
+        self.pickle_file = coin_file(coin, "_nativesegwit_inputs")
+
+    def visit_input(self, block, tx, i, txin, address_type):
+        name = "p2wsh" if address_type == blocksci.address_type.witness_scripthash else "p2wpkh"
+        self.stores[name].append(block.height, txid=txid_bytes(tx.hash), index=i)
+
+
+def _dispatch_table(collectors, attr):
+    table = {}
+    for c in collectors:
+        for ty in getattr(c, attr):
+            table.setdefault(ty, []).append(c)
+    return table
+
+
+def _scan_progress(name, blocks, metrics_file=METRICS_FILE):
+    """
+    :param name: stage name
+    :param blocks: blocksci block range to be scanned
+    :param metrics_file: file where metrics are written (None disables it)
+    :return: Progress object, counting blocks and inputs
+    """
+    return Progress(name, {"blocks": len(blocks), "inputs": int(np.sum(blocks.input_count))},
+                    metrics_file=metrics_file)
+
+
+class _TimedCollector(object):
+    # Collector proxy adding the time spent in the collector's visitor methods to the "classify" stage
+    def __init__(self, collector):
+        self.collector = collector
+
+    def __getattr__(self, name):
+        return getattr(self.collector, name)
+
+    def _timed(self, method, *args):
+        start = perf_counter()
+        method(*args)
+        INSTRUMENTATION.add("classify", perf_counter() - start)
+
+    def begin_block(self, block):
+        self._timed(self.collector.begin_block, block)
+
+    def visit_input(self, block, tx, i, txin, address_type):
+        self._timed(self.collector.visit_input, block, tx, i, txin, address_type)
+
+    def visit_output(self, block, tx, i, txout, address_type):
+        self._timed(self.collector.visit_output, block, tx, i, txout, address_type)
+
+    def end_block(self, block):
+        self._timed(self.collector.end_block, block)
+
+
+def _scan_blocks(blocks, collectors, last_heights, checkpoint=True, progress=None):
+    progress = progress or _scan_progress("scan", blocks)
+    if INSTRUMENTATION.enabled:
+        # The scan stage keeps the time spent walking the chain and reading address types
+        collectors = [_TimedCollector(c) for c in collectors]
+    with INSTRUMENTATION.stage("scan"):
+        active, in_dispatch, out_dispatch = None, {}, {}
+        for block in blocks:
+            h = block.height
+            progress.update(blocks=1, inputs=block.input_count)
+            block_active = [c for c, last in zip(collectors, last_heights) if h > last and h >= c.start_height]
+            if block_active != active:
+                active = block_active
+                in_dispatch = _dispatch_table(active, "input_types")
+                out_dispatch = _dispatch_table(active, "output_types")
+            if not active:
+                continue
+
+            for c in active:
+                c.begin_block(block)
+
+            for tx in block:
+                if in_dispatch:
+                    i = 0
+                    for txin in tx.ins:
+                        address_type = txin.address_type
+                        if address_type in in_dispatch:
+                            for c in in_dispatch[address_type]:
+                                c.visit_input(block, tx, i, txin, address_type)
+                        i += 1
+                if out_dispatch:
+                    i = 0
+                    for txout in tx.outs:
+                        address_type = txout.address_type
+                        if address_type in out_dispatch:
+                            for c in out_dispatch[address_type]:
+                                c.visit_output(block, tx, i, txout, address_type)
+                        i += 1
+
+            for c in active:
+                c.end_block(block)
+                if checkpoint and c.checkpoints and h and h % SAVE_HEIGHT_INTERVAL == 0:
+                    with INSTRUMENTATION.stage("checkpoint"):
+                        c.checkpoint(h)
+
+    progress.close()
+
+
+def blocksci_scan(chain, collectors, restart_from_height=None, update=False, name="scan"):
+    """
+    Walks the chain once, feeding every registered collector. Each input (output) address type is read only once and
+    dispatched to the collectors that registered it.
+
+    Progress is saved each SAVE_HEIGHT_INTERVAL blocks as append-only checkpoint segments for the collectors that
+    support them, and an interrupted scan automatically resumes after the last complete segment. When the scan
+    finishes, segments are compacted and final results are dumped to each collector's pickle file.
+
+    A progress line (blocks and inputs per second, external API metrics, ETA) is printed each PROGRESS_INTERVAL
+    seconds, and the same metrics are written to METRICS_FILE (see progress.Progress). In instrumented runs (see
+    profiling.instrumented_run), the time is broken down in load, scan (walking the chain and reading address types),
+    classify (collectors), checkpoint and serialize stages.
+
+    With update, results of a previous run are extended to the current tip of the chain: only blocks above the last
+    height they cover are scanned (without checkpoints), and new spends of previous outputs are patched in (spent
+    status of native segwit outputs, public key counters by output height). Collectors without previous results
+    scan the whole chain.
+
+    :param chain: blocksci chain object
+    :param collectors: list of ChainCollector objects
+    :param restart_from_height: if set, only checkpoint segments ending at or before this height are reused (later
+                                ones are discarded and recomputed)
+    :param update: boolean, extend the results of a previous run instead of starting from scratch
+    :param name: name of the scan in progress lines and metrics
+    :return:
+    """
+
+    with INSTRUMENTATION.stage("load"):
+        if update:
+            last_heights = [c.start_update(chain) for c in collectors]
+        else:
+            last_heights = [c.start(chain, restart_from_height) for c in collectors]
+    first_height = min([max(c.start_height, last + 1) for c, last in zip(collectors, last_heights)])
+
+    blocks = chain[first_height:]
+    _scan_blocks(blocks, collectors, last_heights, checkpoint=not update, progress=_scan_progress(name, blocks))
+
+    with INSTRUMENTATION.stage("serialize"):
+        for c in collectors:
+            c.finish()
+
+
+def _shard_ranges(chain, num_shards):
+    """
+    Splits the chain in num_shards contiguous height ranges with a similar number of inputs and outputs (early blocks
+    are almost empty, so equally sized ranges would be badly unbalanced).
+
+    :param chain: blocksci chain object
+    :param num_shards: number of ranges
+    :return: list of (first height, last height + 1) tuples
+    """
+
+    num_inputs, num_outputs = block_counts(chain)
+    work = np.cumsum(num_inputs + num_outputs + 1)
+    total = int(work[-1]) if len(work) else 0
+
+    # Shard k ends at the first height where the work done reaches k / num_shards of the total (rounded up)
+    targets = -(-total * np.arange(1, num_shards, dtype=np.int64) // num_shards)
+    ends = np.searchsorted(work, targets).astype(np.int64) + 1
+    bounds = [0] + sorted(set(ends.tolist()) - set([0, len(work)])) + [len(work)]
+
+    return [(first, last) for first, last in zip(bounds[:-1], bounds[1:]) if first < last]
+
+
+def _scan_shard(chain_path, collector_factories, coin, first_height, last_height, instrumented=False):
+    # Returns the states of the collectors and the instrumentation report of the shard (see worker_instrumentation)
+    with worker_instrumentation(instrumented) as report:
+        chain = blocksci.Blockchain(chain_path)
+        collectors = [factory(coin) for factory in collector_factories]
+        heights = range(first_height, last_height)
+        last_heights = [c.start(chain, heights=heights, resume=False) for c in collectors]
+        blocks = chain[max(first_height, min([c.start_height for c in collectors])):last_height]
+        # Shards only print their progress, metrics files are written by the main process
+        name = "shard {} {}-{}".format(COIN_STR[coin], first_height, last_height - 1)
+        progress = _scan_progress(name, blocks, metrics_file=None)
+        _scan_blocks(blocks, collectors, last_heights, checkpoint=False, progress=progress)
+
+    return [c.state() for c in collectors], report
+
+
+def _scan_process(chain_path, collector_factories, coin, restart_from_height, update, name, instrumented=False):
+    # blocksci_scan run in a process of a pool, with its own blocksci chain. Returns the instrumentation report of the
+    # scan (see worker_instrumentation).
+    with worker_instrumentation(instrumented) as report:
+        blocksci_scan(blocksci.Blockchain(chain_path), [factory(coin) for factory in collector_factories],
+                      restart_from_height, update, name=name)
+    return report
+
+
+def blocksci_scan_parallel(chain_path, collector_factories, coin=BITCOIN, num_processes=None, shards_per_process=4,
+                           executor=None):
+    """
+    Parallel version of blocksci_scan. The chain is split in height ranges (shards) that are scanned in a process
+    pool, each worker opening its own blocksci chain. The partial results of each shard are merged in height order,
+    so final pickle files are the same ones blocksci_scan writes.
+
+    Checkpoints are not written (and restart_from_height is not available) in parallel mode: shards are short enough
+    to be recomputed.
+
+    When the run is instrumented, the stages of all the shards are added up as "shard scan", "shard classify", ...
+    (see Instrumentation.merge).
+
+    :param chain_path: path to the blocksci parsed data
+    :param collector_factories: list of callables creating a ChainCollector given a coin (must be picklable, e.g.
+                                module level functions or ChainCollector subclasses)
+    :param coin: studied coin
+    :param num_processes: size of the process pool (defaults to the number of cores)
+    :param shards_per_process: number of shards per process, more shards balance the load better
+    :param executor: process pool where shards are scanned, e.g. shared by the scans of several coins (None creates
+                     a pool of num_processes processes). When given, num_processes must be its number of processes.
+    :return:
+    """
+
+    num_processes = num_processes or os.cpu_count()
+    chain = blocksci.Blockchain(chain_path)
+    collectors = [factory(coin) for factory in collector_factories]
+    for c in collectors:
+        c.start(chain, resume=False)
+    ranges = _shard_ranges(chain, num_processes * shards_per_process)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=num_processes)
+    try:
+        partial_states = executor.map(_scan_shard, [chain_path] * len(ranges), [collector_factories] * len(ranges),
+                                      [coin] * len(ranges), [r[0] for r in ranges], [r[1] for r in ranges],
+                                      [INSTRUMENTATION.enabled] * len(ranges))
+
+        # map returns results in submission order, so merging is deterministic (the merge stage includes the time
+        # waiting for the shards)
+        with INSTRUMENTATION.stage("merge"):
+            for states, report in partial_states:
+                INSTRUMENTATION.merge(report, "shard")
+                for c, state in zip(collectors, states):
+                    c.merge(state)
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    with INSTRUMENTATION.stage("serialize"):
+        for c in collectors:
+            c.finish()
+
+
+ALL_COLLECTORS = [P2PKHPubkeyCollector, P2SHCollector, nonstd_inputs_collector, p2wsh_inputs_collector,
+                  NativeSegwitOutputsCollector, NativeSegwitInputsCollector]
+
+
+def blocksci_find_all(chain, restart_from_height=None, coin=BITCOIN, chain_path=None, num_processes=1, update=False,
+                      executor=None):
+    """
+    Runs all blocksci_find_* extractors in a single traversal of the chain. Results are stored in the same pickle
+    files written by each individual function.
+
     :param chain: blocksci chain object
-    :return: dictionary, key is block height, value is number of UTXOs
+    :param restart_from_height: if set, only checkpoint segments ending at or before this height are reused. Only
+                                available when running in a single process.
+    :param coin: studied coin
+    :param chain_path: path to the blocksci parsed data, needed when running in several processes
+    :param num_processes: number of processes (None uses all cores)
+    :param update: boolean, only scan the blocks added since the previous run, extending its results (see
+                   blocksci_scan). Updates always run in a single process.
+    :param executor: process pool shared with other scans (see blocksci_scan_parallel). Scans in a single process
+                     also run in a process of the pool (if chain_path is given), so the scans of several coins run in
+                     parallel instead of sharing the GIL.
+    :return:
     """
 
-    num_outputs, num_inputs = 0, 0
-    utxo_set_size = []
-    for block in chain:
-        num_outputs += block.output_count
-        num_inputs += block.input_count
-        utxo_set_size.append((block.height, num_outputs - num_inputs))
+    name = "scan " + COIN_STR[coin]
+    if num_processes != 1 and chain_path and not update:
+        blocksci_scan_parallel(chain_path, ALL_COLLECTORS, coin, num_processes, executor=executor)
+    elif executor is not None and chain_path:
+        INSTRUMENTATION.merge(executor.submit(_scan_process, chain_path, ALL_COLLECTORS, coin, restart_from_height,
+                                              update, name, INSTRUMENTATION.enabled).result())
+    else:
+        blocksci_scan(chain, [factory(coin) for factory in ALL_COLLECTORS], restart_from_height, update, name=name)
 
-    return utxo_set_size
 
+def _resolve_inputs(store, coin, kind, batch_size, rows=None):
+    """
+    Gets the scripts (or witnesses) of all the inputs of a store, in batches of batch_size inputs. Inputs are grouped
+    by transaction, so that each transaction is fetched once for all of its inputs. Fetched transactions are kept in
+    the persistent explorer cache (committed after each batch), so an interrupted resolution resumes without repeating
+    requests.
 
-def blocksci_find_pk_in_p2pkh(chain, restart_from_height=None, coin=BITCOIN):
+    :param store: HeightColumns object with txid and index columns
+    :param coin: studied coin
+    :param kind: "script" or "witness"
+    :param batch_size: number of inputs resolved at once
+    :param rows: list with the positions of the inputs to resolve (None resolves all the inputs)
+    :return: list with the hex scripts of the inputs of the store (None for inputs not in rows)
+    """
+
+    txids = [txid.tobytes().hex() for txid in store["txid"]]
+    indexes = store["index"].tolist()
+    rows = range(len(txids)) if rows is None else rows
+    order = sorted(rows, key=lambda k: txids[k])
+
+    scripts = [None] * len(txids)
+    label = {"script": "scripts", "witness": "witnesses"}[kind]
+    progress = Progress("resolve {} {}".format(COIN_STR[coin], label), {"inputs": len(order)})
+    for first in range(0, len(order), batch_size):
+        batch = order[first:first + batch_size]
+        with INSTRUMENTATION.stage("fetch"):
+            _, batch_scripts = fetch_input_scripts([(txids[k], indexes[k]) for k in batch], coin, kind)
+        for k, script in zip(batch, batch_scripts):
+            scripts[k] = script
+        cache = get_script_cache()
+        if cache:
+            cache.flush()
+        progress.update(inputs=len(batch))
+    progress.close()
+
+    return scripts
+
+
+def blocksci_resolve_script_sizes(coin=BITCOIN, batch_size=EXTERNAL_API_BATCH_SIZE):
+    """
+    Resolves, using external APIs (or the block files of the node, see RAW_BLOCKS_DIRS), the script sizes that can not
+    be obtained from blocksci, and joins them with the data collected by the chain scan:
+        - scripts and sizes of non-standard inputs (COIN_non_std_inputs store, see blocksci_find_nonstd_inputs)
+        - witness scripts and sizes of P2WSH inputs (COIN_p2wsh_inputs store, see blocksci_find_p2wsh_inputs)
+          For both of them, size statistics are also accumulated in the file SIZE_STATS_FILE of the store (see
+          load_size_stats), updated with the new inputs only.
+        - input script sizes of P2SH inputs with nonstandard and scripthash redeem scripts (COIN_p2sh_pending store,
+          added to the COIN_p2sh pickle file, see blocksci_find_p2sh_inputs)
+
+    The resolution can be run (and re-run, e.g. after an interruption) at any time after the scan has finished. Inputs
+    resolved by a previous run are kept, so after an update (see blocksci_scan) only the new inputs are resolved.
+
+    :param coin: studied coin
+    :param batch_size: number of inputs resolved at once
+    :return:
+    """
+
+    for pickle_suffix, kind in [("_non_std_inputs", "script"), ("_p2wsh_inputs", "witness")]:
+        pickle_file = coin_file(coin, pickle_suffix)
+        store = HeightColumns.load(pickle_file, mmap_mode=None)
+        scripts_path = os.path.join(pickle_file, SCRIPTS_DIR)
+        scripts = ScriptDictionary.load(scripts_path, mmap_mode=None) if ScriptDictionary.exists(scripts_path) \
+            else ScriptDictionary()
+        # Inputs are resolved in order, so the resolved ones are the first inputs of the store (all of them but the
+        # ones added by an update)
+        num_resolved = scripts.num_occurrences()
+        rows = list(range(num_resolved, len(store)))
+        stats = load_size_stats(pickle_file)
+        if stats is None or stats.count != num_resolved:
+            # Missing or out of sync (e.g. interrupted before saving them): rebuilt from the resolved sizes
+            stats = SizeAccumulator()
+            if num_resolved:
+                stats.add(store["size"][:num_resolved])
+
+        hex_scripts = _resolve_inputs(store, coin, kind, batch_size, rows)
+        refs = scripts.intern([bytes.fromhex(hex_scripts[k]) for k in rows])
+        script_ref = np.zeros(len(store), dtype=np.uint32)
+        if num_resolved:
+            script_ref[:num_resolved] = store["script_ref"][:num_resolved]
+        script_ref[num_resolved:] = refs
+        store.columns["script_ref"] = script_ref
+        store.columns["size"] = scripts.sizes()[script_ref].astype(np.uint32)
+        stats.add(store["size"][num_resolved:])
+        with INSTRUMENTATION.stage("serialize"):
+            scripts.save(scripts_path)
+            store.save(pickle_file, ["script_ref", "size"])
+            stats.save(os.path.join(pickle_file, SIZE_STATS_FILE))
+
+    pickle_file = coin_file(coin, "_p2sh")
+    pending = HeightColumns.load(pickle_file + "_pending", mmap_mode=None)
+    (p2sh, others_in_p2sh) = pickle.load(open(pickle_file + ".pickle", "rb"))
+
+    # Deferred types are only filled here, so heights with pending inputs and no deferred sizes are the ones not
+    # resolved yet. Their deferred types are rebuilt from scratch (resolving twice does not count twice).
+    heights = pending.heights().tolist()
+    unresolved = set([h for h in set(heights) if not any([p2sh[h][ty] for ty in P2SH_DEFERRED_TYPES])])
+    rows = [k for k, h in enumerate(heights) if h in unresolved]
+    scripts = _resolve_inputs(pending, coin, "script", batch_size, rows)
+
+    for h in unresolved:
+        for ty in P2SH_DEFERRED_TYPES:
+            p2sh[h][ty] = {}
+    for k in rows:
+        h, category, script = heights[k], int(pending["category"][k]), scripts[k]
+        l = len(script) / 2
+        p2sh_sizes = p2sh[h][P2SH_DEFERRED_TYPES[category]]
+        if l in p2sh_sizes:
+            p2sh_sizes[l] += 1
+        else:
+            p2sh_sizes[l] = 1
+    with INSTRUMENTATION.stage("serialize"):
+        pickle.dump((p2sh, others_in_p2sh), open(pickle_file + ".pickle", "wb"))
+
+
+def blocksci_find_pk_in_p2pkh(chain, restart_from_height=None, coin=BITCOIN, update=False):
     """
     Collects data about sizes of public keys revealed when spending P2PKH outputs. Two data sets are created,
     indexing the results by input height (the height where the public key is found) and output height (the
@@ -81,62 +936,23 @@ def blocksci_find_pk_in_p2pkh(chain, restart_from_height=None, coin=BITCOIN):
             440001: {33: 4393, 65: 32}
         }
 
-    Note: restart_from_height is not available in this function (checking the full blockchain is less than 1h).
+    Progress is saved each SAVE_HEIGHT_INTERVAL blocks (as checkpoint segments, see ChainCollector) and an interrupted
+    run resumes automatically.
+
+    Counts of P2PKH inputs by output height (without public key sizes) can be obtained without walking the chain from
+    the spent index built by the journal in COIN_spent_index (see spent_index.SpentIndex.inputs_by_output_height).
 
     :param chain: blocksci chain object
-    :param restart_from_height: height where the script starts running (data from previous blocks is loaded from
-                                an existing pickle file).
+    :param restart_from_height: if set, only checkpoint segments ending at or before this height are reused.
     :param coin: studied coin
+    :param update: boolean, only scan the blocks added since the previous run, extending its results
     :return:
     """
 
-    # Storing block height of the INPUT
-    pickle_file = COIN_STR[coin] + "_pk_sizes_in"
-    pubkey_sizes = {}
-    unknowns = 0
-    for block in chain:
-        this_block = {}
-        for tx in block:
-            for txin in tx.ins:
-                if txin.address_type == blocksci.address_type.pubkeyhash:
-                    # if txin.address.script.pubkey:  # v0.4
-                    if txin.address.pubkey:
-                        # l = len(txin.address.script.pubkey)  # v0.4
-                        l = len(txin.address.pubkey)
-                        if l in this_block.keys():
-                            this_block[l] += 1
-                        else:
-                            this_block[l] = 1
-                    else:
-                        unknowns += 1
-        pubkey_sizes[block.height] = this_block
-        print(block.height)
-
-    pickle.dump((pubkey_sizes, unknowns), open(pickle_file+ ".pickle", "wb"))
-
-
-    # Storing block height of the OUTPUT
-    pickle_file = COIN_STR[coin] + "_pk_sizes_out"
-    pubkey_sizes_outs = {h: {33: 0, 65: 0} for h in range(len(chain))}
-    unknowns_outs = 0
-    for block in chain:
-        for tx in block:
-            for txin in tx.ins:
-                if txin.address_type == blocksci.address_type.pubkeyhash:
-                    # if txin.address.script.pubkey:  # v0.4
-                    if txin.address.pubkey:
-                        # l = len(txin.address.script.pubkey)  # v0.4
-                        l = len(txin.address.pubkey)
-                        h = txin.spent_tx.block_height
-                        pubkey_sizes_outs[h][l] += 1
-                    else:
-                        unknowns_outs += 1
-        print(block.height)
-
-    pickle.dump((pubkey_sizes_outs, unknowns_outs), open(pickle_file + ".pickle", "wb"))
-
-
-def blocksci_find_p2sh_inputs(chain, restart_from_height=None, coin=BITCOIN):
+    blocksci_scan(chain, [P2PKHPubkeyCollector(coin)], restart_from_height, update)
+
+
+def blocksci_find_p2sh_inputs(chain, restart_from_height=None, coin=BITCOIN, update=False):
     """
     Function to find all spent P2SH scripts and to store data about its type, by input height. Data is stored in a
     pickle file.
@@ -154,347 +970,158 @@ def blocksci_find_p2sh_inputs(chain, restart_from_height=None, coin=BITCOIN):
         {'P2WPKH': 94, 'pubkeyhash': {}, 'multisig': {(1, 2): 4, (2, 3): 658, (2, 4): 40, (2, 2): 54},
             'scripthash': {}, 'others': 0, 'P2WSH': 224, 'pubkey': {}, 'nonstandard': {}}
 
-    Progress is saved each SAVE_HEIGHT_INTERVAL blocks and can be recovered using the restart_from_height parameter.
+    Sizes of "nonstandard" and "scripthash" scripts are obtained from external APIs: the scan only records those
+    inputs (in the COIN_p2sh_pending store), and blocksci_resolve_script_sizes adds them to the pickle file.
+
+    Progress is saved each SAVE_HEIGHT_INTERVAL blocks (as checkpoint segments, see ChainCollector) and an interrupted
+    run resumes automatically.
 
     :param chain: blocksci chain object
-    :param restart_from_height: height where the script starts running (data from previous blocks is loaded from
-                                an existing pickle file).
+    :param restart_from_height: if set, only checkpoint segments ending at or before this height are reused.
     :param coin: studied coin
+    :param update: boolean, only scan the blocks added since the previous run, extending its results
     :return:
     """
 
-    pickle_file = COIN_STR[coin] + "_p2sh"
+    blocksci_scan(chain, [P2SHCollector(coin)], restart_from_height, update)
 
-    if restart_from_height:
-        (p2sh, others_in_p2sh) = pickle.load(open(pickle_file+str(restart_from_height)+".pickle", "rb"))
-    else:
-        p2sh = {}
-        others_in_p2sh = []
-        restart_from_height = -1
-
-    for block in chain:
-        if block.height > restart_from_height:
-            print(block.height)
-            p2sh_sizes = {"multisig": {}, 'nonstandard': {}, 'pubkey': {}, "pubkeyhash": {}, "scripthash": {},
-                          "P2WPKH": 0, "P2WSH": 0, "others": 0}
-            for tx in block:
-                i = 0
-                for txin in tx.ins:
-                    if txin.address_type == blocksci.address_type.scripthash:
-                        if txin.address.script.wrapped_address.type == blocksci.address_type.multisig:
-                            n = txin.address.script.wrapped_script.required
-                            m = txin.address.script.wrapped_script.total
-                            if (n, m) in p2sh_sizes["multisig"].keys():
-                                p2sh_sizes["multisig"][(n, m)] += 1
-                            else:
-                                p2sh_sizes["multisig"][(n, m)] = 1
-
-                        elif txin.address.script.wrapped_address.type == blocksci.address_type.nonstandard:
-                            lens, _ = get_script_size_API([(tx.hash, i)], coin)
-                            l = lens[0]
-                            if l in p2sh_sizes["nonstandard"].keys():
-                                p2sh_sizes["nonstandard"][l] += 1
-                            else:
-                                p2sh_sizes["nonstandard"][l] = 1
-
-                        elif txin.address.script.wrapped_address.type == blocksci.address_type.pubkey:
-                            l = len(txin.address.script.wrapped_script.pubkey)
-                            if l in p2sh_sizes["pubkey"].keys():
-                                p2sh_sizes["pubkey"][l] += 1
-                            else:
-                                p2sh_sizes["pubkey"][l] = 1
-
-                        elif txin.address.script.wrapped_address.type == blocksci.address_type.pubkeyhash:
-                            l = len(txin.address.script.wrapped_script.pubkey)
-                            if l in p2sh_sizes["pubkeyhash"].keys():
-                                p2sh_sizes["pubkeyhash"][l] += 1
-                            else:
-                                p2sh_sizes["pubkeyhash"][l] = 1
-
-                        elif txin.address.script.wrapped_address.type == blocksci.address_type.scripthash:
-                            lens, _ = get_script_size_API([(tx.hash, i)], coin)
-                            l = lens[0]
-                            if l in p2sh_sizes["scripthash"].keys():
-                                p2sh_sizes["scripthash"][l] += 1
-                            else:
-                                p2sh_sizes["scripthash"][l] = 1
-
-                        elif txin.address.script.wrapped_address.type == blocksci.address_type.witness_pubkeyhash:
-                            p2sh_sizes["P2WPKH"] += 1
-
-                        elif txin.address.script.wrapped_address.type == blocksci.address_type.witness_scripthash:
-                            p2sh_sizes["P2WSH"] += 1
-
-                        else:
-                            p2sh_sizes["others"] += 1
-                            others_in_p2sh.append((tx.hash, i))
-                    i += 1
-
-            p2sh[block.height] = p2sh_sizes
-
-            if block.height % SAVE_HEIGHT_INTERVAL == 0:
-                pickle.dump((p2sh, others_in_p2sh), open(pickle_file+str(block.height)+".pickle", "wb"))
-
-    pickle.dump((p2sh, others_in_p2sh), open(pickle_file+".pickle", "wb"))
-
-
-def blocksci_find_nonstd_inputs(chain, restart_from_height=None, coin=BITCOIN):
+
+def blocksci_find_nonstd_inputs(chain, restart_from_height=None, coin=BITCOIN, update=False):
     """
     Collects data about sizes of non standard inputs, indexed by input height.
 
-    Results are stored in a pickle file: COIN_non_std_inputs.
+    Results are stored in a columnar store (see results_store.HeightColumns) in the directory COIN_non_std_inputs.
 
-    The pickle file contains three dictionaries, each one indexed by input block height:
-        nonstd_sizes_outs: stores input identifiers (transaction hash and input index) # TODO: why is it called outs?
-        nonstd_sizes_scripts: stores scripts
-        nonstd_sizes_lens: stores script sizes
+    The store is indexed by input block height and has four columns:
+        txid, index: input identifiers (transaction hash and input index)
+        script_ref: script ids, in the dictionary of distinct scripts saved in the subdirectory SCRIPTS_DIR (see
+                    results_store.ScriptDictionary, scripts are memoryviews of raw bytes)
+        size: script sizes
 
     For instance, for height 129878:
 
-    nonstd_sizes_outs[129878]:
-        [('8ebe1df6ebf008f7ec42ccd022478c9afaec3ca0444322243b745aa2e317c272', 0)]
-    nonstd_sizes_scripts[129878]:
+    store.at(129878, "txid"), store.at(129878, "index"):
+        [8ebe1df6ebf008f7ec42ccd022478c9afaec3ca0444322243b745aa2e317c272], [0]
+    [scripts[script_id].hex() for script_id in store.at(129878, "script_ref")]:
         ['49304602210095e9fe42a22dfc8e8f950bc900f34126cc9d24f666fbd587a7b062d09830983e022100b7588f0f6152a12e1d3fa449bd
         87e6d28a143f96b4d6bfd6b03e18a24e7f61cd01']
-    nonstd_sizes_lens[129878]
-        [74.0]
+    store.at(129878, "size")
+        [74]
 
-    Progress is saved each SAVE_HEIGHT_INTERVAL blocks and can be recovered using the restart_from_height parameter.
+    The legacy dictionaries (nonstd_sizes_outs, nonstd_sizes_scripts, nonstd_sizes_lens) can be obtained with
+    store.to_height_dict("txid", "index"), scripts.to_height_dict(store) and store.to_height_dict("size"), where
+    scripts = ScriptDictionary.load(os.path.join("COIN_non_std_inputs", SCRIPTS_DIR)).
+
+    The scan only stores the input identifiers: scripts and sizes are obtained from external APIs afterwards, by
+    blocksci_resolve_script_sizes.
+
+    Progress is saved each SAVE_HEIGHT_INTERVAL blocks (as checkpoint segments, see ChainCollector) and an interrupted
+    run resumes automatically.
 
     :param chain: blocksci chain object
-    :param restart_from_height: height where the script starts running (data from previous blocks is loaded from
-                                an existing pickle file).
+    :param restart_from_height: if set, only checkpoint segments ending at or before this height are reused.
     :param coin: studied coin
+    :param update: boolean, only scan the blocks added since the previous run, extending its results
     :return:
     """
 
-    pickle_file = COIN_STR[coin] + "_non_std_inputs"
-
-    if restart_from_height:
-        (nonstd_sizes_outs, nonstd_sizes_scripts, nonstd_sizes_lens) = pickle.load(
-            open(pickle_file + str(restart_from_height) + ".pickle", "rb"))
-    else:
-        # Store txhash and input index (outs), scripts (scripts) and script lengths (lens)
-        nonstd_sizes_outs = {h: [] for h in range(len(chain))}
-        nonstd_sizes_scripts = {h: [] for h in range(len(chain))}
-        nonstd_sizes_lens = {h: [] for h in range(len(chain))}
-        restart_from_height = -1
-
-    for block in chain:
-        if block.height > restart_from_height:
-            print(block.height)
-            for tx in block:
-                i = 0
-                for txin in tx.ins:
-                    if txin.address_type == blocksci.address_type.nonstandard:
-                        lens, scripts = get_script_size_API([(tx.hash, i)], coin)
-                        h = block.height
-                        nonstd_sizes_outs[h].append((str(tx.hash), i))
-                        nonstd_sizes_scripts[h].append(scripts[0])
-                        nonstd_sizes_lens[h].append(lens[0])
+    blocksci_scan(chain, [nonstd_inputs_collector(coin)], restart_from_height, update)
 
-                    i += 1
 
-            if block.height % SAVE_HEIGHT_INTERVAL == 0:
-                pickle.dump((nonstd_sizes_outs, nonstd_sizes_scripts, nonstd_sizes_lens), open(pickle_file + str(block.height) + ".pickle", "wb"))
-
-    pickle.dump((nonstd_sizes_outs, nonstd_sizes_scripts, nonstd_sizes_lens), open(pickle_file + ".pickle", "wb"))
-
-
-def blocksci_find_p2wsh_inputs(chain, restart_from_height=None, coin=BITCOIN):
+def blocksci_find_p2wsh_inputs(chain, restart_from_height=None, coin=BITCOIN, update=False):
     """
 
     Collects data about sizes of P2WSH witness scripts, indexed by input height.
 
-    Results are stored in a pickle file: COIN_p2wsh_inputs.
+    Results are stored in a columnar store (see results_store.HeightColumns) in the directory COIN_p2wsh_inputs.
 
-    The pickle file contains three dictionaries, each one indexed by input block height:
-        p2wsh_sizes_outs: stores input identifiers (transaction hash and input index) # TODO: why is it called outs?
-        p2wsh_sizes_scripts: stores scripts
-        p2wsh_sizes_lens: stores script sizes
+    The store is indexed by input block height and has four columns:
+        txid, index: input identifiers (transaction hash and input index)
+        script_ref: witness script ids, in the dictionary of distinct witness scripts saved in the subdirectory
+                    SCRIPTS_DIR (see results_store.ScriptDictionary)
+        size: witness script sizes
 
     For instance, for height 482133:
-        p2wsh_sizes_outs[482133]:
-            [('cab75da6d7fe1531c881d4efdb4826410a2604aa9e6442ab12a08363f34fb408', 0)]
+        store.at(482133, "txid"), store.at(482133, "index"):
+            [cab75da6d7fe1531c881d4efdb4826410a2604aa9e6442ab12a08363f34fb408], [0]
 
-        p2wsh_sizes_scripts[482133]
+        [scripts[script_id].hex() for script_id in store.at(482133, "script_ref")]
             ['0300483045022100a9a7b273afe54da5f087cb2d995180251f2950cb3b08cd7126f3ebe0d9323335022008c49c695f8951fbb6
             837e157b9a243dc8a6c79334af529cde6af20a1749efef0125512103534da516a0ab32f30246620fdfbfaf1921228c1e222c6bd2
             fcddbcfd9024a1b651ae']
 
-        p2wsh_sizes_lens[482133]
-            [113.0]
+        store.at(482133, "size")
+            [113]
 
+    The scan only stores the input identifiers: witness scripts and sizes are obtained from external APIs afterwards,
+    by blocksci_resolve_script_sizes.
 
-    Progress is saved each SAVE_HEIGHT_INTERVAL blocks and can be recovered using the restart_from_height parameter.
+
+    Progress is saved each SAVE_HEIGHT_INTERVAL blocks (as checkpoint segments, see ChainCollector) and an interrupted
+    run resumes automatically.
 
     :param chain: blocksci chain object
-    :param restart_from_height: height where the script starts running (data from previous blocks is loaded from
-                                an existing pickle file).
+    :param restart_from_height: if set, only checkpoint segments ending at or before this height are reused.
     :param coin: studied coin
+    :param update: boolean, only scan the blocks added since the previous run, extending its results
     :return:
     """
 
-    pickle_file = COIN_STR[coin] + "_p2wsh_inputs"
-
-    if restart_from_height:
-        (p2wsh_sizes_outs, p2wsh_sizes_scripts, p2wsh_sizes_lens) = pickle.load(
-            open(pickle_file + str(restart_from_height) + ".pickle", "rb"))
-    else:
-        # Store txhash and input index (outs), witness scripts (scripts) and witness script lengths (lens)
-        p2wsh_sizes_outs = {h: [] for h in range(len(chain))}
-        p2wsh_sizes_scripts = {h: [] for h in range(len(chain))}
-        p2wsh_sizes_lens = {h: [] for h in range(len(chain))}
-        restart_from_height = -1
-
-    # First P2WSH input is in block 482133
-    # for block in chain[482133:]:
-    for block in chain:
-        if block.height > restart_from_height:
-            print(block.height)
-            for tx in block:
-                i = 0
-                for txin in tx.ins:
-                    if txin.address_type == blocksci.address_type.witness_scripthash:
-                        lens, scripts = get_witness_size_API([(tx.hash, i)], coin)
-                        h = block.height
-                        p2wsh_sizes_outs[h].append((str(tx.hash), i))
-                        p2wsh_sizes_scripts[h].append(scripts[0])
-                        p2wsh_sizes_lens[h].append(lens[0])
-
-                    i += 1
-
-            if block.height % SAVE_HEIGHT_INTERVAL == 0:
-                pickle.dump((p2wsh_sizes_outs, p2wsh_sizes_scripts, p2wsh_sizes_lens), open(pickle_file + str(block.height) + ".pickle", "wb"))
-
-    pickle.dump((p2wsh_sizes_outs, p2wsh_sizes_scripts, p2wsh_sizes_lens), open(pickle_file + ".pickle", "wb"))
+    blocksci_scan(chain, [p2wsh_inputs_collector(coin)], restart_from_height, update)
 
 
-def blocksci_find_native_segwit_outputs(chain, restart_from_height=None, coin=BITCOIN):
+def blocksci_find_native_segwit_outputs(chain, restart_from_height=None, coin=BITCOIN, update=False):
     """
     Collects data about native segwit scripts (P2WSH and P2WPKH), indexed by output height.
 
-    Results are stored in a pickle file: COIN_nativesegwit_outputs.
+    Results are stored in two columnar stores (see results_store.HeightColumns), COIN_nativesegwit_outputs/p2wsh and
+    COIN_nativesegwit_outputs/p2wpkh, each one indexed by output block height and with three columns:
 
-    The pickle file contains four dictionaries, each one indexed by output block height:
-
-        p2wsh_outs: identifiers of native P2WSH outputs (transaction id and output index)
-        p2wsh_outs_spent: dictionary with number of spent and unspent outputs
-
-        p2wpkh_outs: identifiers of native P2WPK outputs (transaction id and output index)
-        p2wpkh_outs_spent: dictionary with number of spent and unspent outputs
+        txid, index: identifiers of native outputs (transaction id and output index)
+        is_spent: whether the output has been spent
 
     For instance, for height 482133:
-        p2wpkh_outs[482133]: [(cab75da6d7fe1531c881d4efdb4826410a2604aa9e6442ab12a08363f34fb408, 0)]
-        p2wpkh_outs_spent[482133]: {True: 1, False: 0}
+        p2wpkh.at(482133, "txid"), p2wpkh.at(482133, "index"):
+            [cab75da6d7fe1531c881d4efdb4826410a2604aa9e6442ab12a08363f34fb408], [0]
+        p2wpkh.at(482133, "is_spent"): [True]
 
-        p2wsh_outs[482133]: [(bd430d52f35166a7dd6251c73a48559ad8b5f41b6c5bc4a6c4c1a3e3702f4287, 0)]
-        p2wsh_outs_spent[482133]: {True: 1, False: 0}
+    The legacy dictionaries with the number of spent and unspent outputs per height (e.g. p2wsh_outs_spent[482133]:
+    {True: 1, False: 0}) can be obtained with analyze_data.native_segwit_spent_counts.
 
 
-    Progress is saved each SAVE_HEIGHT_INTERVAL blocks and can be recovered using the restart_from_height parameter.
+    Progress is saved each SAVE_HEIGHT_INTERVAL blocks (as checkpoint segments, see ChainCollector) and an interrupted
+    run resumes automatically.
 
     :param chain: blocksci chain object
-    :param restart_from_height: height where the script starts running (data from previous blocks is loaded from
-                                an existing pickle file).
+    :param restart_from_height: if set, only checkpoint segments ending at or before this height are reused.
     :param coin: studied coin
+    :param update: boolean, only scan the blocks added since the previous run, extending its results
     :return:
     """
 
-    pickle_file = COIN_STR[coin] + "_nativesegwit_outputs"
-
-    if restart_from_height:
-        (p2wsh_outs, p2wsh_outs_spent, p2wpkh_outs, p2wpkh_outs_spent) = pickle.load(
-            open(pickle_file + str(restart_from_height) + ".pickle", "rb"))
-    else:
-        # Store txhash and input index (outs) and how many outputs have been spent (spent)
-        p2wsh_outs = {h: [] for h in range(len(chain))}
-        p2wsh_outs_spent = {h: {True: 0, False: 0} for h in range(len(chain))}
-
-        p2wpkh_outs = {h: [] for h in range(len(chain))}
-        p2wpkh_outs_spent = {h: {True: 0, False: 0} for h in range(len(chain))}
+    blocksci_scan(chain, [NativeSegwitOutputsCollector(coin)], restart_from_height, update)
 
-        restart_from_height = -1
 
-    # First P2WSH input is in block 482133
-    #for block in chain[482133:]:
-    for block in chain:
-        if block.height > restart_from_height:
-            print(block.height)
-            for tx in block:
-                i = 0
-                for txout in tx.outs:
-                    if txout.address_type == blocksci.address_type.witness_scripthash:
-                        h = block.height
-                        p2wsh_outs[h].append((tx.hash, i))
-                        p2wsh_outs_spent[h][txout.is_spent] += 1
-                    if txout.address_type == blocksci.address_type.witness_pubkeyhash:
-                        h = block.height
-                        p2wpkh_outs[h].append((tx.hash, i))
-                        p2wpkh_outs_spent[h][txout.is_spent] += 1
-                    i += 1
-
-            if block.height % SAVE_HEIGHT_INTERVAL == 0:
-                pickle.dump((p2wsh_outs, p2wsh_outs_spent, p2wpkh_outs, p2wpkh_outs_spent),
-                            open(pickle_file + str(block.height) + ".pickle", "wb"))
-
-    pickle.dump((p2wsh_outs, p2wsh_outs_spent, p2wpkh_outs, p2wpkh_outs_spent), open(pickle_file + ".pickle", "wb"))
-
-
-def blocksci_find_native_segwit_inputs(chain, restart_from_height=None, coin=BITCOIN):
+def blocksci_find_native_segwit_inputs(chain, restart_from_height=None, coin=BITCOIN, update=False):
     """
     Collects data about native segwit scripts (P2WSH and P2WPKH), indexed by input height.
 
-    Results are stored in a pickle file: COIN_nativesegwit_inputs.
-
-    The pickle file contains two dictionaries, each one indexed by input block height:
-
-        p2wsh_ins: identifiers of native P2WSH inputs (transaction id and input index)
-        p2wpkh_ins: identifiers of native P2WPK inputs (transaction id and input index)
+    Results are stored in two columnar stores (see results_store.HeightColumns), COIN_nativesegwit_inputs/p2wsh and
+    COIN_nativesegwit_inputs/p2wpkh, each one indexed by input block height and with columns txid and index
+    (identifiers of native P2WSH/P2WPKH inputs).
 
     For instance, for height 481824:
-        p2wpkh_ins[481824]: [('f91d0a8a78462bc59398f2c5d7a84fcff491c26ba54c4833478b202796c8aafd', 0)]
+        p2wpkh.to_height_dict("txid", "index")[481824]:
+            [('f91d0a8a78462bc59398f2c5d7a84fcff491c26ba54c4833478b202796c8aafd', 0)]
 
-    Progress is saved each SAVE_HEIGHT_INTERVAL blocks and can be recovered using the restart_from_height parameter.
+    Progress is saved each SAVE_HEIGHT_INTERVAL blocks (as checkpoint segments, see ChainCollector) and an interrupted
+    run resumes automatically.
 
     :param chain: blocksci chain object
-    :param restart_from_height: height where the script starts running (data from previous blocks is loaded from
-                                an existing pickle file).
+    :param restart_from_height: if set, only checkpoint segments ending at or before this height are reused.
     :param coin: studied coin
+    :param update: boolean, only scan the blocks added since the previous run, extending its results
     :return:
     """
 
-    pickle_file = COIN_STR[coin] + "_nativesegwit_inputs"
-
-    if restart_from_height:
-        (p2wsh_ins, p2wpkh_ins) = pickle.load(
-            open(pickle_file + str(restart_from_height) + ".pickle", "rb"))
-    else:
-        # Store txhash and input index (ins)
-        p2wsh_ins = {h: [] for h in range(len(chain))}
-        p2wpkh_ins = {h: [] for h in range(len(chain))}
-        restart_from_height = -1
-
-    # SegWit was activated in block 481824
-    for block in chain[481824:]:
-    #for block in chain:
-        if block.height > restart_from_height:
-            print(block.height)
-            for tx in block:
-                i = 0
-                for txin in tx.ins:
-                    if txin.address_type == blocksci.address_type.witness_scripthash:
-                        h = block.height
-                        p2wsh_ins[h].append((str(tx.hash), i))
-                    if txin.address_type == blocksci.address_type.witness_pubkeyhash:
-                        h = block.height
-                        p2wpkh_ins[h].append((str(tx.hash), i))
-                    i += 1
-
-            if block.height % SAVE_HEIGHT_INTERVAL == 0:
-                pickle.dump((p2wsh_ins, p2wpkh_ins),
-                            open(pickle_file + str(block.height) + ".pickle", "wb"))
-
-    pickle.dump((p2wsh_ins, p2wpkh_ins), open(pickle_file + ".pickle", "wb"))
-
-
+    blocksci_scan(chain, [NativeSegwitInputsCollector(coin)], restart_from_height, update)
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
+
+from profiling import INSTRUMENTATION
+
+# Folder of the code files listed in Stage.code
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage(object):
+    """
+    Step of a Pipeline: a function (called without arguments), the stages it runs after, the files or folders it
+    writes, what its results depend on (code files and, optionally, the chain tip) and the resources it can not share
+    with other stages.
+    """
+
+    def __init__(self, name, function, after=(), outputs=(), code=(), uses_chain=False, resources=()):
+        """
+        :param name: stage name
+        :param function: callable, run without arguments
+        :param after: names of the stages whose outputs this stage reads
+        :param outputs: paths of the files (or folders) written by the stage
+        :param code: code files (relative to CODE_DIR) the results depend on, e.g. ("get_blocksci_data.py",)
+        :param uses_chain: boolean, the results depend on the chain (and change when its tip changes)
+        :param resources: names of the resources the stage uses exclusively (e.g. "chain"), stages of a pipeline
+                          sharing a resource never run at the same time
+        """
+        self.name = name
+        self.function = function
+        self.after = tuple(after)
+        self.outputs = tuple(outputs)
+        self.code = tuple(code)
+        self.uses_chain = uses_chain
+        self.resources = tuple(resources)
+
+
+class Pipeline(object):
+    """
+    DAG of stages with cached outputs. Each stage has a key combining the pipeline context (e.g. the coin), the chain
+    tip height (for stages using the chain), the contents of its code files and the keys of the stages it runs after,
+    so a change in any of them changes the keys of the stage and of every stage downstream.
+
+    A stage is fresh, and is skipped, if it completed in a previous run with the same key and its outputs still exist.
+    Keys of completed stages are saved in state_file as soon as each stage finishes, so after a crash (or a change in
+    a single analysis) a new run only executes the stages that are not fresh. Stages whose dependencies are done run
+    concurrently, in up to max_workers threads, unless they share a resource (see Stage).
+    """
+
+    def __init__(self, stages, state_file, tip_height=None, context=None, max_workers=4, name=None):
+        """
+        :param stages: list of Stage objects
+        :param state_file: JSON file with the keys of the completed stages
+        :param tip_height: height of the chain tip
+        :param context: dictionary (JSON serializable) with the parameters shared by all stages, e.g. {"coin": 0}
+        :param max_workers: maximum number of stages running at the same time
+        :param name: pipeline name, shown in the messages of its stages (e.g. the coin, when several pipelines run at
+                     the same time)
+        """
+        self.stages = dict([(stage.name, stage) for stage in stages])
+        self.order = [stage.name for stage in stages]
+        for stage in stages:
+            for dep in stage.after:
+                if dep not in self.stages:
+                    raise Exception("Stage {} runs after unknown stage {}".format(stage.name, dep))
+        self.state_file = state_file
+        self.tip_height = tip_height
+        self.context = context or {}
+        self.max_workers = max_workers
+        self.name = name
+        self.state = _load_state(state_file)
+        self.keys = {}
+        for name in self._topological_order():
+            self.keys[name] = self._key(self.stages[name])
+
+    def _topological_order(self):
+        order, visiting = [], set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise Exception("Stage {} depends on itself".format(name))
+            visiting.add(name)
+            for dep in self.stages[name].after:
+                visit(dep)
+            order.append(name)
+
+        for name in self.order:
+            visit(name)
+        return order
+
+    def _key(self, stage):
+        code = dict([(path, _file_hash(os.path.join(CODE_DIR, path))) for path in stage.code])
+        data = {"stage": stage.name, "context": self.context, "code": code,
+                "tip_height": self.tip_height if stage.uses_chain else None,
+                "after": dict([(name, self.keys[name]) for name in stage.after])}
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def is_fresh(self, name):
+        """
+        :param name: stage name
+        :return: boolean, the stage completed with its current key and its outputs exist
+        """
+        stage = self.stages[name]
+        return self.state.get(name) == self.keys[name] and all([os.path.exists(path) for path in stage.outputs])
+
+    def _with_dependencies(self, names):
+        selected = set()
+
+        def add(name):
+            if name not in selected:
+                selected.add(name)
+                for dep in self.stages[name].after:
+                    add(dep)
+
+        for name in names:
+            add(name)
+        return selected
+
+    def run(self, targets=None, force=(), executor=None):
+        """
+        Runs the stages that are not fresh (and those downstream of them), skipping the fresh ones.
+
+        :param targets: names of the stages to bring up to date, with their dependencies (None runs every stage)
+        :param force: names of stages run even if they are fresh
+        :param executor: thread pool where stages run, e.g. shared by the pipelines of several coins (None creates a
+                         pool of max_workers threads)
+        :return: dictionary, keys are stage names and values "fresh", "done", "failed" or "skipped" (not run because a
+                 dependency failed)
+        """
+
+        selected = self._with_dependencies(targets) if targets is not None else set(self.order)
+        pending = [name for name in self._topological_order() if name in selected]
+        status, running = {}, {}
+
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or running:
+                for name in list(pending):
+                    deps = self.stages[name].after
+                    if any([status.get(dep) in ["failed", "skipped"] for dep in deps]):
+                        status[name] = "skipped"
+                        pending.remove(name)
+                    elif all([status.get(dep) in ["fresh", "done"] for dep in deps if dep in selected]):
+                        # A stage is stale if any stage it runs after has been run again
+                        if name not in force and all([status.get(dep) != "done" for dep in deps]) and \
+                                self.is_fresh(name):
+                            pending.remove(name)
+                            status[name] = "fresh"
+                            print("Stage {} is up to date, skipped".format(self._label(name)))
+                        elif not self._in_use(name, running.values()):
+                            pending.remove(name)
+                            # A stage that does not finish is no longer fresh, even if it was before
+                            if self.state.pop(name, None) is not None:
+                                _save_state(self.state_file, self.state)
+                            print("Running stage {}".format(self._label(name)))
+                            running[executor.submit(self._run_stage, name)] = name
+
+                if not running:
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        seconds = future.result()
+                    except Exception:
+                        status[name] = "failed"
+                        print("Stage {} failed:\n{}".format(self._label(name), traceback.format_exc()))
+                        continue
+                    status[name] = "done"
+                    self.state[name] = self.keys[name]
+                    _save_state(self.state_file, self.state)
+                    print("Stage {} done in {:.1f}s".format(self._label(name), seconds))
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+        failed = [name for name, s in status.items() if s == "failed"]
+        if failed:
+            raise Exception("Failed stages: {}".format(", ".join([self._label(name) for name in failed])))
+        return status
+
+    def _in_use(self, name, running):
+        # Whether any of the running stages uses a resource of the stage
+        used = set([resource for other in running for resource in self.stages[other].resources])
+        return any([resource in used for resource in self.stages[name].resources])
+
+    def _label(self, name):
+        return "{}/{}".format(self.name, name) if self.name else name
+
+    def _run_stage(self, name):
+        start = perf_counter()
+        with INSTRUMENTATION.profile_thread(), INSTRUMENTATION.stage(self._label(name)):
+            self.stages[name].function()
+        return perf_counter() - start
+
+
+def _file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(path, state):
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
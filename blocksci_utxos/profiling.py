@@ -0,0 +1,353 @@
+import cProfile
+import json
+import os
+import platform
+import pstats
+import resource
+import subprocess
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter, sleep, strftime, time
+
+
+class Instrumentation(object):
+    """
+    Opt-in timing breakdown of a run by stage (e.g. scan, classify, fetch, checkpoint, serialize) and memory snapshots.
+
+    Stages can be nested: each stage records its total time, its self time (total time minus the time of the stages
+    nested in it) and its number of calls, so self times add up to the instrumented time. Disabled instrumentation
+    (the default) costs a boolean check per stage.
+
+    Records of code run in worker processes are collected by worker_instrumentation and merged in the parent process
+    (see merge).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.snapshots = []
+        self.start = perf_counter()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Profiler of the run (see instrumented_run): thread profiled from the start, profiles of the code run in
+        # other threads (see profile_thread) and sampling profiler
+        self.profiler = None
+        self.profiled_thread = None
+        self.thread_profiles = []
+        self.sampler = None
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def add(self, name, seconds, calls=1, child_seconds=0.0):
+        """
+        Adds the time of a (finished) stage, nested in the current stage.
+
+        :param name: stage name
+        :param seconds: total time of the stage
+        :param calls: number of calls
+        :param child_seconds: time of the stages nested in this one
+        """
+        with self.lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "self_seconds": 0.0, "calls": 0})
+            stage["seconds"] += seconds
+            stage["self_seconds"] += seconds - child_seconds
+            stage["calls"] += calls
+        stack = self._stack()
+        if stack:
+            stack[-1][1] += seconds
+
+    def merge(self, report, prefix=None):
+        """
+        Adds the stages and snapshots of a report of another process (see worker_instrumentation).
+
+        :param report: dictionary, as returned by report (an empty dictionary adds nothing)
+        :param prefix: None if this thread waited for the other process, whose stages are then nested in the current
+                       stage. Otherwise, prefix of the names of the merged stages and snapshot labels (e.g. "shard"):
+                       stages of processes running in parallel overlap the time of this process, so they are kept
+                       apart and their self times are not part of the instrumented time.
+        """
+        stages = report.get("stages", {})
+        with self.lock:
+            for name, stage in stages.items():
+                merged = self.stages.setdefault(name if prefix is None else prefix + " " + name,
+                                                {"seconds": 0.0, "self_seconds": 0.0, "calls": 0})
+                for key in merged:
+                    merged[key] += stage[key]
+            # Snapshot times are counted from the start of the other process
+            self.snapshots.extend([dict(snapshot, label=snapshot["label"] if prefix is None else
+                                        prefix + " " + snapshot["label"]) for snapshot in report.get("snapshots", [])])
+        stack = self._stack()
+        if prefix is None and stack:
+            stack[-1][1] += sum([stage["self_seconds"] for stage in stages.values()])
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a stage (does nothing if instrumentation is disabled).
+
+        :param name: stage name
+        """
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        # [start time, time of nested stages]
+        frame = [perf_counter(), 0.0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            self.add(name, perf_counter() - frame[0], child_seconds=frame[1])
+
+    @contextmanager
+    def profile_thread(self):
+        """
+        Context manager profiling the code run inside it in the current thread, when the run is profiled (see
+        instrumented_run) from another thread. Profilers only see the thread they are enabled in, so code run in
+        worker threads (e.g. pipeline stages) must be wrapped in it to appear in the profile.
+        """
+        # From Python 3.12 on, cProfile sees every thread
+        if not self.enabled or not self.profiler or threading.get_ident() == self.profiled_thread or \
+                (self.profiler == "cprofile" and sys.version_info >= (3, 12)):
+            yield
+            return
+        if self.profiler == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.thread_profiles.append(profile)
+        else:
+            self.sampler.add_thread(threading.get_ident())
+            try:
+                yield
+            finally:
+                self.sampler.remove_thread(threading.get_ident())
+
+    def snapshot(self, label, top=10):
+        """
+        Records the memory usage at this point of the run: peak RSS and, if tracemalloc is tracing, current and peak
+        traced memory and the top allocation sites.
+
+        :param label: snapshot label (e.g. "checkpoint btc_p2sh 100000")
+        :param top: number of allocation sites recorded
+        """
+        if not self.enabled:
+            return
+        snapshot = {"label": label, "seconds": perf_counter() - self.start, "peak_rss_mb": _peak_rss_mb()}
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            stats = tracemalloc.take_snapshot().statistics("lineno")[:top]
+            snapshot.update({"traced_mb": current / 2 ** 20, "traced_peak_mb": peak / 2 ** 20,
+                             "top_allocations": [{"site": str(stat.traceback), "mb": stat.size / 2 ** 20,
+                                                  "blocks": stat.count} for stat in stats]})
+        with self.lock:
+            self.snapshots.append(snapshot)
+
+    def report(self):
+        """
+        :return: dictionary with the instrumented time, the stages and the snapshots
+        """
+        return {"seconds": perf_counter() - self.start, "stages": self.stages, "snapshots": self.snapshots}
+
+
+# Instrumentation of the current process, enabled by instrumented_run
+INSTRUMENTATION = Instrumentation()
+
+
+@contextmanager
+def worker_instrumentation(enabled):
+    """
+    Context manager instrumenting the code run inside it in a worker process of a pool, if the run is instrumented in
+    the parent process. Records of a worker are lost when its task returns, so its report (see
+    Instrumentation.report, with a final memory snapshot) is put in the yielded dictionary, to be returned to the
+    parent and added with Instrumentation.merge.
+
+    :param enabled: boolean, INSTRUMENTATION.enabled in the parent process (workers forked from an instrumented
+                    process start with a copy of its records, which are discarded)
+    """
+    report = {}
+    INSTRUMENTATION.reset()
+    INSTRUMENTATION.enabled = enabled
+    if not enabled:
+        yield report
+        return
+    try:
+        yield report
+    finally:
+        INSTRUMENTATION.snapshot("end of worker {}".format(os.getpid()))
+        INSTRUMENTATION.enabled = False
+        report.update(INSTRUMENTATION.report())
+
+
+class StackSampler(object):
+    """
+    Sampling profiler: a background thread records the stacks of the profiled threads each interval seconds. Functions
+    are ranked by the number of samples where they are running (self) or in the stack (total), which approximates
+    their share of the run time with a much lower overhead than cProfile.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        """
+        :param interval: seconds between samples
+        :param thread_id: thread to profile (defaults to the thread creating the sampler), other threads can be added
+                          with add_thread
+        """
+        self.interval = interval
+        self.thread_ids = set([thread_id or threading.get_ident()])
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.num_samples = 0
+        self.running = False
+        self.thread = None
+
+    def add_thread(self, thread_id):
+        self.thread_ids = self.thread_ids | set([thread_id])
+
+    def remove_thread(self, thread_id):
+        self.thread_ids = self.thread_ids - set([thread_id])
+
+    def _sample(self):
+        while self.running:
+            frames = sys._current_frames()
+            for thread_id in self.thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                self.num_samples += 1
+                self.self_counts[_frame_name(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    name = _frame_name(frame)
+                    if name not in seen:
+                        seen.add(name)
+                        self.total_counts[name] += 1
+                    frame = frame.f_back
+            sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def top(self, n=40):
+        """
+        :param n: number of functions
+        :return: list of dictionaries with the n functions with more total samples, and their self and total shares
+        """
+        samples = max(self.num_samples, 1)
+        return [{"function": name, "total": total / float(samples), "self": self.self_counts[name] / float(samples)}
+                for name, total in self.total_counts.most_common(n)]
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "{}:{}({})".format(os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+
+
+def _cprofile_top(stats, n=40):
+    rows = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:n]
+    return [{"function": "{}:{}({})".format(os.path.basename(filename), line, name), "calls": nc,
+             "self_seconds": tt, "total_seconds": ct}
+            for (filename, line, name), (cc, nc, tt, ct, callers) in rows]
+
+
+def git_commit():
+    """
+    :return: short hash of the current git commit of the code (None if it is not available)
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+@contextmanager
+def instrumented_run(report_file, profiler=None, trace_memory=False):
+    """
+    Context manager instrumenting the code run inside it (see Instrumentation) and writing a single JSON report to
+    report_file when it exits, with the code version, the stage breakdown, the memory snapshots (one per checkpoint,
+    plus a final one) and, optionally, the top functions of a profiler. Reports have sorted keys, so the reports of
+    two versions can be diffed.
+
+    With report_file None, nothing is instrumented.
+
+    :param report_file: report file, may contain strftime fields (e.g. "instrumentation_%Y%m%d-%H%M%S.json")
+    :param profiler: None, "cprofile" (deterministic, also saved as report_file + ".prof" for pstats/snakeviz) or
+                     "sampling" (StackSampler). Code run in other threads is only profiled inside
+                     Instrumentation.profile_thread (as pipeline stages are).
+    :param trace_memory: boolean, trace allocations with tracemalloc (slow) to add traced memory and top allocation
+                         sites to the snapshots
+    """
+
+    if report_file is None:
+        yield INSTRUMENTATION
+        return
+
+    report_file = strftime(report_file)
+    INSTRUMENTATION.reset()
+    INSTRUMENTATION.enabled = True
+    if trace_memory:
+        tracemalloc.start()
+    profile = cProfile.Profile() if profiler == "cprofile" else None
+    sampler = StackSampler() if profiler == "sampling" else None
+    if profile:
+        profile.enable()
+    if sampler:
+        sampler.start()
+    INSTRUMENTATION.profiler = profiler
+    INSTRUMENTATION.profiled_thread = threading.get_ident()
+    INSTRUMENTATION.sampler = sampler
+    started, date = time(), strftime("%Y-%m-%dT%H:%M:%S")
+
+    try:
+        yield INSTRUMENTATION
+    finally:
+        if profile:
+            profile.disable()
+        if sampler:
+            sampler.stop()
+        INSTRUMENTATION.snapshot("end")
+        INSTRUMENTATION.enabled = False
+        INSTRUMENTATION.profiler = None
+        if trace_memory:
+            tracemalloc.stop()
+
+        report = INSTRUMENTATION.report()
+        report.update({"started": date, "commit": git_commit(),
+                       "python": platform.python_version(), "argv": sys.argv, "profiler": profiler,
+                       "wall_seconds": time() - started})
+        if profile:
+            # Profiles of the code run in other threads (see Instrumentation.profile_thread) are added up
+            stats = pstats.Stats(profile, *INSTRUMENTATION.thread_profiles)
+            stats.dump_stats(report_file + ".prof")
+            report["profile"] = _cprofile_top(stats)
+        if sampler:
+            report["profile"] = sampler.top()
+            report["profile_samples"] = sampler.num_samples
+        with open(report_file + ".tmp", "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        os.replace(report_file + ".tmp", report_file)
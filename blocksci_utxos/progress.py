@@ -0,0 +1,207 @@
+import json
+import os
+import sys
+import threading
+from collections import deque
+from time import strftime, time
+
+import numpy as np
+
+from constants import *
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters (e.g. API calls, cache hits) and latency samples (the last max_samples of each
+    kind, to compute percentiles), shared by the whole process (see METRICS).
+    """
+
+    def __init__(self, max_samples=10000):
+        """
+        :param max_samples: number of latency samples kept for each kind
+        """
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.samples = {}
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        """
+        :param name: kind of latency (e.g. "api_latency")
+        :param seconds: measured latency
+        """
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.max_samples)
+            self.samples[name].append(seconds)
+
+    def get(self, name):
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def percentiles(self, name, qs=(50, 95, 99)):
+        """
+        :param name: kind of latency
+        :param qs: percentiles
+        :return: dictionary, keys are percentiles and values latencies in seconds (empty if there are no samples)
+        """
+        with self.lock:
+            samples = list(self.samples.get(name, []))
+        if not samples:
+            return {}
+        return dict(zip(qs, np.percentile(samples, qs).tolist()))
+
+
+# Metrics of the current process, updated by external_apis (API calls, errors, latencies and cache hits/misses)
+METRICS = Metrics()
+
+
+class Progress(object):
+    """
+    Progress of a long running stage (e.g. the chain scan): counts processed units (blocks, inputs, ...), prints a
+    single progress line each interval seconds (rewritten in place on terminals, one line per interval otherwise) with
+    rates, external API metrics and ETA, and writes the same metrics to metrics_file each flush_interval seconds.
+
+    The metrics file is written as JSON lines (one object appended per flush), or as a Prometheus textfile (replaced at
+    each flush, e.g. for node_exporter's textfile collector) if its name ends with ".prom".
+    """
+
+    def __init__(self, name, totals=None, interval=PROGRESS_INTERVAL, metrics_file=METRICS_FILE,
+                 flush_interval=METRICS_FLUSH_INTERVAL, stream=None):
+        """
+        :param name: stage name
+        :param totals: dictionary, total number of each unit (e.g. {"blocks": 1000, "inputs": 250000}), used to show
+                       the completion and ETA (from inputs if known, from the first unit otherwise)
+        :param interval: seconds between progress lines (None disables them)
+        :param metrics_file: file where metrics are written (None disables it)
+        :param flush_interval: seconds between writes of metrics_file
+        :param stream: stream of the progress lines (defaults to sys.stdout)
+        """
+        self.name = name
+        self.totals = totals or {}
+        self.interval = interval
+        self.metrics_file = metrics_file
+        self.flush_interval = flush_interval
+        self.stream = stream or sys.stdout
+        self.counts = {unit: 0 for unit in self.totals}
+        self.start = time()
+        self.last_print = self.start
+        self.last_flush = self.start
+        self.api_calls_start = METRICS.get("api_calls")
+        self.eta_unit = "inputs" if "inputs" in self.totals else next(iter(self.totals), None)
+
+    def update(self, **counts):
+        """
+        :param counts: number of units processed since the last update, e.g. update(blocks=1, inputs=250)
+        """
+        for unit, n in counts.items():
+            self.counts[unit] = self.counts.get(unit, 0) + n
+        now = time()
+        if self.interval is not None and now - self.last_print >= self.interval:
+            self.last_print = now
+            self._print(now)
+        if self.metrics_file and now - self.last_flush >= self.flush_interval:
+            self.last_flush = now
+            self.flush(now)
+
+    def close(self):
+        """
+        Prints the final progress line and writes the final metrics.
+        """
+        now = time()
+        if self.interval is not None:
+            self._print(now, final=True)
+        if self.metrics_file:
+            self.flush(now)
+
+    def snapshot(self, now=None):
+        """
+        :param now: timestamp (defaults to the current time)
+        :return: dictionary with the counts, totals, rates (per second), API metrics and ETA (in seconds) of the stage
+        """
+        now = now or time()
+        elapsed = max(now - self.start, 1e-9)
+        api_calls = METRICS.get("api_calls") - self.api_calls_start
+        hits, misses = METRICS.get("cache_hits"), METRICS.get("cache_misses")
+        snapshot = {"stage": self.name, "time": now, "elapsed": elapsed, "counts": dict(self.counts),
+                    "totals": dict(self.totals),
+                    "rates": {unit: n / elapsed for unit, n in self.counts.items()},
+                    "api_calls": api_calls, "api_calls_per_sec": api_calls / elapsed,
+                    "api_errors": METRICS.get("api_errors"),
+                    "api_latency": METRICS.percentiles("api_latency"),
+                    "cache_hit_rate": hits / float(hits + misses) if hits + misses else None, "eta": None}
+        done = self.counts.get(self.eta_unit, 0)
+        if done and self.eta_unit in self.totals:
+            snapshot["eta"] = max(self.totals[self.eta_unit] - done, 0) * elapsed / done
+        return snapshot
+
+    def _print(self, now, final=False):
+        s = self.snapshot(now)
+        parts = ["{}:".format(self.name)]
+        for unit, n in s["counts"].items():
+            total = "/{}".format(s["totals"][unit]) if unit in s["totals"] else ""
+            parts.append("{}{} {} ({:.1f}/s)".format(n, total, unit, s["rates"][unit]))
+        if s["api_calls"]:
+            parts.append("api {:.1f}/s".format(s["api_calls_per_sec"]))
+            parts.extend(["p{} {:.3f}s".format(q, v) for q, v in s["api_latency"].items()])
+        if s["cache_hit_rate"] is not None:
+            parts.append("cache {:.0%}".format(s["cache_hit_rate"]))
+        parts.append("elapsed {}".format(_format_seconds(s["elapsed"])))
+        if s["eta"] is not None and not final:
+            parts.append("ETA {}".format(_format_seconds(s["eta"])))
+        line = " ".join(parts)
+
+        if self.stream.isatty():
+            self.stream.write("\r\033[K" + line + ("\n" if final else ""))
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def flush(self, now=None):
+        """
+        Writes the current metrics to metrics_file.
+        """
+        s = self.snapshot(now)
+        if self.metrics_file.endswith(".prom"):
+            tmp = self.metrics_file + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(_prometheus_text(s))
+            os.replace(tmp, self.metrics_file)
+        else:
+            with open(self.metrics_file, "a") as f:
+                f.write(json.dumps(dict(s, date=strftime("%Y-%m-%dT%H:%M:%S"))) + "\n")
+
+
+def _prometheus_text(s):
+    labels = 'stage="{}"'.format(s["stage"])
+    lines = []
+
+    def add(name, value, extra=""):
+        if value is not None:
+            lines.append("blocksci_utxos_{}{{{}{}}} {}".format(name, labels, extra, value))
+
+    for unit, n in s["counts"].items():
+        add("processed", n, ',unit="{}"'.format(unit))
+        add("rate", s["rates"][unit], ',unit="{}"'.format(unit))
+    for unit, n in s["totals"].items():
+        add("total", n, ',unit="{}"'.format(unit))
+    add("elapsed_seconds", s["elapsed"])
+    add("eta_seconds", s["eta"])
+    add("api_calls", s["api_calls"])
+    add("api_calls_per_sec", s["api_calls_per_sec"])
+    add("api_errors", s["api_errors"])
+    for q, v in s["api_latency"].items():
+        add("api_latency_seconds", v, ',quantile="{}"'.format(q / 100.0))
+    add("cache_hit_rate", s["cache_hit_rate"])
+
+    return "\n".join(lines) + "\n"
+
+
+def _format_seconds(seconds):
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return "{}h{:02d}m{:02d}s".format(h, m, s) if h else "{}m{:02d}s".format(m, s)
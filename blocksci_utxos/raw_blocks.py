@@ -0,0 +1,342 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Block files written by the node, and file with the key they are obfuscated with (Bitcoin Core 28 and later)
+BLOCK_FILE_PATTERN = re.compile(r"^blk(\d+)\.dat$")
+XOR_KEY_FILE = "xor.dat"
+
+INDEX_ARRAYS = ["keys", "files", "offsets", "sizes"]
+
+
+def _varint(data, pos):
+    n = data[pos]
+    if n < 0xfd:
+        return n, pos + 1
+    size = {0xfd: 2, 0xfe: 4, 0xff: 8}[n]
+    return int.from_bytes(data[pos + 1:pos + 1 + size], "little"), pos + 1 + size
+
+
+def _parse_tx(data, pos, scripts=False):
+    """
+    Parses a serialized transaction.
+
+    :param data: bytes-like object
+    :param pos: position of the transaction in data
+    :param scripts: boolean, also return the scriptSig and witness of each input
+    :return: tuple, end position of the transaction, txid (double SHA-256 of the serialization without witnesses, in
+             internal byte order), list with the scriptSig of each input and list with the witness items of each
+             input (empty for inputs without witness)
+    """
+
+    start = pos
+    pos += 4
+    segwit = data[pos] == 0 and data[pos + 1] != 0
+    if segwit:
+        if data[pos + 1] != 1:
+            # e.g. MWEB transactions in Litecoin
+            raise ValueError("Unknown transaction flag {}".format(data[pos + 1]))
+        pos += 2
+    body = pos
+
+    script_sigs, witnesses = [], []
+    num_inputs, pos = _varint(data, pos)
+    for _ in range(num_inputs):
+        size, pos = _varint(data, pos + 36)
+        if scripts:
+            script_sigs.append(bytes(data[pos:pos + size]))
+        pos += size + 4
+    num_outputs, pos = _varint(data, pos)
+    for _ in range(num_outputs):
+        size, pos = _varint(data, pos + 8)
+        pos += size
+    body_end = pos
+
+    if segwit:
+        for _ in range(num_inputs):
+            items = []
+            num_items, pos = _varint(data, pos)
+            for _ in range(num_items):
+                size, pos = _varint(data, pos)
+                if scripts:
+                    items.append(bytes(data[pos:pos + size]))
+                pos += size
+            witnesses.append(items)
+        serialized = bytes(data[start:start + 4]) + bytes(data[body:body_end]) + bytes(data[pos:pos + 4])
+    else:
+        witnesses = [[] for _ in script_sigs]
+        serialized = bytes(data[start:pos + 4])
+    end = pos + 4
+    if end > len(data):
+        raise IndexError("Truncated transaction")
+
+    return end, hashlib.sha256(hashlib.sha256(serialized).digest()).digest(), script_sigs, witnesses
+
+
+def _compact_size(n):
+    if n < 0xfd:
+        return bytes([n])
+    for prefix, size in [(0xfd, 2), (0xfe, 4), (0xff, 8)]:
+        if n < 2 ** (8 * size):
+            return bytes([prefix]) + n.to_bytes(size, "little")
+
+
+def serialize_witness(items):
+    """
+    :param items: list with the items (bytes) of the witness of an input
+    :return: bytes, the witness as serialized in transactions: item count followed by the items, each preceded by its
+             size (empty if there are no items)
+    """
+    if not items:
+        return b""
+    return _compact_size(len(items)) + b"".join([_compact_size(len(item)) + item for item in items])
+
+
+def witness_pushes(items):
+    """
+    :param items: list with the items (bytes) of the witness of an input
+    :return: bytes, the non-empty items, each preceded by its size (without the item count)
+    """
+    return b"".join([_compact_size(len(item)) + item for item in items if item])
+
+
+def _txid_key(txid):
+    # First 8 bytes of the txid (as shown by explorers, i.e. reversed), as an integer
+    return int.from_bytes(bytes.fromhex(txid)[:8], "big")
+
+
+def _xor_key(blocks_dir):
+    path = os.path.join(blocks_dir, XOR_KEY_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        key = f.read()
+    return key if any(key) else None
+
+
+def _deobfuscate(data, xor_key, pos=0):
+    # data XORed with the key, data being the bytes at position pos of a block file
+    if not xor_key:
+        return data
+    key = np.frombuffer(xor_key, dtype=np.uint8)
+    key = np.roll(key, -(pos % len(key)))
+    values = np.frombuffer(data, dtype=np.uint8)
+    return (values ^ np.resize(key, len(values))).tobytes()
+
+
+def _block_files(blocks_dir):
+    # Dictionary, keys are file numbers and values file names
+    return dict([(int(match.group(1)), name) for name, match in
+                 [(name, BLOCK_FILE_PATTERN.match(name)) for name in os.listdir(blocks_dir)] if match])
+
+
+def _index_block_file(path, xor_key=None):
+    """
+    :param path: block file
+    :param xor_key: key the file is obfuscated with (None if it is not)
+    :return: tuple, numpy arrays with the key (see _txid_key), offset and size of each transaction in the file, and
+             number of blocks that could not be parsed
+    """
+
+    with open(path, "rb") as f:
+        data = _deobfuscate(f.read(), xor_key)
+
+    keys, offsets, sizes = [], [], []
+    num_skipped, pos = 0, 0
+    while pos + 8 <= len(data):
+        # Each block is preceded by the network magic and its size. Files are preallocated with zeros.
+        if data[pos:pos + 4] == b"\x00\x00\x00\x00":
+            break
+        end = pos + 8 + int.from_bytes(data[pos + 4:pos + 8], "little")
+        if end > len(data):
+            break
+        tx, block_keys, block_offsets, block_sizes = pos + 8 + 80, [], [], []
+        try:
+            num_txs, tx = _varint(data, tx)
+            for _ in range(num_txs):
+                tx_end, txid, _, _ = _parse_tx(data, tx)
+                block_keys.append(int.from_bytes(txid[24:], "little"))
+                block_offsets.append(tx)
+                block_sizes.append(tx_end - tx)
+                tx = tx_end
+            keys += block_keys
+            offsets += block_offsets
+            sizes += block_sizes
+        except (ValueError, IndexError, KeyError):
+            num_skipped += 1
+        pos = end
+
+    return (np.array(keys, dtype=np.uint64), np.array(offsets, dtype=np.uint32), np.array(sizes, dtype=np.uint32),
+            num_skipped)
+
+
+def build_raw_blocks_index(blocks_dir, path, num_processes=None, executor=None):
+    """
+    Builds (or updates) the transaction index of the block files (blk*.dat) of a node: the file, offset and size of
+    every transaction, sorted by txid, so that RawBlocks reads any transaction with a single memory-mapped read. Files
+    are parsed in num_processes processes. When the index already exists, only the files added (or grown) since it was
+    built are parsed.
+
+    Transactions are indexed by the first 8 bytes of their txid (full txids are checked when they are read), so the
+    index takes 18 bytes per transaction. Blocks that can not be parsed (e.g. Litecoin blocks with MWEB transactions)
+    are skipped.
+
+    :param blocks_dir: folder with the block files (e.g. ~/.bitcoin/blocks)
+    :param path: index directory
+    :param num_processes: number of processes parsing block files (None uses all cores)
+    :param executor: process pool where block files are parsed, e.g. shared with chain scans (None creates a pool of
+                     num_processes processes)
+    :return:
+    """
+
+    files = _block_files(blocks_dir)
+    file_sizes = dict([(str(number), os.path.getsize(os.path.join(blocks_dir, name)))
+                       for number, name in files.items()])
+    xor_key = _xor_key(blocks_dir)
+
+    # Files already indexed with the same size are kept
+    arrays, indexed = dict([(name, []) for name in INDEX_ARRAYS]), {}
+    if RawBlocks.exists(path):
+        old = RawBlocks.load(path, mmap_mode=None)
+        if old.blocks_dir == os.path.abspath(blocks_dir):
+            indexed = dict([(number, size) for number, size in old.file_sizes.items()
+                            if file_sizes.get(number) == size])
+            kept = np.isin(old.files, [int(number) for number in indexed])
+            for name in INDEX_ARRAYS:
+                arrays[name].append(getattr(old, name)[kept])
+
+    parsed = sorted([number for number in files if str(number) not in indexed])
+    num_skipped = 0
+    if parsed:
+        own_executor = executor is None
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=num_processes)
+        try:
+            results = executor.map(_index_block_file, [os.path.join(blocks_dir, files[number]) for number in parsed],
+                                   [xor_key] * len(parsed))
+            for number, (keys, offsets, sizes, skipped) in zip(parsed, results):
+                arrays["keys"].append(keys)
+                arrays["files"].append(np.full(len(keys), number, dtype=np.uint16))
+                arrays["offsets"].append(offsets)
+                arrays["sizes"].append(sizes)
+                num_skipped += skipped
+                indexed[str(number)] = file_sizes[str(number)]
+        finally:
+            if own_executor:
+                executor.shutdown()
+    if num_skipped:
+        print("{} blocks of {} could not be parsed, their transactions are not indexed".format(num_skipped, blocks_dir))
+
+    dtypes = {"keys": np.uint64, "files": np.uint16, "offsets": np.uint32, "sizes": np.uint32}
+    arrays = dict([(name, np.concatenate(arrays[name]) if arrays[name] else np.zeros(0, dtype=dtypes[name]))
+                   for name in INDEX_ARRAYS])
+    order = np.argsort(arrays["keys"], kind="stable")
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in INDEX_ARRAYS:
+        with open(os.path.join(path, name + ".npy.tmp"), "wb") as f:
+            np.save(f, arrays[name][order])
+        os.replace(os.path.join(path, name + ".npy.tmp"), os.path.join(path, name + ".npy"))
+    with open(os.path.join(path, "files.json.tmp"), "w") as f:
+        json.dump({"blocks_dir": os.path.abspath(blocks_dir), "file_sizes": indexed}, f)
+    os.replace(os.path.join(path, "files.json.tmp"), os.path.join(path, "files.json"))
+
+
+class RawBlocks(object):
+    """
+    Reads the input scripts and witnesses of transactions straight from the block files of a node, using the index
+    built by build_raw_blocks_index. Block files are memory-mapped, so reads run at disk speed and are shared by all
+    threads.
+
+    Scripts are returned as hex scriptSigs and lists with the hex items of each witness. Explorers do not agree on
+    the format of witnesses, so they are formatted by external_apis.witness_script, as the witness explorer of each
+    coin does.
+    """
+
+    def __init__(self, blocks_dir, file_sizes, keys, files, offsets, sizes):
+        """
+        :param blocks_dir: folder with the block files
+        :param file_sizes: dictionary, keys are indexed file numbers (strings) and values their sizes
+        :param keys: numpy array with the sorted keys of the transactions (see _txid_key)
+        :param files: numpy array with the file number of each transaction
+        :param offsets: numpy array with the offset of each transaction in its file
+        :param sizes: numpy array with the size of each transaction
+        """
+        self.blocks_dir = blocks_dir
+        self.file_sizes = file_sizes
+        self.keys = keys
+        self.files = files
+        self.offsets = offsets
+        self.sizes = sizes
+        self.xor_key = _xor_key(blocks_dir)
+        self.block_files = _block_files(blocks_dir)
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "files.json"))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param path: index directory
+        :param mmap_mode: numpy mmap_mode (None loads the index in memory)
+        :return: RawBlocks object
+        """
+        with open(os.path.join(path, "files.json")) as f:
+            meta = json.load(f)
+        return cls(meta["blocks_dir"], meta["file_sizes"],
+                   *[np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in INDEX_ARRAYS])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _map(self, number):
+        with self.lock:
+            if number not in self.maps:
+                with open(os.path.join(self.blocks_dir, self.block_files[number]), "rb") as f:
+                    self.maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.maps[number]
+
+    def _read_tx(self, row):
+        number, offset, size = int(self.files[row]), int(self.offsets[row]), int(self.sizes[row])
+        return _deobfuscate(self._map(number)[offset:offset + size], self.xor_key, offset)
+
+    def tx_scripts(self, txids):
+        """
+        :param txids: list of transaction ids
+        :return: dictionary, keys are the txids found in the block files and values dictionaries with the hex
+                 scriptSig ("script") and the list of hex witness items ("witness") of every input of the transaction
+        """
+
+        keys = np.array([_txid_key(txid) for txid in txids], dtype=np.uint64)
+        firsts = np.searchsorted(self.keys, keys, "left")
+        lasts = np.searchsorted(self.keys, keys, "right")
+
+        # Candidates (transactions with the same key) are read in file order
+        candidates = [(int(row), txid) for txid, first, last in zip(txids, firsts, lasts) for row in range(first, last)]
+        candidates.sort(key=lambda candidate: (int(self.files[candidate[0]]), int(self.offsets[candidate[0]])))
+
+        found = {}
+        for row, txid in candidates:
+            if txid in found:
+                continue
+            _, tx_hash, script_sigs, witnesses = _parse_tx(self._read_tx(row), 0, scripts=True)
+            if tx_hash[::-1].hex() == txid:
+                found[txid] = {"script": [script.hex() for script in script_sigs],
+                               "witness": [[item.hex() for item in items] for items in witnesses]}
+        return found
+
+    def close(self):
+        with self.lock:
+            for m in self.maps.values():
+                m.close()
+            self.maps = {}
@@ -0,0 +1,229 @@
+import json
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+
+
+class ScriptCache(object):
+    """
+    Persistent (SQLite) cache of the input scripts and witnesses extracted from explorer responses, keyed by coin and
+    transaction id. Each entry stores the hex scriptSig (and/or witness) of every input of the transaction, so that
+    later requests for any input of a cached transaction never reach the network.
+
+    The cache holds at most max_txs transactions: when the limit is exceeded, least recently used transactions are
+    evicted. With warm_start, all entries are loaded in memory when the cache is opened, so lookups do not hit the
+    database.
+
+    Insertions are committed in batches (every COMMIT_INTERVAL insertions, or on flush and close), since a commit
+    syncs the database to disk. A crash only loses the last uncommitted transactions, which are fetched again.
+    """
+
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path, max_txs=None, warm_start=False):
+        """
+        :param path: SQLite database file
+        :param max_txs: maximum number of cached transactions (None for no limit)
+        :param warm_start: boolean, load the whole cache in memory
+        """
+        self.path = path
+        self.max_txs = max_txs
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS txs (coin INTEGER, txid TEXT, script TEXT, witness TEXT, "
+                        "last_used INTEGER, PRIMARY KEY (coin, txid))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS txs_last_used ON txs (last_used)")
+        self.db.commit()
+        self.clock = self.db.execute("SELECT COALESCE(MAX(last_used), 0) FROM txs").fetchone()[0]
+        self.num_txs = self.db.execute("SELECT COUNT(*) FROM txs").fetchone()[0]
+        self.touched = {}
+        self.num_pending = 0
+        self.hits, self.misses = 0, 0
+
+        self.memory = None
+        if warm_start:
+            self.memory = {}
+            for (coin, txid, script, witness) in self.db.execute("SELECT coin, txid, script, witness FROM txs"):
+                self.memory[(coin, txid)] = {"script": _loads(script), "witness": _loads(witness)}
+
+        with self.lock:
+            self._evict()
+
+    def get(self, coin, txid, kind="script"):
+        """
+        :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+        :param txid: transaction id
+        :param kind: "script" or "witness"
+        :return: list with the hex script (or witness) of every input of the transaction, None if not cached
+        """
+        key = (coin, str(txid))
+        with self.lock:
+            if self.memory is not None:
+                entry = self.memory.get(key)
+                scripts = entry[kind] if entry else None
+            else:
+                row = self.db.execute("SELECT {} FROM txs WHERE coin = ? AND txid = ?".format(kind), key).fetchone()
+                scripts = _loads(row[0]) if row else None
+
+            if scripts is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.clock += 1
+            self.touched[key] = self.clock
+            if len(self.touched) >= 1000:
+                self._flush_touched()
+            return scripts
+
+    def put(self, coin, txid, scripts_by_kind):
+        """
+        :param coin: BITCOIN, BITCOIN_CASH or LITECOIN
+        :param txid: transaction id
+        :param scripts_by_kind: dictionary, keys are "script" and/or "witness" and values lists with the hex script
+                                (or witness) of every input of the transaction
+        """
+        key = (coin, str(txid))
+        with self.lock:
+            self.clock += 1
+            row = self.db.execute("SELECT script, witness FROM txs WHERE coin = ? AND txid = ?", key).fetchone()
+            entry = {"script": _loads(row[0]), "witness": _loads(row[1])} if row else {"script": None, "witness": None}
+            entry.update(scripts_by_kind)
+            self.db.execute("INSERT OR REPLACE INTO txs VALUES (?, ?, ?, ?, ?)",
+                            key + (_dumps(entry["script"]), _dumps(entry["witness"]), self.clock))
+            self.num_pending += 1
+            if self.num_pending >= self.COMMIT_INTERVAL:
+                self._commit()
+            if not row:
+                self.num_txs += 1
+            if self.memory is not None:
+                self.memory[key] = entry
+            self._evict()
+
+    def flush(self):
+        """
+        Commits the pending insertions and last use times (e.g. after each batch of resolved inputs).
+        """
+        with self.lock:
+            self._flush_touched()
+
+    def _commit(self):
+        self.db.commit()
+        self.num_pending = 0
+
+    def _flush_touched(self):
+        self.db.executemany("UPDATE txs SET last_used = ? WHERE coin = ? AND txid = ?",
+                            [(t,) + key for key, t in self.touched.items()])
+        self._commit()
+        self.touched = {}
+
+    def _evict(self):
+        if self.max_txs is None or self.num_txs <= self.max_txs:
+            return
+        self._flush_touched()
+        # Evict 1% more than needed, so that eviction does not run on every insertion
+        num_evicted = self.num_txs - self.max_txs + self.max_txs // 100
+        evicted = self.db.execute("SELECT coin, txid FROM txs ORDER BY last_used LIMIT ?", (num_evicted,)).fetchall()
+        self.db.executemany("DELETE FROM txs WHERE coin = ? AND txid = ?", evicted)
+        self._commit()
+        self.num_txs -= len(evicted)
+        if self.memory is not None:
+            for key in evicted:
+                self.memory.pop(tuple(key), None)
+
+    def close(self):
+        with self.lock:
+            self._flush_touched()
+            self.db.close()
+
+
+class ResponseArchive(object):
+    """
+    Append-only archive of raw explorer responses, keyed by provider and transaction id, used to record the traffic of
+    a run and replay it later (see external_apis.fetch_tx).
+
+    Each record is the key and the zlib-compressed response body, preceded by their lengths, so records are written as
+    soon as responses arrive, and a run that crashes only loses the record being written. Opening an archive reads it
+    whole into memory (compressed), so replayed responses are served at memory speed. If a key is recorded several
+    times, the last record is used.
+    """
+
+    HEADER = struct.Struct("<HI")
+
+    def __init__(self, path):
+        """
+        :param path: archive file (created if it does not exist)
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+
+        end = 0
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            while end + self.HEADER.size <= len(data):
+                key_size, body_size = self.HEADER.unpack_from(data, end)
+                start = end + self.HEADER.size
+                if start + key_size + body_size > len(data):
+                    break
+                key = data[start:start + key_size].decode()
+                self.records[key] = data[start + key_size:start + key_size + body_size]
+                end = start + key_size + body_size
+        self.file = open(path, "ab")
+        # A record truncated by a crash is dropped
+        self.file.truncate(end)
+
+    @staticmethod
+    def _key(provider, txid):
+        return "{}/{}".format(provider, txid)
+
+    def __len__(self):
+        return len(self.records)
+
+    def keys(self):
+        """
+        :return: list of tuples (provider, transaction id) of the archived responses
+        """
+        with self.lock:
+            return [tuple(key.split("/", 1)) for key in self.records]
+
+    def get(self, provider, txid):
+        """
+        :param provider: provider name
+        :param txid: transaction id
+        :return: raw response body (bytes), None if not archived
+        """
+        with self.lock:
+            body = self.records.get(self._key(provider, str(txid)))
+        return zlib.decompress(body) if body is not None else None
+
+    def put(self, provider, txid, body):
+        """
+        :param provider: provider name
+        :param txid: transaction id
+        :param body: raw response body (bytes)
+        """
+        key = self._key(provider, str(txid))
+        compressed = zlib.compress(body, 9)
+        with self.lock:
+            if self.records.get(key) == compressed:
+                return
+            key_bytes = key.encode()
+            self.file.write(self.HEADER.pack(len(key_bytes), len(compressed)) + key_bytes + compressed)
+            self.file.flush()
+            self.records[key] = compressed
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def _dumps(scripts):
+    return json.dumps(scripts) if scripts is not None else None
+
+
+def _loads(scripts):
+    return json.loads(scripts) if scripts is not None else None
@@ -0,0 +1,406 @@
+import hashlib
+import os
+
+import numpy as np
+
+# Transaction hashes are stored as rows of 32 raw bytes (fixed-size byte strings would drop trailing zero bytes)
+TXID_DTYPE = np.dtype((np.uint8, 32))
+# Directory (inside the stores of inputs with resolved scripts) of the dictionary of distinct scripts (see
+# ScriptDictionary)
+SCRIPTS_DIR = "scripts"
+
+
+class HeightColumns(object):
+    """
+    Sparse columnar storage of values indexed by block height (CSR layout).
+
+    Values found at height h are stored in positions offsets[h]:offsets[h + 1] of every column, so heights with no
+    values take no space (besides their offset). Each column is a numpy array, stored on disk as an .npy file inside
+    the store directory, so that it can be memory-mapped when loaded. Columns of variable length byte strings (e.g.
+    scripts) are ScriptArena objects, stored in a subdirectory of the store directory.
+
+    For instance, a store with columns txid and index for the non-standard inputs found at heights 129878 and 129880
+    (and no other heights) has:
+        offsets[129878:129882]: [0, 1, 1, 3]
+        txid[0:3]: [[0x8e, 0xbe, ...], [0x1a, 0x02, ...], [0x1a, 0x02, ...]]
+        index[0:3]: [0, 0, 1]
+    """
+
+    def __init__(self, offsets, columns):
+        self.offsets = offsets
+        self.columns = columns
+
+    @property
+    def num_heights(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def at(self, h, name):
+        """
+        :param h: block height
+        :param name: column name
+        :return: numpy array with the values of column name found at height h
+        """
+        return self.columns[name][self.offsets[h]:self.offsets[h + 1]]
+
+    def counts(self):
+        """
+        :return: numpy array with the number of values found at each height
+        """
+        return np.diff(self.offsets)
+
+    def heights(self):
+        """
+        :return: numpy array with the height of each value
+        """
+        return np.repeat(np.arange(self.num_heights), self.counts())
+
+    def to_height_dict(self, *names):
+        """
+        Converts the store to the legacy dict-of-lists layout, e.g. {h: [(txid, index), ...]}.
+
+        :param names: column names. If more than one is given, dictionary values are lists of tuples.
+        :return: dictionary, keys are block heights and values lists of values
+        """
+        # Arena columns may only cover the first values (see concatenate), missing values are None
+        columns = [[_to_python(v) for v in self.columns[name]] + [None] * (len(self) - len(self.columns[name]))
+                   for name in names]
+        values = columns[0] if len(columns) == 1 else list(zip(*columns))
+        offsets = self.offsets.tolist()
+        return {h: values[offsets[h]:offsets[h + 1]] for h in range(self.num_heights)}
+
+    def concatenate(self, later):
+        """
+        Appends the values of a store holding later heights (e.g. built after scanning new blocks). Columns missing
+        in later are filled with None (columns of Python objects) or zeros, except ScriptArena columns, that keep
+        covering only the values of self.
+
+        :param later: HeightColumns object with no values below self.num_heights
+        :return: HeightColumns object with the values of both stores
+        """
+        assert later.num_heights >= self.num_heights and later.offsets[self.num_heights] == 0
+        offsets = later.offsets.copy()
+        offsets[:self.num_heights + 1] = self.offsets
+        offsets[self.num_heights + 1:] += self.offsets[-1]
+
+        columns = {}
+        for name, column in self.columns.items():
+            if isinstance(column, ScriptArena):
+                columns[name] = column
+            elif name in later.columns:
+                columns[name] = np.concatenate([column, later[name]])
+            else:
+                fill = np.empty if column.dtype == object else np.zeros
+                columns[name] = np.concatenate([column, fill((len(later),) + column.shape[1:], dtype=column.dtype)])
+        return HeightColumns(offsets, columns)
+
+    def save(self, path, names=None):
+        """
+        :param path: store directory
+        :param names: names of the columns to save, None saves the offsets and all the columns (columns of a store
+                      loaded from path can only be overwritten if it was loaded without memory-mapping)
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if names is None:
+            np.save(os.path.join(path, "offsets.npy"), self.offsets)
+            names = self.columns.keys()
+        for name in names:
+            column = self.columns[name]
+            if isinstance(column, ScriptArena):
+                column.save(os.path.join(path, name))
+            else:
+                np.save(os.path.join(path, name + ".npy"), column, allow_pickle=column.dtype == object)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Loads a store saved with save. Columns are memory-mapped unless mmap_mode is None (columns of Python objects
+        can not be memory-mapped and are always fully loaded).
+
+        :param path: store directory
+        :param mmap_mode: numpy mmap_mode
+        :return: HeightColumns object
+        """
+        offsets = np.load(os.path.join(path, "offsets.npy"))
+        columns = {}
+        for f in sorted(os.listdir(path)):
+            if ScriptArena.exists(os.path.join(path, f)):
+                columns[f] = ScriptArena.load(os.path.join(path, f), mmap_mode)
+                continue
+            name, ext = os.path.splitext(f)
+            if ext != ".npy" or name == "offsets":
+                continue
+            try:
+                columns[name] = np.load(os.path.join(path, f), mmap_mode=mmap_mode)
+            except ValueError:
+                columns[name] = np.load(os.path.join(path, f), allow_pickle=True)
+        return cls(offsets, columns)
+
+
+class ScriptArena(object):
+    """
+    Column of variable length byte strings (scripts, witnesses) stored as raw bytes concatenated in a single buffer:
+    value k is data[offsets[k]:offsets[k + 1]]. Values are accessed as memoryviews of the buffer (no copy), and their
+    sizes are computed from the offsets, without reading the data.
+
+    On disk, an arena is a directory with the buffer (data.bin) and the offsets (offsets.npy), both memory-mappable.
+    """
+
+    def __init__(self, data, offsets):
+        """
+        :param data: numpy uint8 array with the concatenated values
+        :param offsets: numpy uint64 array, with one more element than values
+        """
+        self.data = data
+        self.offsets = offsets
+        self.view = memoryview(data)
+
+    @classmethod
+    def from_scripts(cls, scripts):
+        """
+        :param scripts: list of bytes objects
+        :return: ScriptArena object
+        """
+        offsets = np.zeros(len(scripts) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(script) for script in scripts])
+        return cls(np.frombuffer(b"".join(scripts), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        return self.view[int(self.offsets[k]):int(self.offsets[k + 1])]
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def sizes(self):
+        """
+        :return: numpy array with the size (in bytes) of each value
+        """
+        return np.diff(self.offsets)
+
+    def extend(self, scripts):
+        """
+        :param scripts: list of bytes objects
+        :return: new ScriptArena object with the values of self followed by scripts
+        """
+        other = ScriptArena.from_scripts(scripts)
+        return ScriptArena(np.concatenate([self.data, other.data]),
+                           np.concatenate([self.offsets, self.offsets[-1] + other.offsets[1:]]))
+
+    def save(self, path):
+        """
+        :param path: arena directory (files are replaced atomically, so a memory-mapped arena can be overwritten)
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, "data.bin.tmp"), "wb") as f:
+            f.write(self.view)
+        os.replace(os.path.join(path, "data.bin.tmp"), os.path.join(path, "data.bin"))
+        with open(os.path.join(path, "offsets.npy.tmp"), "wb") as f:
+            np.save(f, self.offsets)
+        os.replace(os.path.join(path, "offsets.npy.tmp"), os.path.join(path, "offsets.npy"))
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "data.bin"))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param path: arena directory
+        :param mmap_mode: numpy mmap_mode (None loads the arena in memory)
+        :return: ScriptArena object
+        """
+        data_file = os.path.join(path, "data.bin")
+        if mmap_mode is None or os.path.getsize(data_file) == 0:
+            data = np.fromfile(data_file, dtype=np.uint8)
+        else:
+            data = np.memmap(data_file, dtype=np.uint8, mode=mmap_mode)
+        return cls(data, np.load(os.path.join(path, "offsets.npy"), mmap_mode=mmap_mode))
+
+
+class ScriptDictionary(object):
+    """
+    Content-addressed set of distinct scripts: each script is stored once (in a ScriptArena), identified by its
+    position (script id) and its SHA-256 hash, together with its number of occurrences. Stores reference scripts by
+    id (e.g. a script_ref column), so repeated scripts take no space and statistics about distinct scripts are exact
+    and cheap.
+
+    On disk, a dictionary is a directory with the arena of scripts (arena), their hashes (hashes.npy) and their
+    occurrence counts (counts.npy).
+    """
+
+    def __init__(self, arena=None, hashes=None, counts=None):
+        self.arena = arena if arena is not None else ScriptArena.from_scripts([])
+        self.hashes = hashes if hashes is not None else np.zeros((0, 32), dtype=np.uint8)
+        self.counts = counts if counts is not None else np.zeros(0, dtype=np.uint64)
+        self.index = None
+
+    def __len__(self):
+        return len(self.arena)
+
+    def __getitem__(self, script_id):
+        return self.arena[script_id]
+
+    def sizes(self):
+        """
+        :return: numpy array with the size (in bytes) of each distinct script
+        """
+        return self.arena.sizes()
+
+    def num_occurrences(self):
+        return int(self.counts.sum())
+
+    def lookup(self, script_hash):
+        """
+        :param script_hash: SHA-256 digest (32 bytes)
+        :return: script id, None if the script is not in the dictionary
+        """
+        if self.index is None:
+            self.index = {bytes(h): script_id for script_id, h in enumerate(self.hashes)}
+        return self.index.get(bytes(script_hash))
+
+    def intern(self, scripts):
+        """
+        Adds occurrences of scripts, storing the scripts not found in the dictionary.
+
+        :param scripts: list of bytes objects
+        :return: numpy uint32 array with the script id of each script
+        """
+        refs = np.zeros(len(scripts), dtype=np.uint32)
+        new_scripts, new_hashes = [], []
+        for k, script in enumerate(scripts):
+            script_hash = hashlib.sha256(script).digest()
+            script_id = self.lookup(script_hash)
+            if script_id is None:
+                script_id = len(self) + len(new_scripts)
+                self.index[script_hash] = script_id
+                new_scripts.append(script)
+                new_hashes.append(script_hash)
+            refs[k] = script_id
+
+        self.arena = self.arena.extend(new_scripts)
+        self.hashes = np.concatenate([self.hashes, _to_array(new_hashes, TXID_DTYPE)])
+        self.counts = np.concatenate([self.counts, np.zeros(len(new_scripts), dtype=np.uint64)])
+        self.counts += np.bincount(refs, minlength=len(self)).astype(np.uint64)
+        return refs
+
+    def save(self, path):
+        """
+        :param path: dictionary directory
+        """
+        self.arena.save(os.path.join(path, "arena"))
+        np.save(os.path.join(path, "hashes.npy"), self.hashes)
+        np.save(os.path.join(path, "counts.npy"), self.counts)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "counts.npy"))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param path: dictionary directory
+        :param mmap_mode: numpy mmap_mode (None loads the dictionary in memory)
+        :return: ScriptDictionary object
+        """
+        return cls(ScriptArena.load(os.path.join(path, "arena"), mmap_mode),
+                   np.load(os.path.join(path, "hashes.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, "counts.npy"), mmap_mode=mmap_mode))
+
+    def to_height_dict(self, store, name="script_ref"):
+        """
+        :param store: HeightColumns object with a column of script ids
+        :param name: name of the column of script ids
+        :return: dictionary, keys are block heights and values lists of hex scripts (legacy dict-of-lists layout)
+        """
+        return {h: [self[int(script_id)].hex() for script_id in refs]
+                for h, refs in store.to_height_dict(name).items()}
+
+
+class HeightColumnsBuilder(object):
+    """
+    Accumulates values in height order and builds a HeightColumns store.
+    """
+
+    def __init__(self, dtypes):
+        """
+        :param dtypes: dictionary, keys are column names and values numpy dtypes
+        """
+        self.dtypes = dtypes
+        self.heights = []
+        self.values = {name: [] for name in dtypes}
+
+    def __len__(self):
+        return len(self.heights)
+
+    def append(self, h, **values):
+        self.heights.append(h)
+        for name, v in values.items():
+            self.values[name].append(v)
+
+    def extend(self, other):
+        """
+        Appends the values of a builder holding later heights.
+        """
+        assert not self.heights or not other.heights or self.heights[-1] <= other.heights[0]
+        self.heights.extend(other.heights)
+        for name in self.dtypes:
+            self.values[name].extend(other.values[name])
+
+    def build(self, num_heights):
+        heights = np.array(self.heights, dtype=np.int64)
+        offsets = np.zeros(num_heights + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(heights, minlength=num_heights))
+        columns = {name: _to_array(self.values[name], dtype) for name, dtype in self.dtypes.items()}
+        return HeightColumns(offsets, columns)
+
+    @classmethod
+    def from_store(cls, store, dtypes):
+        builder = cls(dtypes)
+        builder.heights = store.heights().tolist()
+        for name, dtype in dtypes.items():
+            if np.dtype(dtype) == TXID_DTYPE:
+                builder.values[name] = [bytes(v) for v in store[name]]
+            else:
+                builder.values[name] = list(store[name])
+        return builder
+
+
+def _to_array(values, dtype):
+    if np.dtype(dtype) == TXID_DTYPE:
+        return np.frombuffer(b"".join(values), dtype=np.uint8).reshape(-1, 32)
+    if np.dtype(dtype) == object:
+        a = np.empty(len(values), dtype=object)
+        a[:] = values
+        return a
+    return np.array(values, dtype=dtype)
+
+
+def _to_python(v):
+    if isinstance(v, memoryview):
+        return v.hex()
+    if isinstance(v, np.ndarray):
+        return v.tobytes().hex()
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def txid_bytes(txid):
+    """
+    :param txid: transaction hash (blocksci hash or hex string)
+    :return: 32 raw bytes, as stored in TXID_DTYPE columns
+    """
+    return bytes.fromhex(str(txid))
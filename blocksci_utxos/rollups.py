@@ -0,0 +1,179 @@
+import os
+import pickle
+
+import numpy as np
+
+from constants import *
+from results_store import *
+from accumulators import *
+from analyze_data import *
+
+# Blocks per point of the rollups by resolution, and rolling windows (blocks) with the blocks between their points
+ROLLUP_RESOLUTIONS = [1, 10, 100, 1000, 2000]
+ROLLUP_WINDOWS = {50: 10, 100: 10, 1000: 100, 2000: 100}
+
+
+def _store_metric(path, name="size"):
+    # Count of values at each height of a store, and sum of its column name (nan if the column is missing)
+    store = HeightColumns.load(path)
+    counts = store.counts().astype(np.float64)
+    if name in store.columns:
+        sums = np.bincount(store.heights(), weights=store[name][:len(store)], minlength=store.num_heights)
+    else:
+        sums = np.full(store.num_heights, np.nan)
+    return counts, sums
+
+
+def rollup_metrics(coin=BITCOIN):
+    """
+    Per-height series of every extracted metric of a coin, as a count and a sum at each height (so that they can be
+    aggregated over any number of blocks): the mean of a metric is sum / count (e.g. average size), and its number
+    of occurrences per block is count / blocks (e.g. inputs per block).
+
+        p2pkh_pubkey_size_in, p2pkh_pubkey_size_out: public key sizes of P2PKH inputs, by input and output height
+        p2sh_script_size: P2SH input script sizes, and p2sh_TYPE the ones of each redeem script type of P2SH_TYPES
+        nonstd_script_size, p2wsh_witness_size: non-standard input script and P2WSH witness sizes (sums are nan if
+                                                 sizes have not been resolved)
+        native_p2wpkh_outputs, native_p2wsh_outputs: native segwit outputs by output height (mean: fraction spent)
+        native_p2wpkh_inputs, native_p2wsh_inputs: native segwit inputs by input height
+
+    Metrics whose extraction results are not found are omitted.
+
+    :param coin: studied coin
+    :return: dictionary, keys are metric names and values tuples of numpy arrays (count and sum at each height)
+    """
+
+    metrics = {}
+
+    for name, suffix in [("p2pkh_pubkey_size_in", "_pk_sizes_in"), ("p2pkh_pubkey_size_out", "_pk_sizes_out")]:
+        if os.path.exists(coin_file(coin, suffix) + ".pickle"):
+            (pubkey_sizes, unknowns) = pickle.load(open(coin_file(coin, suffix) + ".pickle", "rb"))
+            metrics[name] = p2pkh_range_index(pubkey_sizes).height_totals()
+
+    if os.path.exists(coin_file(coin, "_p2sh") + ".pickle"):
+        (p2sh, others_in_p2sh) = pickle.load(open(coin_file(coin, "_p2sh") + ".pickle", "rb"))
+        index = p2sh_range_index(p2sh)
+        metrics["p2sh_script_size"] = index.height_totals()
+        for ty in P2SH_TYPES:
+            if ty != "others":
+                metrics["p2sh_" + ty.lower()] = index.height_totals([ty])
+
+    for name, suffix in [("nonstd_script_size", "_non_std_inputs"), ("p2wsh_witness_size", "_p2wsh_inputs")]:
+        if os.path.isdir(coin_file(coin, suffix)):
+            metrics[name] = _store_metric(coin_file(coin, suffix))
+
+    for kind, column in [("outputs", "is_spent"), ("inputs", None)]:
+        for ty in ["p2wpkh", "p2wsh"]:
+            path = os.path.join(coin_file(coin, "_nativesegwit_" + kind), ty)
+            if os.path.isdir(path):
+                counts, sums = _store_metric(path, column)
+                metrics["native_{}_{}".format(ty, kind)] = (counts, sums if column else counts)
+
+    return metrics
+
+
+def _rollup(values, resolution):
+    # Sum of values in consecutive bins of resolution heights
+    return np.add.reduceat(values, np.arange(0, len(values), resolution)) if len(values) else values
+
+
+def _rolling(values, window, step):
+    # Sum of values in the window of heights ending at each step heights
+    prefix = np.concatenate([[0.0], np.cumsum(values)])
+    ends = np.arange(window, len(values) + 1, step)
+    return prefix[ends] - prefix[ends - window]
+
+
+def build_rollups(coin=BITCOIN):
+    """
+    Pre-aggregates every metric of rollup_metrics at the resolutions of ROLLUP_RESOLUTIONS (bins of consecutive
+    blocks) and in the rolling windows of ROLLUP_WINDOWS, and saves all of them in a single compressed file,
+    COIN_rollups.npz. Plots read the series they show with Rollups (a few kilobytes for coarse resolutions), instead
+    of rebuilding them from the extraction results.
+
+    :param coin: studied coin
+    :return:
+    """
+
+    metrics = rollup_metrics(coin)
+    num_heights = max([len(counts) for counts, sums in metrics.values()] or [0])
+
+    arrays = {"num_heights": np.array(num_heights)}
+    for name, (counts, sums) in metrics.items():
+        # Series of different lengths (e.g. input and output heights) are aligned to the same heights
+        counts = np.concatenate([counts, np.zeros(num_heights - len(counts))])
+        sums = np.concatenate([sums, np.zeros(num_heights - len(sums))])
+        for resolution in ROLLUP_RESOLUTIONS:
+            arrays["{}.r{}.count".format(name, resolution)] = _rollup(counts, resolution)
+            arrays["{}.r{}.sum".format(name, resolution)] = _rollup(sums, resolution)
+        for window, step in ROLLUP_WINDOWS.items():
+            arrays["{}.w{}.count".format(name, window)] = _rolling(counts, window, step)
+            arrays["{}.w{}.sum".format(name, window)] = _rolling(sums, window, step)
+
+    path = coin_file(coin, "_rollups.npz")
+    with open(path + ".tmp", "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+class Rollups(object):
+    """
+    Rollups of a coin saved by build_rollups. The file is read lazily: each series only reads its own arrays.
+
+    For instance, the 2000 block moving average of the number of P2WSH nested in P2SH inputs per block, and the
+    average P2SH input script size every 1000 blocks:
+        rollups = Rollups.load(BITCOIN)
+        heights, values = rollups.series("p2sh_p2wsh", window=2000, stat="per_block")
+        heights, values = rollups.series("p2sh_script_size", resolution=1000)
+    """
+
+    def __init__(self, data):
+        """
+        :param data: dictionary-like object with the arrays saved by build_rollups (e.g. a numpy NpzFile)
+        """
+        self.data = data
+        self.num_heights = int(data["num_heights"])
+
+    @classmethod
+    def load(cls, coin=BITCOIN):
+        """
+        :param coin: studied coin
+        :return: Rollups object
+        """
+        return cls(np.load(coin_file(coin, "_rollups.npz")))
+
+    def metrics(self):
+        """
+        :return: sorted list with the names of the metrics (see rollup_metrics)
+        """
+        return sorted(set([key.split(".")[0] for key in self.data.keys() if "." in key]))
+
+    def series(self, metric, resolution=1000, window=None, stat="mean"):
+        """
+        :param metric: metric name (see rollup_metrics)
+        :param resolution: blocks per point, one of ROLLUP_RESOLUTIONS
+        :param window: rolling window, one of ROLLUP_WINDOWS (if set, resolution is ignored)
+        :param stat: "mean" (sum / count, e.g. average size), "per_block" (count / blocks, e.g. inputs per block),
+                     "count" or "sum"
+        :return: tuple of numpy arrays, heights (first height of each bin, or last height of each window) and values
+        """
+
+        if window:
+            key, step = "w{}".format(window), ROLLUP_WINDOWS[window]
+            heights = np.arange(window, self.num_heights + 1, step) - 1
+            blocks = np.full(len(heights), window)
+        else:
+            key = "r{}".format(resolution)
+            heights = np.arange(0, self.num_heights, resolution)
+            blocks = np.minimum(heights + resolution, self.num_heights) - heights
+
+        counts = self.data["{}.{}.count".format(metric, key)]
+        if stat == "count":
+            return heights, counts
+        if stat == "per_block":
+            return heights, counts / blocks
+        sums = self.data["{}.{}.sum".format(metric, key)]
+        if stat == "sum":
+            return heights, sums
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return heights, sums / counts
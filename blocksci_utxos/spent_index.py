@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from type_counts import ADDRESS_TYPES, address_type_codes, block_counts, block_ranges
+
+# Spending height of unspent outputs
+UNSPENT = np.iinfo(np.uint32).max
+
+
+class SpentIndex(object):
+    """
+    Flat index linking inputs and outputs by height, built once per chain (see build_spent_index) and memory-mapped
+    when loaded, so that analyses by output (or spending) height can aggregate arrays with np.bincount instead of
+    following blocksci objects (txin.spent_tx.block_height, txout.spending_tx, ...).
+
+    Inputs and outputs are numbered in chain order. The inputs found at height h are input_offsets[h]:input_offsets[h +
+    1] (and the same for outputs), and for each of them the index stores:
+        spent_height: height of the output spent by each input
+        input_type: address type code of each input
+        spending_height: height where each output is spent (UNSPENT if it is not spent)
+        output_type: address type code of each output
+    """
+
+    names = ["input_offsets", "output_offsets", "spent_height", "input_type", "spending_height", "output_type"]
+
+    def __init__(self, input_offsets, output_offsets, spent_height, input_type, spending_height, output_type):
+        self.input_offsets = input_offsets
+        self.output_offsets = output_offsets
+        self.spent_height = spent_height
+        self.input_type = input_type
+        self.spending_height = spending_height
+        self.output_type = output_type
+
+    @property
+    def num_heights(self):
+        return len(self.input_offsets) - 1
+
+    def input_heights(self):
+        """
+        :return: numpy array with the height of each input
+        """
+        return np.repeat(np.arange(self.num_heights, dtype=np.uint32), np.diff(self.input_offsets))
+
+    def output_heights(self):
+        """
+        :return: numpy array with the height of each output
+        """
+        return np.repeat(np.arange(self.num_heights, dtype=np.uint32), np.diff(self.output_offsets))
+
+    def ages(self):
+        """
+        :return: numpy array with the age (in blocks) of the output spent by each input, i.e. txin.age
+        """
+        return self.input_heights() - self.spent_height
+
+    def inputs_by_output_height(self, address_type=None):
+        """
+        :param address_type: only count inputs of this address type (None counts all inputs)
+        :return: numpy array with the number of inputs spending outputs created at each height
+        """
+        spent_height = self.spent_height
+        if address_type is not None:
+            spent_height = spent_height[self.input_type == int(address_type)]
+        return np.bincount(spent_height, minlength=self.num_heights)
+
+    def outputs_by_spending_height(self, address_type=None):
+        """
+        :param address_type: only count outputs of this address type (None counts all outputs)
+        :return: numpy array with the number of outputs spent at each height
+        """
+        spending_height = self.spending_height
+        if address_type is not None:
+            spending_height = spending_height[self.output_type == int(address_type)]
+        return np.bincount(spending_height[spending_height != UNSPENT], minlength=self.num_heights)
+
+    def spent_outputs_by_height(self, address_type=None):
+        """
+        :param address_type: only count outputs of this address type (None counts all outputs)
+        :return: tuple, numpy arrays with the number of spent and unspent outputs created at each height
+        """
+        output_heights, is_spent = self.output_heights(), self.spending_height != UNSPENT
+        if address_type is not None:
+            mask = self.output_type == int(address_type)
+            output_heights, is_spent = output_heights[mask], is_spent[mask]
+        spent = np.bincount(output_heights[is_spent], minlength=self.num_heights)
+        unspent = np.bincount(output_heights[~is_spent], minlength=self.num_heights)
+        return spent, unspent
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param path: index directory, written by build_spent_index
+        :param mmap_mode: numpy mmap_mode
+        :return: SpentIndex object
+        """
+        return cls(*[np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in cls.names])
+
+
+def build_spent_index(chain, path, chunk_size=1000):
+    """
+    Builds the spent index of a chain (see SpentIndex) and saves it in directory path. Arrays are written to
+    memory-mapped .npy files while reading blocksci block ranges (chunk_size blocks at a time), so the index does not
+    need to fit in memory.
+
+    The spent height of an input is its height minus its age. The spending height of an output is the height of the
+    block containing its spending transaction, found from the transaction index by binary search on the number of
+    transactions per block.
+
+    :param chain: blocksci chain object
+    :param path: index directory
+    :param chunk_size: number of blocks read at once
+    :return: SpentIndex object (memory-mapped)
+    """
+
+    assert len(ADDRESS_TYPES) <= np.iinfo(np.uint8).max
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    num_inputs, num_outputs = block_counts(chain, chunk_size)
+    input_offsets = np.concatenate([[0], np.cumsum(num_inputs)])
+    output_offsets = np.concatenate([[0], np.cumsum(num_outputs)])
+    tx_counts = [np.asarray(blocks.tx_count, dtype=np.int64) for _, blocks in block_ranges(chain, chunk_size)]
+    tx_offsets = np.concatenate([[0], np.cumsum(np.concatenate(tx_counts))])
+    np.save(os.path.join(path, "input_offsets.npy"), input_offsets)
+    np.save(os.path.join(path, "output_offsets.npy"), output_offsets)
+
+    arrays = {}
+    for name, length, dtype in [("spent_height", input_offsets[-1], np.uint32),
+                                ("input_type", input_offsets[-1], np.uint8),
+                                ("spending_height", output_offsets[-1], np.uint32),
+                                ("output_type", output_offsets[-1], np.uint8)]:
+        arrays[name] = open_memmap(os.path.join(path, name + ".npy"), mode="w+", dtype=dtype, shape=(int(length),))
+
+    for first, blocks in block_ranges(chain, chunk_size):
+        last = first + len(blocks)
+        inputs = slice(input_offsets[first], input_offsets[last])
+        outputs = slice(output_offsets[first], output_offsets[last])
+
+        input_heights = np.repeat(np.arange(first, last), num_inputs[first:last])
+        arrays["spent_height"][inputs] = input_heights - np.asarray(blocks.inputs.age, dtype=np.int64)
+        arrays["input_type"][inputs] = address_type_codes(blocks.inputs.address_type)
+
+        is_spent = np.asarray(blocks.outputs.is_spent, dtype=bool)
+        spending_tx = np.asarray(blocks.outputs.spending_tx_index, dtype=np.int64)
+        spending_height = np.full(len(is_spent), UNSPENT, dtype=np.uint32)
+        spending_height[is_spent] = np.searchsorted(tx_offsets, spending_tx[is_spent], side="right") - 1
+        arrays["spending_height"][outputs] = spending_height
+        arrays["output_type"][outputs] = address_type_codes(blocks.outputs.address_type)
+
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    return SpentIndex.load(path)
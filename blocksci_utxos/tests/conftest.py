@@ -0,0 +1,65 @@
+"""
+Tests run from any folder: modules of blocksci_utxos are imported as top-level modules (as when running the journal from
+its folder), with the synthetic chain of the benchmarks registered as blocksci (see synthetic_chain.install).
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import synthetic_chain
+
+synthetic_chain.install()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Runs the test in an empty folder, where results files (and the metrics file) are written.
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(scope="session")
+def chain():
+    return synthetic_chain.Blockchain(num_blocks=200, segwit_height=80, seed=1)
+
+
+@pytest.fixture
+def scan(chain, workdir, monkeypatch):
+    """
+    Runs get_blocksci_data.blocksci_find_all on the synthetic chain, in a folder of the test folder (keyword arguments
+    are passed to blocksci_find_all).
+    """
+    import get_blocksci_data
+    monkeypatch.setattr(get_blocksci_data.NativeSegwitInputsCollector, "start_height", chain.segwit_height)
+    # Processes scanning shards read the same chain
+    monkeypatch.setattr(synthetic_chain, "Blockchain", lambda path=None: chain)
+
+    def run(folder=".", **kwargs):
+        os.makedirs(workdir / folder, exist_ok=True)
+        monkeypatch.chdir(workdir / folder)
+        get_blocksci_data.blocksci_find_all(chain, **kwargs)
+
+    return run
+
+
+@pytest.fixture
+def offline_apis(workdir, monkeypatch):
+    """
+    Isolates the module state of external_apis (sessions, rate limiters, explorer cache, response archive and block
+    files) for the test. The explorer cache is disabled, and requests fail at once until a stub is installed (e.g.
+    explorer_stub.ExplorerStub.install).
+
+    :return: external_apis module
+    """
+    import external_apis
+    for name, value in [("_sessions", {}), ("_rate_limiters", {}), ("_script_cache", None), ("_response_archive", None),
+                        ("_raw_blocks", {}), ("PROVIDER_URLS", {}), ("EXTERNAL_API_CACHE_FILE", None),
+                        ("EXTERNAL_API_ARCHIVE_MODE", None), ("EXTERNAL_API_MAX_RETRIES", 0),
+                        ("EXTERNAL_API_RATE_LIMITS", dict(external_apis.EXTERNAL_API_RATE_LIMITS))]:
+        monkeypatch.setattr(external_apis, name, value)
+    return external_apis
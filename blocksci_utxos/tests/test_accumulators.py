@@ -0,0 +1,170 @@
+import numpy as np
+import pytest
+
+from accumulators import *
+
+
+def _sizes(n, seed=0):
+    rnd = np.random.RandomState(seed)
+    # Sizes beyond the last bucket (8 * 128) are included
+    return np.concatenate([rnd.randint(0, 400, n), rnd.randint(1000, 3000, n // 50)])
+
+
+def _accumulator(sizes):
+    acc = SizeAccumulator()
+    acc.add(sizes)
+    return acc
+
+
+def test_size_accumulator_statistics():
+    sizes = _sizes(5000)
+    acc = _accumulator(sizes)
+
+    assert acc.count == len(sizes)
+    assert acc.sum == sizes.sum()
+    assert (acc.min, acc.max) == (sizes.min(), sizes.max())
+    assert acc.mean() == pytest.approx(sizes.mean())
+    assert acc.std() == pytest.approx(sizes.std())
+    assert acc.std(ddof=1) == pytest.approx(sizes.std(ddof=1))
+    assert acc.histogram.sum() == len(sizes)
+    assert acc.histogram[-1] == np.count_nonzero(sizes >= acc.bucket_width * (acc.num_buckets - 1))
+
+
+def test_size_accumulator_quantile():
+    sizes = _sizes(5000)
+    acc = _accumulator(sizes)
+    for q in [0.01, 0.25, 0.5, 0.9, 0.95]:
+        # Upper limit of the bucket holding the exact quantile
+        exact = np.quantile(sizes, q)
+        assert exact <= acc.quantile(q) <= exact + acc.bucket_width
+    # Quantiles beyond the last bucket limit are bounded by the maximum
+    assert acc.quantile(0.999) == acc.quantile(1.0) == sizes.max()
+
+
+def test_size_accumulator_merge():
+    sizes = _sizes(5000)
+    merged = SizeAccumulator()
+    for part in np.array_split(sizes, 7):
+        merged.merge(_accumulator(part))
+    merged.merge(SizeAccumulator())
+
+    whole = _accumulator(sizes)
+    assert (merged.count, merged.min, merged.max) == (whole.count, whole.min, whole.max)
+    assert merged.sum == pytest.approx(whole.sum) and merged.sumsq == pytest.approx(whole.sumsq)
+    assert np.array_equal(merged.histogram, whole.histogram)
+
+    with pytest.raises(AssertionError):
+        merged.merge(SizeAccumulator(bucket_width=4))
+
+
+def test_size_accumulator_empty():
+    acc = SizeAccumulator()
+    acc.add([])
+    assert acc.count == 0
+    assert np.isnan(acc.mean()) and np.isnan(acc.std()) and np.isnan(acc.quantile(0.5))
+    acc.add(7)
+    assert (acc.count, acc.mean(), acc.std()) == (1, 7.0, 0.0)
+    assert np.isnan(acc.std(ddof=1))
+
+
+def test_size_accumulator_serialization(tmp_path):
+    acc = _accumulator(_sizes(1000))
+    restored = SizeAccumulator.from_bytes(acc.to_bytes())
+    assert restored.__dict__.keys() == acc.__dict__.keys()
+    for name, value in acc.__dict__.items():
+        assert np.array_equal(getattr(restored, name), value)
+
+    assert load_size_stats(str(tmp_path)) is None
+    acc.save(str(tmp_path / SIZE_STATS_FILE))
+    loaded = load_size_stats(str(tmp_path))
+    assert (loaded.count, loaded.sum, loaded.quantile(0.5)) == (acc.count, acc.sum, acc.quantile(0.5))
+
+
+def _range_data(n=3000, num_heights=200, seed=1):
+    rnd = np.random.RandomState(seed)
+    # Heights 150 to 159 have no sizes
+    heights = rnd.choice(np.setdiff1d(np.arange(num_heights), np.arange(150, 160)), n)
+    return heights, rnd.randint(20, 300, n), rnd.randint(1, 4, n), rnd.randint(0, 3, n)
+
+
+def _window_sizes(data, first, last, series=None):
+    # Brute force: every size in the window (repeated by its weight)
+    heights, sizes, weights, size_series = data
+    mask = (heights >= first) & (heights <= last)
+    if series is not None:
+        mask &= np.isin(size_series, series)
+    return np.repeat(sizes[mask], weights[mask]).astype(np.float64)
+
+
+def test_range_index_windows():
+    data = _range_data()
+    heights, sizes, weights, series = data
+    index = RangeIndex.build(heights, sizes, weights, series, keys=["a", "b", "c"], num_heights=210)
+    assert index.num_heights == 210
+
+    rnd = np.random.RandomState(2)
+    windows = [(0, None), (-5, 20), (150, 159), (190, 400), (30, 29)] + \
+        [tuple(sorted(rnd.randint(0, 210, 2))) for _ in range(50)]
+    for first, last in windows:
+        for keys, positions in [(None, None), (["b"], [1]), (["a", "c"], [0, 2])]:
+            expected = _window_sizes(data, first, 209 if last is None else last, positions)
+            count, s, sumsq = index.window(first, last, keys)
+            assert (count, s, sumsq) == (len(expected), expected.sum(), (expected ** 2).sum())
+            assert index.count(first, last, keys) == len(expected)
+            if len(expected):
+                assert index.mean(first, last, keys) == pytest.approx(expected.mean())
+                assert index.std(first, last, keys) == pytest.approx(expected.std())
+            else:
+                assert np.isnan(index.mean(first, last, keys)) and np.isnan(index.std(first, last, keys))
+
+
+def test_range_index_size_buckets():
+    data = _range_data()
+    heights, sizes, weights, series = data
+    index = RangeIndex.build(heights, sizes, weights, series, keys=["a", "b", "c"], bucket_width=100, num_buckets=2)
+
+    # Sizes of 100 and more are in the last bucket, and only buckets with sizes have a column
+    assert sorted(index.keys) == sorted(set([(["a", "b", "c"][s], 0 if size < 100 else 100)
+                                             for s, size in zip(series, sizes)]))
+    for first, last in [(0, 199), (40, 120)]:
+        expected = _window_sizes(data, first, last, [1])
+        big = expected[expected >= 100]
+        assert index.count(first, last, [("b", 100)]) == len(big)
+        assert index.mean(first, last, [("b", 100)]) == pytest.approx(big.mean())
+        # Keys of a series select all of its buckets
+        assert index.mean(first, last, ["b"]) == pytest.approx(expected.mean())
+
+
+def test_range_index_height_means(tmp_path):
+    data = _range_data()
+    heights, sizes, weights, series = data
+    index = RangeIndex.build(heights, sizes, weights, series, keys=["a", "b", "c"])
+
+    counts, sums = index.height_totals(["c"])
+    means = index.height_means(["c"])
+    filled = index.forward_filled_means(["c"], initial=0.0)
+    last_mean = 0.0
+    for h in range(index.num_heights):
+        expected = _window_sizes(data, h, h, [2])
+        assert (counts[h], sums[h]) == (len(expected), expected.sum())
+        if len(expected):
+            last_mean = expected.mean()
+            assert means[h] == pytest.approx(last_mean)
+        else:
+            assert np.isnan(means[h])
+        assert filled[h] == pytest.approx(last_mean)
+
+    # Save and load, with tuple keys
+    index = RangeIndex.build(heights, sizes, weights, series, keys=["a", "b", "c"], bucket_width=100)
+    index.save(str(tmp_path / "index"))
+    assert RangeIndex.exists(str(tmp_path / "index"))
+    loaded = RangeIndex.load(str(tmp_path / "index"))
+    assert loaded.keys == index.keys
+    assert loaded.window(10, 120, [("a", 0)]) == index.window(10, 120, [("a", 0)])
+    assert loaded.window(10, 120, ["a"]) == index.window(10, 120, ["a"])
+
+
+def test_range_index_empty():
+    index = RangeIndex.build([], [], num_heights=5)
+    assert index.window(0, 4) == (0.0, 0.0, 0.0)
+    assert np.isnan(index.mean()) and np.isnan(index.height_means()).all()
@@ -0,0 +1,80 @@
+from time import sleep, time
+
+import pytest
+import requests
+
+from benchmarks.explorer_stub import ExplorerStub
+from constants import *
+
+
+@pytest.fixture
+def explorer(chain, offline_apis, monkeypatch):
+    """
+    Explorer stub of the synthetic chain, installed in external_apis, with sleeps between retries recorded instead of
+    slept.
+
+    :return: tuple, ExplorerStub and list with the seconds of each sleep between retries
+    """
+    external_apis = offline_apis
+    backoffs = []
+    monkeypatch.setattr(external_apis, "EXTERNAL_API_BACKOFF", 1)
+    monkeypatch.setattr(external_apis, "EXTERNAL_API_MAX_BACKOFF", 3)
+    monkeypatch.setattr(external_apis, "sleep", backoffs.append)
+    stub = ExplorerStub(chain).start()
+    stub.install()
+    yield stub, backoffs
+    stub.stop()
+
+
+def _txids(chain, n):
+    return [tx.hash for block in chain for tx in block if tx.ins][:n]
+
+
+def test_fetch_tx_retries_server_errors(chain, offline_apis, explorer, monkeypatch):
+    external_apis = offline_apis
+    stub, backoffs = explorer
+    monkeypatch.setattr(external_apis, "EXTERNAL_API_MAX_RETRIES", 4)
+    txid = _txids(chain, 1)[0]
+    errors = external_apis.METRICS.get("api_errors")
+
+    stub.num_errors = 3
+    response = external_apis.fetch_tx(txid, BITCOIN)
+    assert response["inputs"][0]["script"] == stub.script(txid, 0)
+    assert stub.num_requests == 4
+    # Exponential backoff, capped at EXTERNAL_API_MAX_BACKOFF
+    assert backoffs == [1, 2, 3]
+    assert external_apis.METRICS.get("api_errors") - errors == 3
+
+
+def test_fetch_tx_gives_up(chain, offline_apis, explorer, monkeypatch):
+    external_apis = offline_apis
+    stub, backoffs = explorer
+    monkeypatch.setattr(external_apis, "EXTERNAL_API_MAX_RETRIES", 2)
+    txid = _txids(chain, 1)[0]
+
+    stub.num_errors = 10
+    with pytest.raises(requests.HTTPError, match="503"):
+        external_apis.fetch_tx(txid, BITCOIN)
+    assert stub.num_requests == 3 and len(backoffs) == 2
+
+    # Unknown transactions (404) are retried too
+    stub.num_errors = 0
+    with pytest.raises(requests.HTTPError, match="404"):
+        external_apis.fetch_tx("ff" * 32, BITCOIN)
+    assert stub.num_requests == 6
+
+
+def test_fetch_rate_limit(chain, offline_apis, explorer, monkeypatch):
+    # Concurrent requests to a provider are rate limited (with bursts of up to rate requests)
+    external_apis = offline_apis
+    stub, _ = explorer
+    monkeypatch.setattr(external_apis, "sleep", sleep)
+    rate, txids = 100, _txids(chain, 160)
+    external_apis.EXTERNAL_API_RATE_LIMITS["blockchain.info"] = rate
+
+    start = time()
+    _, scripts = external_apis.get_script_size_API([(txid, 0) for txid in txids], BITCOIN)
+    elapsed = time() - start
+    assert scripts == [stub.script(txid, 0) for txid in txids]
+    assert stub.num_requests == len(txids)
+    assert elapsed >= 0.95 * (len(txids) - rate) / rate
@@ -0,0 +1,230 @@
+import json
+import os
+import pickle
+
+import pytest
+
+from benchmarks import synthetic_chain
+from benchmarks.explorer_stub import ExplorerStub
+import get_blocksci_data
+from get_blocksci_data import *
+
+ty = synthetic_chain.address_type
+
+
+def _inputs(chain, types, first_height=0):
+    # Reference {h: [(txid, index), ...]} of the inputs of the given types
+    return dict([(block.height, [(tx.hash, i) for tx in block for i, txin in enumerate(tx.ins)
+                                 if txin.address_type in types and block.height >= first_height]) for block in chain])
+
+
+def _outputs(chain, types):
+    # Reference {h: [(txid, index, is_spent), ...]} of the outputs of the given types
+    return dict([(block.height, [(tx.hash, i, txout.is_spent) for tx in block for i, txout in enumerate(tx.outs)
+                                 if txout.address_type in types]) for block in chain])
+
+
+def _p2pkh(chain):
+    # Reference public key sizes of P2PKH inputs, by input and by output height
+    sizes_in = dict([(block.height, {}) for block in chain])
+    sizes_out = dict([(block.height, {33: 0, 65: 0}) for block in chain])
+    for block in chain:
+        for tx in block:
+            for txin in tx.ins:
+                if txin.address_type == ty.pubkeyhash:
+                    l = len(txin.address.pubkey)
+                    sizes_in[block.height][l] = sizes_in[block.height].get(l, 0) + 1
+                    sizes_out[txin.spent_tx.block_height][l] += 1
+    return sizes_in, sizes_out
+
+
+def _p2sh(chain, script_size=None):
+    """
+    Reference P2SH results.
+
+    :param script_size: function returning the script size of a P2SH input (txid, index) with a deferred redeem script
+                        type, None leaves their sizes unresolved
+    :return: tuple, p2sh dictionary and dictionary {h: [(txid, index, category), ...]} of the pending inputs
+    """
+    p2sh, pending = {}, {}
+    for block in chain:
+        sizes = {"multisig": {}, "nonstandard": {}, "pubkey": {}, "pubkeyhash": {}, "scripthash": {}, "P2WPKH": 0,
+                 "P2WSH": 0, "others": 0}
+        pending[block.height] = []
+        for tx in block:
+            for i, txin in enumerate(tx.ins):
+                if txin.address_type != ty.scripthash:
+                    continue
+                script = txin.address.script
+                wrapped_type = script.wrapped_address.type
+                if wrapped_type == ty.witness_pubkeyhash:
+                    sizes["P2WPKH"] += 1
+                    continue
+                elif wrapped_type == ty.witness_scripthash:
+                    sizes["P2WSH"] += 1
+                    continue
+                elif wrapped_type == ty.multisig:
+                    key = (script.wrapped_script.required, script.wrapped_script.total)
+                elif wrapped_type in [ty.pubkey, ty.pubkeyhash]:
+                    key = len(script.wrapped_script.pubkey)
+                else:
+                    pending[block.height].append((tx.hash, i, P2SH_DEFERRED_TYPES.index(wrapped_type.name)))
+                    if script_size is None:
+                        continue
+                    key = script_size(tx.hash, i)
+                sizes[wrapped_type.name][key] = sizes[wrapped_type.name].get(key, 0) + 1
+        p2sh[block.height] = sizes
+    return p2sh, pending
+
+
+def _load(suffix):
+    with open(coin_file(BITCOIN, suffix), "rb") as f:
+        return pickle.load(f)
+
+
+def _results():
+    # Every result of the scan, as pickled values and legacy dictionaries of the stores
+    results = dict([(suffix, _load(suffix)) for suffix in ["_pk_sizes_in.pickle", "_pk_sizes_out.pickle",
+                                                           "_p2sh.pickle"]])
+    results["_p2sh_pending"] = HeightColumns.load(coin_file(BITCOIN, "_p2sh_pending")).to_height_dict(
+        "txid", "index", "category")
+    for suffix in ["_non_std_inputs", "_p2wsh_inputs"]:
+        results[suffix] = HeightColumns.load(coin_file(BITCOIN, suffix)).to_height_dict("txid", "index")
+    for name in ["p2wsh", "p2wpkh"]:
+        results[name + "_outputs"] = HeightColumns.load(
+            os.path.join(coin_file(BITCOIN, "_nativesegwit_outputs"), name)).to_height_dict("txid", "index", "is_spent")
+        results[name + "_inputs"] = HeightColumns.load(
+            os.path.join(coin_file(BITCOIN, "_nativesegwit_inputs"), name)).to_height_dict("txid", "index")
+    return results
+
+
+def test_find_all_matches_chain(chain, scan):
+    scan()
+    results = _results()
+
+    sizes_in, sizes_out = _p2pkh(chain)
+    assert results["_pk_sizes_in.pickle"] == (sizes_in, 0)
+    assert results["_pk_sizes_out.pickle"] == (sizes_out, 0)
+    p2sh, pending = _p2sh(chain)
+    assert results["_p2sh.pickle"] == (p2sh, [])
+    assert results["_p2sh_pending"] == pending
+    assert results["_non_std_inputs"] == _inputs(chain, [ty.nonstandard])
+    assert results["_p2wsh_inputs"] == _inputs(chain, [ty.witness_scripthash])
+    for name, address_type in [("p2wsh", ty.witness_scripthash), ("p2wpkh", ty.witness_pubkeyhash)]:
+        assert results[name + "_outputs"] == _outputs(chain, [address_type])
+        assert results[name + "_inputs"] == _inputs(chain, [address_type], chain.segwit_height)
+    # The synthetic chain has inputs of every kind
+    assert all([any(values.values()) for name, values in results.items() if not name.endswith(".pickle")])
+
+
+def test_parallel_scan_matches_serial(scan):
+    scan("serial")
+    serial = _results()
+    scan("parallel", chain_path="synthetic", num_processes=3)
+    assert _results() == serial
+
+
+def test_resolve_matches_explorer(chain, scan, offline_apis):
+    scan()
+    stub = ExplorerStub(chain, num_scripts=50).start()
+    try:
+        stub.install()
+        blocksci_resolve_script_sizes(BITCOIN, batch_size=40)
+        num_requests = stub.num_requests
+
+        for suffix, kind, address_type in [("_non_std_inputs", "script", ty.nonstandard),
+                                           ("_p2wsh_inputs", "witness", ty.witness_scripthash)]:
+            inputs = _inputs(chain, [address_type])
+            store = HeightColumns.load(coin_file(BITCOIN, suffix))
+            scripts = ScriptDictionary.load(os.path.join(coin_file(BITCOIN, suffix), SCRIPTS_DIR))
+            assert scripts.to_height_dict(store) == dict([(h, [stub.script(txid, i, kind) for txid, i in values])
+                                                          for h, values in inputs.items()])
+            sizes = [len(stub.script(txid, i, kind)) // 2 for h in sorted(inputs) for txid, i in inputs[h]]
+            assert store["size"].tolist() == sizes
+            stats = load_size_stats(coin_file(BITCOIN, suffix))
+            assert stats.count == len(sizes) and stats.mean() == pytest.approx(sum(sizes) / len(sizes))
+
+        p2sh, _ = _p2sh(chain, lambda txid, i: len(stub.script(txid, i)) / 2)
+        assert _load("_p2sh.pickle") == (p2sh, [])
+
+        # Resolving again does not request anything nor count any input twice
+        blocksci_resolve_script_sizes(BITCOIN, batch_size=40)
+        assert stub.num_requests == num_requests
+        assert _load("_p2sh.pickle") == (p2sh, [])
+        assert load_size_stats(coin_file(BITCOIN, "_non_std_inputs")).count == \
+            len(HeightColumns.load(coin_file(BITCOIN, "_non_std_inputs")))
+    finally:
+        stub.stop()
+
+
+def test_interrupted_scan_resumes_from_checkpoints(scan, monkeypatch):
+    monkeypatch.setattr(get_blocksci_data, "SAVE_HEIGHT_INTERVAL", 50)
+    scan("full")
+    full = _results()
+
+    class Interrupted(Exception):
+        pass
+
+    end_block = P2PKHPubkeyCollector.end_block
+    visited, interrupt_heights = [], [170]
+
+    def interrupted_end_block(self, block):
+        visited.append(block.height)
+        if block.height in interrupt_heights:
+            interrupt_heights.remove(block.height)
+            raise Interrupted
+        end_block(self, block)
+
+    monkeypatch.setattr(P2PKHPubkeyCollector, "end_block", interrupted_end_block)
+    with pytest.raises(Interrupted):
+        scan("interrupted")
+    # Every collector checkpoints (the P2PKH one included), and height 0 is not a checkpoint of its own
+    for suffix in ["_pk_sizes_in", "_p2sh", "_non_std_inputs", "_nativesegwit_outputs"]:
+        with open(os.path.join(coin_file(BITCOIN, suffix) + "_segments", "manifest.json")) as f:
+            assert json.load(f)["segments"] == [[0, 50, "0-50.pickle"], [51, 100, "51-100.pickle"],
+                                                [101, 150, "101-150.pickle"]]
+
+    visited.clear()
+    scan("interrupted")
+    assert min(visited) == 151
+    assert _results() == full
+    assert not [f for f in os.listdir(".") if f.endswith("_segments")]
+
+
+@pytest.mark.parametrize("resolve", [False, True], ids=["scan", "resolve"])
+def test_update_matches_full_scan(chain, scan, workdir, offline_apis, monkeypatch, resolve):
+    # The first 130 blocks of the chain (blocks are generated in order from the seed, so they are the same ones; the
+    # scan fixture replaces synthetic_chain.Blockchain)
+    short = type(chain)(num_blocks=130, segwit_height=chain.segwit_height, seed=1)
+    stub = ExplorerStub(chain, num_scripts=50).start()
+    try:
+        stub.install()
+
+        def results():
+            if resolve:
+                blocksci_resolve_script_sizes(BITCOIN, batch_size=40)
+            values = _results()
+            for suffix in ["_non_std_inputs", "_p2wsh_inputs"]:
+                path = os.path.join(coin_file(BITCOIN, suffix), SCRIPTS_DIR)
+                values[suffix + " scripts"] = ScriptDictionary.load(path).to_height_dict(
+                    HeightColumns.load(coin_file(BITCOIN, suffix))) if os.path.exists(path) else None
+            return values
+
+        scan("full")
+        full = results()
+        assert (full["_non_std_inputs scripts"] is not None) == resolve
+
+        os.makedirs(workdir / "updated")
+        monkeypatch.chdir(workdir / "updated")
+        get_blocksci_data.blocksci_find_all(short)
+        assert max(_load("_pk_sizes_in.pickle")[0]) == len(short) - 1
+        if resolve:
+            blocksci_resolve_script_sizes(BITCOIN, batch_size=40)
+        num_requests = stub.num_requests
+        scan("updated", update=True)
+        assert results() == full
+    finally:
+        stub.stop()
+    if resolve:
+        # Only the inputs of the new blocks are resolved after the update
+        assert stub.num_requests - num_requests < num_requests
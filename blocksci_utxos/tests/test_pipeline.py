@@ -0,0 +1,90 @@
+import json
+from functools import partial
+
+import pytest
+
+import pipeline
+from pipeline import *
+
+
+@pytest.fixture
+def dag(workdir, monkeypatch):
+    """
+    Builds pipelines of four stages writing files in the test folder: a and c read the chain, b runs after a, and d
+    after b and c. Code files of the stages are in the test folder too.
+
+    :return: tuple, callable creating the pipeline (given the tip height and the stages that fail) and list with the
+             names of the stages run
+    """
+    monkeypatch.setattr(pipeline, "CODE_DIR", str(workdir))
+    for name in ["a", "b", "c", "d"]:
+        (workdir / (name + ".py")).write_text(name)
+    runs = []
+
+    def write(name, fail):
+        runs.append(name)
+        if fail:
+            raise ValueError(name)
+        (workdir / (name + ".out")).write_text(name)
+
+    def make(tip_height=100, failing=()):
+        return Pipeline([Stage(name, partial(write, name, name in failing), after=after, outputs=[name + ".out"],
+                               code=[name + ".py"], uses_chain=name in ["a", "c"])
+                         for name, after in [("a", []), ("b", ["a"]), ("c", []), ("d", ["b", "c"])]],
+                        "pipeline.json", tip_height=tip_height, context={"coin": 0}, max_workers=2)
+
+    return make, runs
+
+
+def test_fresh_stages_are_skipped(dag, workdir):
+    make, runs = dag
+    assert make().run() == {"a": "done", "b": "done", "c": "done", "d": "done"}
+    assert sorted(runs) == ["a", "b", "c", "d"]
+    assert make().run() == {"a": "fresh", "b": "fresh", "c": "fresh", "d": "fresh"}
+    assert len(runs) == 4
+
+    # A stage whose outputs are gone is run again, with the stages downstream
+    (workdir / "b.out").unlink()
+    assert make().run() == {"a": "fresh", "b": "done", "c": "fresh", "d": "done"}
+    # Forced stages are run even if they are fresh
+    assert make().run(force=["c"]) == {"a": "fresh", "b": "fresh", "c": "done", "d": "done"}
+    assert runs[4:] == ["b", "d", "c", "d"]
+
+
+def test_changes_invalidate_downstream(dag, workdir):
+    make, runs = dag
+    make().run()
+
+    # Code of a stage
+    (workdir / "b.py").write_text("b, changed")
+    assert make().run() == {"a": "fresh", "b": "done", "c": "fresh", "d": "done"}
+    # Tip height (for the stages reading the chain)
+    assert make(tip_height=101).run() == {"a": "done", "b": "done", "c": "done", "d": "done"}
+    assert make(tip_height=101).run() == {"a": "fresh", "b": "fresh", "c": "fresh", "d": "fresh"}
+    assert runs[4:6] == ["b", "d"]
+    assert sorted(runs[6:]) == ["a", "b", "c", "d"] and runs[-1] == "d"
+
+
+def test_targets_include_dependencies(dag):
+    make, runs = dag
+    assert make().run(targets=["b"]) == {"a": "done", "b": "done"}
+    assert make().run(targets=["d"]) == {"a": "fresh", "b": "fresh", "c": "done", "d": "done"}
+    assert runs == ["a", "b", "c", "d"]
+
+
+def test_failed_stage_is_recorded(dag, workdir):
+    make, runs = dag
+    make().run()
+    (workdir / "a.py").write_text("a, changed")
+    with pytest.raises(Exception, match="Failed stages: a"):
+        make(failing=["a"]).run()
+    # Stages downstream of the failed stage are not run, independent stages are (c is fresh)
+    assert runs[4:] == ["a"]
+    state = json.loads((workdir / "pipeline.json").read_text())
+    assert sorted(state) == ["b", "c", "d"]
+    pipe = make()
+    assert not pipe.is_fresh("a") and not pipe.is_fresh("b") and not pipe.is_fresh("d") and pipe.is_fresh("c")
+
+    # The next run executes the failed stage and the stages downstream
+    assert pipe.run() == {"a": "done", "b": "done", "c": "fresh", "d": "done"}
+    assert runs[5:] == ["a", "b", "d"]
@@ -0,0 +1,124 @@
+import glob
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import profiling
+from profiling import *
+
+
+def _report_stages(report_file):
+    with open(report_file) as f:
+        return json.load(f)["stages"]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Clock of the instrumentation, advanced by the test
+    now = [0.0]
+    monkeypatch.setattr(profiling, "perf_counter", lambda: now[0])
+    return now
+
+
+def test_stage_nesting(clock):
+    instrumentation = Instrumentation()
+    with instrumentation.stage("outer"):
+        clock[0] += 1
+    # Disabled instrumentation records nothing
+    assert instrumentation.stages == {}
+
+    instrumentation.enabled = True
+    with instrumentation.stage("outer"):
+        clock[0] += 1
+        for _ in range(2):
+            with instrumentation.stage("inner"):
+                clock[0] += 2
+                with instrumentation.stage("leaf"):
+                    clock[0] += 0.5
+        # Stages of other threads are not nested in the stages of this one
+        thread = threading.Thread(target=lambda: instrumentation.add("thread", 10))
+        thread.start()
+        thread.join()
+        clock[0] += 1
+    assert instrumentation.stages == {"outer": {"seconds": 7.0, "self_seconds": 2.0, "calls": 1},
+                                      "inner": {"seconds": 5.0, "self_seconds": 4.0, "calls": 2},
+                                      "leaf": {"seconds": 1.0, "self_seconds": 1.0, "calls": 2},
+                                      "thread": {"seconds": 10.0, "self_seconds": 10.0, "calls": 1}}
+
+    # A stage that raises is recorded too
+    with pytest.raises(ValueError):
+        with instrumentation.stage("outer"):
+            clock[0] += 3
+            raise ValueError()
+    assert instrumentation.stages["outer"] == {"seconds": 10.0, "self_seconds": 5.0, "calls": 2}
+
+
+def test_merge(clock):
+    worker = {"stages": {"scan": {"seconds": 4.0, "self_seconds": 3.0, "calls": 1},
+                         "checkpoint": {"seconds": 1.0, "self_seconds": 1.0, "calls": 2}},
+              "snapshots": [{"label": "end", "seconds": 4.0, "peak_rss_mb": 1.0}]}
+    instrumentation = Instrumentation()
+    instrumentation.enabled = True
+    with instrumentation.stage("extract"):
+        # The stages of a process this thread waited for are nested in the current stage
+        clock[0] += 5
+        instrumentation.merge(worker)
+        # Stages of parallel processes are kept apart
+        instrumentation.merge(worker, "shard")
+        instrumentation.merge(worker, "shard")
+        instrumentation.merge({}, "shard")
+    assert instrumentation.stages == {"extract": {"seconds": 5.0, "self_seconds": 1.0, "calls": 1},
+                                      "scan": {"seconds": 4.0, "self_seconds": 3.0, "calls": 1},
+                                      "checkpoint": {"seconds": 1.0, "self_seconds": 1.0, "calls": 2},
+                                      "shard scan": {"seconds": 8.0, "self_seconds": 6.0, "calls": 2},
+                                      "shard checkpoint": {"seconds": 2.0, "self_seconds": 2.0, "calls": 4}}
+    assert [s["label"] for s in instrumentation.snapshots] == ["end", "shard end", "shard end"]
+
+
+@pytest.mark.parametrize("profiler", [None, "cprofile", "sampling"])
+def test_instrumented_run(tmp_path, profiler):
+    with instrumented_run(str(tmp_path / "report_%Y.json"), profiler) as instrumentation:
+        assert instrumentation is INSTRUMENTATION and INSTRUMENTATION.enabled
+        with INSTRUMENTATION.stage("scan"):
+            with INSTRUMENTATION.stage("classify"):
+                sum(range(100000))
+        INSTRUMENTATION.snapshot("checkpoint")
+    assert not INSTRUMENTATION.enabled
+
+    (report_file,) = glob.glob(str(tmp_path / "report_2*.json"))
+    with open(report_file) as f:
+        report = json.load(f)
+    assert sorted(report["stages"]) == ["classify", "scan"]
+    assert report["stages"]["scan"]["calls"] == 1
+    assert report["stages"]["scan"]["self_seconds"] + report["stages"]["classify"]["seconds"] == \
+        pytest.approx(report["stages"]["scan"]["seconds"])
+    assert [s["label"] for s in report["snapshots"]] == ["checkpoint", "end"]
+    assert report["profiler"] == profiler and report["wall_seconds"] >= report["stages"]["scan"]["seconds"]
+    if profiler:
+        assert report["profile"]
+    if profiler == "cprofile":
+        assert os.path.exists(report_file + ".prof")
+
+    # Without a report file nothing is instrumented
+    with instrumented_run(None) as instrumentation:
+        with instrumentation.stage("scan"):
+            pass
+    assert INSTRUMENTATION.stages == _report_stages(report_file)
+
+
+@pytest.mark.parametrize("num_processes", [1, 2])
+def test_instrumented_scan_in_pool(scan, workdir, num_processes):
+    # Stages run in the processes of the pool are added to the report of the run
+    executor = ProcessPoolExecutor(max_workers=2)
+    try:
+        with instrumented_run(str(workdir / "report.json")):
+            scan("scan", chain_path="synthetic", num_processes=num_processes, executor=executor)
+    finally:
+        executor.shutdown()
+    stages = _report_stages(str(workdir / "report.json"))
+    prefix = "" if num_processes == 1 else "shard "
+    assert stages[prefix + "scan"]["calls"] >= 1 and stages[prefix + "classify"]["calls"] > 0
+    assert "serialize" in stages
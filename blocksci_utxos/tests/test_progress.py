@@ -0,0 +1,91 @@
+import io
+import json
+import os
+
+import pytest
+
+import progress
+from progress import *
+
+
+@pytest.fixture
+def clock(workdir, monkeypatch):
+    # Clock of the progress (and empty metrics), advanced by the test
+    now = [1000.0]
+    monkeypatch.setattr(progress, "time", lambda: now[0])
+    monkeypatch.setattr(progress, "METRICS", Metrics())
+    return now
+
+
+def _run(clock, metrics_file):
+    stream = io.StringIO()
+    p = Progress("resolve btc", {"blocks": 10, "inputs": 100}, interval=5, metrics_file=metrics_file,
+                 flush_interval=10, stream=stream)
+    clock[0] += 6
+    p.update(blocks=2, inputs=30)
+    progress.METRICS.inc("api_calls", 40)
+    progress.METRICS.inc("api_errors", 2)
+    progress.METRICS.inc("cache_hits", 30)
+    progress.METRICS.inc("cache_misses", 10)
+    for latency in range(101):
+        progress.METRICS.observe("api_latency", latency / 10.0)
+    clock[0] += 4
+    p.update(blocks=3, inputs=20)
+    clock[0] += 10
+    p.close()
+    return stream.getvalue().splitlines()
+
+
+def test_metrics():
+    metrics = Metrics(max_samples=100)
+    metrics.inc("api_calls")
+    metrics.inc("api_calls", 2)
+    assert metrics.get("api_calls") == 3 and metrics.get("cache_hits") == 0
+    assert metrics.percentiles("api_latency") == {}
+    # Only the last max_samples are kept
+    for latency in range(200):
+        metrics.observe("api_latency", latency)
+    assert metrics.percentiles("api_latency") == {50: 149.5, 95: 194.05, 99: 198.01}
+
+
+def test_progress_lines_and_jsonl(clock):
+    lines = _run(clock, "metrics.jsonl")
+    assert lines == ["resolve btc: 2/10 blocks (0.3/s) 30/100 inputs (5.0/s) elapsed 0m06s ETA 0m14s",
+                     "resolve btc: 5/10 blocks (0.2/s) 50/100 inputs (2.5/s) api 2.0/s p50 5.000s p95 9.500s "
+                     "p99 9.900s cache 75% elapsed 0m20s"]
+
+    # Flushed at the first update after flush_interval seconds, and when closed
+    with open("metrics.jsonl") as f:
+        snapshots = [json.loads(line) for line in f]
+    assert [s["elapsed"] for s in snapshots] == [10, 20]
+    s = snapshots[0]
+    assert s["stage"] == "resolve btc" and s["counts"] == {"blocks": 5, "inputs": 50}
+    assert s["totals"] == {"blocks": 10, "inputs": 100} and s["rates"] == {"blocks": 0.5, "inputs": 5.0}
+    assert s["api_calls"] == 40 and s["api_calls_per_sec"] == 4.0 and s["api_errors"] == 2
+    assert s["api_latency"] == {"50": 5.0, "95": 9.5, "99": 9.9}
+    assert s["cache_hit_rate"] == 0.75 and s["eta"] == 10.0 and "date" in s
+    assert snapshots[1]["eta"] == 20.0
+
+
+def test_progress_prometheus(clock):
+    _run(clock, "metrics.prom")
+    with open("metrics.prom") as f:
+        lines = f.read().splitlines()
+    labels = 'stage="resolve btc"'
+    assert lines == ["blocksci_utxos_processed{%s,unit=\"blocks\"} 5" % labels,
+                     "blocksci_utxos_rate{%s,unit=\"blocks\"} 0.25" % labels,
+                     "blocksci_utxos_processed{%s,unit=\"inputs\"} 50" % labels,
+                     "blocksci_utxos_rate{%s,unit=\"inputs\"} 2.5" % labels,
+                     "blocksci_utxos_total{%s,unit=\"blocks\"} 10" % labels,
+                     "blocksci_utxos_total{%s,unit=\"inputs\"} 100" % labels,
+                     "blocksci_utxos_elapsed_seconds{%s} 20.0" % labels,
+                     "blocksci_utxos_eta_seconds{%s} 20.0" % labels,
+                     "blocksci_utxos_api_calls{%s} 40" % labels,
+                     "blocksci_utxos_api_calls_per_sec{%s} 2.0" % labels,
+                     "blocksci_utxos_api_errors{%s} 2" % labels,
+                     "blocksci_utxos_api_latency_seconds{%s,quantile=\"0.5\"} 5.0" % labels,
+                     "blocksci_utxos_api_latency_seconds{%s,quantile=\"0.95\"} 9.5" % labels,
+                     "blocksci_utxos_api_latency_seconds{%s,quantile=\"0.99\"} 9.9" % labels,
+                     "blocksci_utxos_cache_hit_rate{%s} 0.75" % labels]
+    # The file is replaced at each flush
+    assert not [f for f in os.listdir(".") if f.endswith(".tmp")]
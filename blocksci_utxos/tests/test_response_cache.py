@@ -0,0 +1,124 @@
+import os
+import sqlite3
+
+import pytest
+
+from benchmarks.explorer_stub import ArchiveStub, ExplorerStub
+from constants import *
+from response_cache import *
+
+
+def test_response_archive(tmp_path):
+    path = str(tmp_path / "archive.bin")
+    archive = ResponseArchive(path)
+    archive.put("blockchain.info", "aa" * 32, b'{"inputs": []}')
+    archive.put("chainz.cryptoid.info", "aa" * 32, b"{}")
+    archive.put("blockchain.info", "bb" * 32, b"x" * 10000)
+    assert len(archive) == 3
+    assert archive.get("blockchain.info", "aa" * 32) == b'{"inputs": []}'
+    assert archive.get("blockchain.info", "cc" * 32) is None
+    archive.close()
+
+    # Records are kept when the archive is reopened, a repeated record only replaces the body if it changed
+    archive = ResponseArchive(path)
+    assert sorted(archive.keys()) == sorted([("blockchain.info", "aa" * 32), ("chainz.cryptoid.info", "aa" * 32),
+                                             ("blockchain.info", "bb" * 32)])
+    size = os.path.getsize(path)
+    archive.put("blockchain.info", "bb" * 32, b"x" * 10000)
+    assert os.path.getsize(path) == size
+    archive.put("blockchain.info", "aa" * 32, b'{"inputs": [1]}')
+    archive.close()
+    archive = ResponseArchive(path)
+    assert len(archive) == 3
+    assert archive.get("blockchain.info", "aa" * 32) == b'{"inputs": [1]}'
+    archive.close()
+
+
+def test_response_archive_truncated_record(tmp_path):
+    path = str(tmp_path / "archive.bin")
+    archive = ResponseArchive(path)
+    archive.put("blockchain.info", "aa" * 32, b"{}")
+    archive.close()
+    size = os.path.getsize(path)
+
+    # Record interrupted by a crash
+    with open(path, "ab") as f:
+        f.write(ResponseArchive.HEADER.pack(20, 100) + b"blockchain.info/b")
+    archive = ResponseArchive(path)
+    assert len(archive) == 1
+    assert os.path.getsize(path) == size
+    # Later records are appended after the last complete one
+    archive.put("blockchain.info", "bb" * 32, b"[]")
+    archive.close()
+    archive = ResponseArchive(path)
+    assert archive.get("blockchain.info", "aa" * 32) == b"{}" and archive.get("blockchain.info", "bb" * 32) == b"[]"
+    archive.close()
+
+
+def test_script_cache_commits(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.sqlite")
+    monkeypatch.setattr(ScriptCache, "COMMIT_INTERVAL", 10)
+    cache = ScriptCache(path)
+
+    def num_committed():
+        with sqlite3.connect(path) as db:
+            return db.execute("SELECT COUNT(*) FROM txs").fetchone()[0]
+
+    # Insertions are visible to the cache at once, and committed on flush or every COMMIT_INTERVAL insertions
+    for i in range(5):
+        cache.put(BITCOIN, "{:064x}".format(i), {"script": ["aa" * i]})
+    assert cache.get(BITCOIN, "{:064x}".format(4)) == ["aa" * 4]
+    assert num_committed() == 0
+    cache.flush()
+    assert num_committed() == 5
+    for i in range(5, 17):
+        cache.put(BITCOIN, "{:064x}".format(i), {"witness": ["bb"]})
+    assert num_committed() == 15
+    cache.close()
+    assert num_committed() == 17
+    cache = ScriptCache(path)
+    assert cache.get(BITCOIN, "{:064x}".format(16), "witness") == ["bb"]
+    cache.close()
+
+
+def test_record_replay(chain, offline_apis, monkeypatch):
+    external_apis = offline_apis
+    txids = [tx.hash for block in chain for tx in block if tx.ins][:200]
+    inputs = [(txid, i) for txid in txids for i in range(len(chain.tx(txid).ins))]
+
+    def fetch_all():
+        return [external_apis.get_script_size_API(inputs, BITCOIN), external_apis.get_script_size_API(inputs, LITECOIN),
+                external_apis.get_witness_size_API(inputs, LITECOIN)]
+
+    # Record
+    stub = ExplorerStub(chain).start()
+    try:
+        stub.install()
+        monkeypatch.setattr(external_apis, "EXTERNAL_API_ARCHIVE_MODE", "record")
+        recorded = fetch_all()
+        num_requests = stub.num_requests
+    finally:
+        stub.stop()
+    assert num_requests == 3 * len(txids)
+    assert recorded[0][1] == [stub.script(txid, i) for txid, i in inputs]
+    external_apis.get_response_archive().close()
+    external_apis.set_response_archive(None)
+
+    # Replay, with the explorer gone
+    monkeypatch.setattr(external_apis, "EXTERNAL_API_ARCHIVE_MODE", "replay")
+    monkeypatch.setattr(external_apis, "EXTERNAL_API_ARCHIVE_STRICT", True)
+    assert len(external_apis.get_response_archive()) == num_requests
+    assert fetch_all() == recorded
+    with pytest.raises(Exception, match="No archived"):
+        external_apis.fetch_tx("ff" * 32, BITCOIN)
+
+    # The archive served over HTTP, through the real fetch path
+    monkeypatch.setattr(external_apis, "EXTERNAL_API_ARCHIVE_MODE", None)
+    archive_stub = ArchiveStub(external_apis.get_response_archive()).start()
+    try:
+        archive_stub.install()
+        assert fetch_all() == recorded
+        assert archive_stub.num_requests == num_requests
+    finally:
+        archive_stub.stop()
+        external_apis.get_response_archive().close()
@@ -0,0 +1,165 @@
+import hashlib
+
+import numpy as np
+
+from results_store import *
+
+DTYPES = {"txid": TXID_DTYPE, "index": np.uint32}
+
+
+def _values(heights, seed=0):
+    # Legacy dict-of-lists layout, {h: [(txid, index), ...]}, with several values at some heights and none at others
+    rnd = np.random.RandomState(seed)
+    values = {}
+    for h in heights:
+        values[h] = [(hashlib.sha256(b"%d:%d:%d" % (seed, h, k)).hexdigest(), int(rnd.randint(0, 10)))
+                     for k in range(rnd.choice([0, 0, 1, 3]))]
+    return values
+
+
+def _builder(values):
+    builder = HeightColumnsBuilder(DTYPES)
+    for h in sorted(values):
+        for txid, index in values[h]:
+            builder.append(h, txid=txid_bytes(txid), index=index)
+    return builder
+
+
+def _build(values, num_heights):
+    return _builder(values).build(num_heights)
+
+
+def test_height_columns_layout():
+    values = _values(range(50))
+    store = _build(values, 50)
+
+    assert store.num_heights == 50
+    assert len(store) == sum([len(v) for v in values.values()])
+    assert store.counts().tolist() == [len(values[h]) for h in range(50)]
+    assert store.heights().tolist() == [h for h in range(50) for _ in values[h]]
+    for h in range(50):
+        assert store.at(h, "index").tolist() == [index for _, index in values[h]]
+    assert store.to_height_dict("txid", "index") == values
+
+
+def test_height_columns_save_load(tmp_path):
+    values = _values(range(50))
+    store = _build(values, 50)
+    store.columns["script"] = ScriptArena.from_scripts([bytes([k]) * k for k in range(len(store))])
+    store.save(str(tmp_path / "store"))
+
+    for mmap_mode in ["r", None]:
+        loaded = HeightColumns.load(str(tmp_path / "store"), mmap_mode=mmap_mode)
+        assert sorted(loaded.columns) == ["index", "script", "txid"]
+        assert np.array_equal(loaded.offsets, store.offsets)
+        assert loaded.to_height_dict("txid", "index") == values
+        assert [bytes(script) for script in loaded["script"]] == [bytes([k]) * k for k in range(len(store))]
+
+    # Only the given columns are overwritten
+    store.columns["index"] = store["index"] + 1
+    store.save(str(tmp_path / "store"), ["index"])
+    loaded = HeightColumns.load(str(tmp_path / "store"))
+    assert loaded["index"].tolist() == [index + 1 for h in range(50) for _, index in values[h]]
+
+
+def test_height_columns_concatenate():
+    # As in update mode: a store of the first heights extended with a store of the blocks scanned later
+    values = _values(range(80))
+    earlier = _build(dict([(h, v) for h, v in values.items() if h < 30]), 30)
+    later = _build(dict([(h, v) for h, v in values.items() if h >= 30]), 80)
+
+    store = earlier.concatenate(later)
+    whole = _build(values, 80)
+    assert np.array_equal(store.offsets, whole.offsets)
+    assert np.array_equal(store["txid"], whole["txid"])
+    assert store.to_height_dict("txid", "index") == values
+
+
+def test_height_columns_concatenate_missing_columns():
+    values = _values(range(40))
+    earlier = _build(dict([(h, v) for h, v in values.items() if h < 20]), 20)
+    later = _build(dict([(h, v) for h, v in values.items() if h >= 20]), 40)
+    earlier.columns["size"] = np.arange(len(earlier), dtype=np.uint32) + 1
+    earlier.columns["script"] = ScriptArena.from_scripts([b"\x51"] * len(earlier))
+
+    store = earlier.concatenate(later)
+    assert len(store) == len(earlier) + len(later)
+    # Numeric columns are filled with zeros, arenas keep covering the earlier values only
+    assert store["size"].tolist() == list(range(1, len(earlier) + 1)) + [0] * len(later)
+    scripts = store.to_height_dict("script")
+    assert [s for h in range(20) for s in scripts[h]] == ["51"] * len(earlier)
+    assert [s for h in range(20, 40) for s in scripts[h]] == [None] * len(later)
+
+
+def test_height_columns_builder_from_store():
+    values = _values(range(60))
+    store = _build(values, 60)
+    builder = HeightColumnsBuilder.from_store(store, DTYPES)
+    builder.extend(_builder({60: [("ab" * 32, 7)]}))
+    values[60] = [("ab" * 32, 7)]
+    assert builder.build(61).to_height_dict("txid", "index") == values
+
+
+def test_script_arena(tmp_path):
+    scripts = [b"", b"\x00", b"\x51\x52", b"\xff" * 300, b""]
+    arena = ScriptArena.from_scripts(scripts)
+    assert len(arena) == len(scripts)
+    assert arena.sizes().tolist() == [len(script) for script in scripts]
+    assert [bytes(script) for script in arena] == scripts
+    assert [bytes(script) for script in arena[1:3]] == scripts[1:3]
+
+    extended = arena.extend([b"\x01\x02\x03"])
+    assert [bytes(script) for script in extended] == scripts + [b"\x01\x02\x03"]
+    # Extending does not modify the original arena
+    assert len(arena) == len(scripts)
+
+    extended.save(str(tmp_path / "arena"))
+    assert ScriptArena.exists(str(tmp_path / "arena"))
+    for mmap_mode in ["r", None]:
+        loaded = ScriptArena.load(str(tmp_path / "arena"), mmap_mode)
+        assert [bytes(script) for script in loaded] == scripts + [b"\x01\x02\x03"]
+
+    empty = ScriptArena.from_scripts([])
+    empty.save(str(tmp_path / "empty"))
+    assert len(ScriptArena.load(str(tmp_path / "empty"))) == 0
+
+
+def test_script_dictionary_intern(tmp_path):
+    scripts = [b"\x51", b"\x52\x53", b"\x51", b"", b"\x52\x53", b"\x51"]
+    dictionary = ScriptDictionary()
+    refs = dictionary.intern(scripts)
+
+    assert refs.tolist() == [0, 1, 0, 2, 1, 0]
+    assert [bytes(dictionary[script_id]) for script_id in range(len(dictionary))] == [b"\x51", b"\x52\x53", b""]
+    assert dictionary.sizes().tolist() == [1, 2, 0]
+    assert dictionary.counts.tolist() == [3, 2, 1]
+    assert dictionary.num_occurrences() == len(scripts)
+    assert dictionary.lookup(hashlib.sha256(b"\x52\x53").digest()) == 1
+    assert dictionary.lookup(hashlib.sha256(b"\x54").digest()) is None
+
+    # Later occurrences (e.g. inputs added by an update) reuse the stored scripts
+    dictionary.save(str(tmp_path / "scripts"))
+    assert ScriptDictionary.exists(str(tmp_path / "scripts"))
+    loaded = ScriptDictionary.load(str(tmp_path / "scripts"), mmap_mode=None)
+    refs = loaded.intern([b"\x54", b"\x51", b"\x54"])
+    assert refs.tolist() == [3, 0, 3]
+    assert loaded.counts.tolist() == [4, 2, 1, 2]
+    assert [bytes(script) for script in loaded.arena] == [b"\x51", b"\x52\x53", b"", b"\x54"]
+
+    loaded.save(str(tmp_path / "scripts"))
+    reloaded = ScriptDictionary.load(str(tmp_path / "scripts"))
+    assert reloaded.counts.tolist() == [4, 2, 1, 2]
+    assert [reloaded.lookup(hashlib.sha256(script).digest()) for script in [b"\x54", b"", b"\x52\x53", b"\x51"]] == \
+        [3, 2, 1, 0]
+
+
+def test_script_dictionary_to_height_dict():
+    values = _values(range(30))
+    store = _build(values, 30)
+    scripts = [bytes([index]) * index for h in range(30) for _, index in values[h]]
+    dictionary = ScriptDictionary()
+    store.columns["script_ref"] = dictionary.intern(scripts)
+
+    assert len(dictionary) == len(set(scripts))
+    assert dictionary.to_height_dict(store) == dict([(h, [(bytes([index]) * index).hex() for _, index in values[h]])
+                                                     for h in range(30)])
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from benchmarks import synthetic_chain
+from benchmarks.explorer_stub import ExplorerStub
+from get_blocksci_data import blocksci_resolve_script_sizes
+from rollups import *
+
+ty = synthetic_chain.address_type
+
+
+@pytest.fixture
+def rollups(chain, scan, offline_apis):
+    """
+    Rollups of the synthetic chain, with script sizes resolved by the explorer stub.
+
+    :return: tuple, Rollups object and ExplorerStub
+    """
+    scan()
+    stub = ExplorerStub(chain, num_scripts=50).start()
+    try:
+        stub.install()
+        blocksci_resolve_script_sizes(BITCOIN)
+    finally:
+        stub.stop()
+    build_rollups(BITCOIN)
+    return Rollups.load(BITCOIN), stub
+
+
+def _chain_metric(chain, value):
+    # Reference count and sum at each height of the non-None values of value(tx, i, txin) over all inputs
+    counts, sums = np.zeros(len(chain)), np.zeros(len(chain))
+    for block in chain:
+        for tx in block:
+            for i, txin in enumerate(tx.ins):
+                v = value(tx, i, txin)
+                if v is not None:
+                    counts[block.height] += 1
+                    sums[block.height] += v
+    return counts, sums
+
+
+def test_rollup_metrics_match_chain(chain, rollups):
+    (_, stub) = rollups
+    metrics = rollup_metrics(BITCOIN)
+    assert sorted(metrics) == Rollups.load(BITCOIN).metrics()
+
+    references = {
+        "p2pkh_pubkey_size_in": _chain_metric(
+            chain, lambda tx, i, txin: len(txin.address.pubkey) if txin.address_type == ty.pubkeyhash else None),
+        "nonstd_script_size": _chain_metric(
+            chain, lambda tx, i, txin: len(stub.script(tx.hash, i)) // 2 if txin.address_type == ty.nonstandard
+            else None),
+        "p2wsh_witness_size": _chain_metric(
+            chain, lambda tx, i, txin: len(stub.script(tx.hash, i, "witness")) // 2
+            if txin.address_type == ty.witness_scripthash else None),
+        "p2sh_p2wpkh": _chain_metric(
+            chain, lambda tx, i, txin: 0 if txin.address_type == ty.scripthash and
+            txin.address.script.wrapped_address.type == ty.witness_pubkeyhash else None)}
+    outputs = np.zeros(len(chain)), np.zeros(len(chain))
+    for block in chain:
+        for tx in block:
+            for txout in tx.outs:
+                if txout.address_type == ty.witness_scripthash:
+                    outputs[0][block.height] += 1
+                    outputs[1][block.height] += txout.is_spent
+    references["native_p2wsh_outputs"] = outputs
+
+    for name, (counts, sums) in references.items():
+        assert counts.sum() > 0
+        assert np.array_equal(metrics[name][0], counts), name
+        if name != "p2sh_p2wpkh":
+            assert np.array_equal(metrics[name][1], sums), name
+
+
+def test_rollups_match_metrics(chain, rollups):
+    (rollups, _) = rollups
+    metrics = rollup_metrics(BITCOIN)
+    assert rollups.num_heights == len(chain)
+
+    for name, (counts, sums) in metrics.items():
+        for resolution in ROLLUP_RESOLUTIONS:
+            bins = range(0, len(chain), resolution)
+            heights, values = rollups.series(name, resolution=resolution, stat="count")
+            assert heights.tolist() == list(bins)
+            assert values.tolist() == [counts[h:h + resolution].sum() for h in bins]
+            _, values = rollups.series(name, resolution=resolution, stat="sum")
+            assert np.allclose(values, [sums[h:h + resolution].sum() for h in bins], equal_nan=True)
+            _, values = rollups.series(name, resolution=resolution, stat="per_block")
+            assert np.allclose(values, [counts[h:h + resolution].sum() / len(range(h, min(h + resolution, len(chain))))
+                                        for h in bins])
+
+        for window, step in ROLLUP_WINDOWS.items():
+            ends = range(window, len(chain) + 1, step)
+            heights, values = rollups.series(name, window=window, stat="count")
+            assert heights.tolist() == [end - 1 for end in ends]
+            assert values.tolist() == [counts[end - window:end].sum() for end in ends]
+            with np.errstate(invalid="ignore"):
+                expected = [sums[end - window:end].sum() / counts[end - window:end].sum() for end in ends]
+            _, values = rollups.series(name, window=window)
+            assert np.allclose(values, expected, equal_nan=True)
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from benchmarks import synthetic_chain
+from spent_index import *
+
+ty = synthetic_chain.address_type
+
+
+@pytest.mark.parametrize("chunk_size", [1000, 7])
+def test_spent_index_matches_chain(chain, chunk_size, tmp_path):
+    index = build_spent_index(chain, str(tmp_path / "spent_index"), chunk_size=chunk_size)
+    assert index.num_heights == len(chain)
+
+    ages, by_output_height, p2pkh_by_output_height = [], np.zeros(len(chain)), np.zeros(len(chain))
+    by_spending_height, p2pkh_by_spending_height = np.zeros(len(chain)), np.zeros(len(chain))
+    spent, unspent = np.zeros(len(chain)), np.zeros(len(chain))
+    for block in chain:
+        for tx in block:
+            for txin in tx.ins:
+                ages.append(block.height - txin.spent_tx.block_height)
+                by_output_height[txin.spent_tx.block_height] += 1
+                p2pkh_by_output_height[txin.spent_tx.block_height] += txin.address_type == ty.pubkeyhash
+            for txout in tx.outs:
+                if txout.is_spent:
+                    spent[block.height] += 1
+                    by_spending_height[txout.spending_tx.block_height] += 1
+                    p2pkh_by_spending_height[txout.spending_tx.block_height] += txout.address_type == ty.pubkeyhash
+                else:
+                    unspent[block.height] += 1
+
+    assert p2pkh_by_output_height.sum() > 0 and unspent.sum() > 0
+    assert index.ages().tolist() == ages
+    assert index.ages().tolist() == chain.input_arrays["age"].tolist()
+    assert np.array_equal(index.inputs_by_output_height(), by_output_height)
+    assert np.array_equal(index.inputs_by_output_height(ty.pubkeyhash), p2pkh_by_output_height)
+    assert np.array_equal(index.outputs_by_spending_height(), by_spending_height)
+    assert np.array_equal(index.outputs_by_spending_height(ty.pubkeyhash), p2pkh_by_spending_height)
+    assert all([np.array_equal(a, b) for a, b in zip(index.spent_outputs_by_height(), (spent, unspent))])
@@ -0,0 +1,49 @@
+import json
+
+import numpy as np
+import pytest
+
+from constants import *
+from type_counts import *
+
+
+def _chain_counts(chain):
+    # Reference counts of inputs and outputs of each type at each height, from the objects of the chain
+    inputs = np.zeros((len(chain), len(ADDRESS_TYPES)), dtype=np.int64)
+    outputs = np.zeros((len(chain), len(ADDRESS_TYPES)), dtype=np.int64)
+    for block in chain:
+        for tx in block:
+            for txin in tx.ins:
+                inputs[block.height, ADDRESS_TYPES.index(txin.address_type)] += 1
+            for txout in tx.outs:
+                outputs[block.height, ADDRESS_TYPES.index(txout.address_type)] += 1
+    return inputs, outputs
+
+
+# 7 does not divide the length of the chain
+@pytest.mark.parametrize("chunk_size", [1000, 7])
+def test_count_by_type_matches_chain(chain, chunk_size):
+    inputs, outputs = _chain_counts(chain)
+    assert np.array_equal(count_by_type(chain, "inputs", chunk_size), inputs)
+    assert np.array_equal(count_by_type(chain, "outputs", chunk_size), outputs)
+    num_inputs, num_outputs = block_counts(chain, chunk_size)
+    assert np.array_equal(num_inputs, inputs.sum(axis=1)) and np.array_equal(num_outputs, outputs.sum(axis=1))
+
+    assert np.array_equal(cumulative_counts(inputs)[-1], inputs.sum(axis=0))
+    assert cumulative_counts(num_outputs).tolist() == [num_outputs[:h + 1].sum() for h in range(len(chain))]
+    assert np.array_equal(utxo_set_size_by_type(chain, chunk_size), np.cumsum(outputs - inputs, axis=0))
+    totals = type_totals(inputs)
+    assert totals == dict([(ty, int(n)) for ty, n in zip(ADDRESS_TYPES, inputs.sum(axis=0)) if n])
+    assert all(totals.values())
+
+
+def test_dump_type_counts(chain, workdir):
+    import get_blocksci_data
+    import utxo_journal_main
+    utxo_journal_main.dump_type_counts(chain, BITCOIN)
+    inputs, outputs = _chain_counts(chain)
+    assert np.array_equal(np.load(coin_file(BITCOIN, "_input_types.npy")), inputs)
+    assert np.array_equal(np.load(coin_file(BITCOIN, "_output_types.npy")), outputs)
+    with open(coin_file(BITCOIN, "_input_types.json")) as f:
+        assert json.load(f) == dict([(str(ty), n) for ty, n in
+                                     get_blocksci_data.blocksci_count_input_by_type(chain).items()])
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from benchmarks import synthetic_chain
+from type_counts import ADDRESS_TYPES
+from utxo_set import *
+
+BUCKET_SIZE = 30
+
+
+def _chain_utxo_set(chain):
+    # Reference series: each spendable output is in the UTXO set from its creation height to the height before its
+    # spend (or to the tip)
+    num_heights, num_buckets = len(chain), (len(chain) - 1) // BUCKET_SIZE + 1
+    count, value = np.zeros(num_heights, dtype=np.int64), np.zeros(num_heights, dtype=np.int64)
+    by_type = np.zeros((num_heights, len(ADDRESS_TYPES)), dtype=np.int64)
+    by_age = np.zeros((num_heights, num_buckets), dtype=np.int64)
+    for block in chain:
+        for tx in block:
+            for txout in tx.outs:
+                if txout.address_type == synthetic_chain.address_type.nulldata:
+                    continue
+                last = txout.spending_tx.block_height if txout.is_spent else num_heights
+                heights = slice(block.height, last)
+                count[heights] += 1
+                value[heights] += txout.value
+                by_type[heights, ADDRESS_TYPES.index(txout.address_type)] += 1
+                by_age[heights, block.height // BUCKET_SIZE] += 1
+    return {"count": count, "value": value, "by_type": by_type, "by_age": by_age}
+
+
+@pytest.mark.parametrize("chunk_size", [1000, 7])
+def test_utxo_set_evolution_matches_chain(chain, chunk_size, tmp_path):
+    expected = _chain_utxo_set(chain)
+    evolution = utxo_set_evolution(chain, bucket_size=BUCKET_SIZE, chunk_size=chunk_size)
+    assert evolution.num_heights == len(chain)
+    for name in UTXOSetEvolution.names:
+        assert np.array_equal(getattr(evolution, name), expected[name]), name
+    # Null data outputs are in the chain, but never in the UTXO set
+    assert chain.output_arrays["address_type"].tolist().count(int(synthetic_chain.address_type.nulldata)) > 0
+    assert not evolution.by_type[:, ADDRESS_TYPES.index(synthetic_chain.address_type.nulldata)].any()
+
+    evolution.save(str(tmp_path / "utxo_set"))
+    loaded = UTXOSetEvolution.load(str(tmp_path / "utxo_set"))
+    h = len(chain) - 1
+    assert loaded.bucket_size == BUCKET_SIZE
+    assert loaded.at(h) == evolution.at(h)
+    assert loaded.at(h)["count"] == expected["count"][h]
@@ -0,0 +1,99 @@
+import blocksci
+import numpy as np
+
+# Address types, in the order of the columns of the count matrices (the code of an address type is its column)
+ADDRESS_TYPES = sorted(blocksci.address_type.__members__.values(), key=int)
+
+
+def address_type_codes(values):
+    """
+    :param values: address types, as returned by blocksci (numpy array of codes or sequence of address_type values)
+    :return: numpy array with the code of each address type
+    """
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = np.array([int(v) for v in values], dtype=np.int64)
+    return values.astype(np.int64)
+
+
+def block_ranges(chain, chunk_size):
+    """
+    :param chain: blocksci chain object
+    :param chunk_size: number of blocks of each range
+    :return: generator of tuples (first height, blocksci block range)
+    """
+    for first in range(0, len(chain), chunk_size):
+        yield first, chain[first:min(first + chunk_size, len(chain))]
+
+
+def count_by_type(chain, kind="inputs", chunk_size=1000):
+    """
+    Counts the inputs (or outputs) of each address type found at each block height. Address types and counts are read
+    as numpy arrays from blocksci block ranges (chunk_size blocks at a time), so no Python object is created per
+    input/output.
+
+    :param chain: blocksci chain object
+    :param kind: "inputs" or "outputs"
+    :param chunk_size: number of blocks read at once
+    :return: numpy array of shape (number of heights, len(ADDRESS_TYPES)), element [h, t] is the number of inputs (or
+             outputs) of type ADDRESS_TYPES[t] found at height h
+    """
+
+    num_types = len(ADDRESS_TYPES)
+    counts = np.zeros((len(chain), num_types), dtype=np.int64)
+    for first, blocks in block_ranges(chain, chunk_size):
+        per_block = np.asarray(blocks.input_count if kind == "inputs" else blocks.output_count, dtype=np.int64)
+        types = address_type_codes(getattr(blocks, kind).address_type)
+        rows = np.repeat(np.arange(len(per_block)), per_block)
+        counts[first:first + len(per_block)] = np.bincount(rows * num_types + types,
+                                                          minlength=len(per_block) * num_types).reshape(-1, num_types)
+
+    return counts
+
+
+def block_counts(chain, chunk_size=1000):
+    """
+    :param chain: blocksci chain object
+    :param chunk_size: number of blocks read at once
+    :return: tuple, numpy arrays with the number of inputs and the number of outputs found at each height
+    """
+
+    inputs, outputs = [], []
+    for _, blocks in block_ranges(chain, chunk_size):
+        inputs.append(np.asarray(blocks.input_count, dtype=np.int64))
+        outputs.append(np.asarray(blocks.output_count, dtype=np.int64))
+
+    return np.concatenate(inputs), np.concatenate(outputs)
+
+
+def type_totals(counts):
+    """
+    :param counts: count matrix, as returned by count_by_type
+    :return: dictionary, keys are address types and values the number of occurrences (types with no occurrences are
+             not included)
+    """
+
+    totals = counts.sum(axis=0)
+    return {ty: int(n) for ty, n in zip(ADDRESS_TYPES, totals) if n}
+
+
+def cumulative_counts(counts):
+    """
+    :param counts: count array or matrix indexed by height (e.g. as returned by count_by_type or block_counts)
+    :return: numpy array with the same shape, the element at height h counts the occurrences up to height h
+    """
+
+    return np.cumsum(counts, axis=0)
+
+
+def utxo_set_size_by_type(chain, chunk_size=1000):
+    """
+    Computes the number of UTXOs of each address type existing at each block height (outputs created minus inputs
+    spent up to that height; inputs have the address type of the output they spend).
+
+    :param chain: blocksci chain object
+    :param chunk_size: number of blocks read at once
+    :return: numpy array of shape (number of heights, len(ADDRESS_TYPES))
+    """
+
+    return cumulative_counts(count_by_type(chain, "outputs", chunk_size) - count_by_type(chain, "inputs", chunk_size))
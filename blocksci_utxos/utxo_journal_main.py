@@ -1,48 +1,258 @@
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
 import blocksci
+import numpy as np
 
 from constants import *
 from get_blocksci_data import *
 from analyze_data import *
+from rollups import *
+from pipeline import Pipeline, Stage
+from profiling import instrumented_run
+from spent_index import build_spent_index
 
+# Code files the results of each kind of stage depend on
+EXTRACT_CODE = ("get_blocksci_data.py", "results_store.py", "accumulators.py", "type_counts.py", "constants.py")
+RESOLVE_CODE = EXTRACT_CODE + ("external_apis.py", "raw_blocks.py")
+ANALYSIS_CODE = ("analyze_data.py", "results_store.py", "accumulators.py", "constants.py")
+COUNT_CODE = ("get_blocksci_data.py", "type_counts.py")
+SPENT_INDEX_CODE = ("spent_index.py", "type_counts.py")
 
-if __name__ == "__main__":
+# Resources of the stages (see Stage): stages reading the chain (or the block files) are run one at a time, and so are
+# the analyses loading the P2PKH and P2SH pickles (that are the largest results)
+CHAIN = "chain"
+MEMORY = "memory"
+
+
+def dump_json(function, json_file):
+    """
+    :param function: callable, run without arguments
+    :param json_file: file where the value returned by function is dumped (keys of dictionaries, e.g. blocksci
+                      address types, are written as strings)
+    """
+    value = function()
+    if isinstance(value, dict):
+        value = dict([(str(key), v) for key, v in value.items()])
+    with open(json_file + ".tmp", "w") as f:
+        json.dump(value, f, default=str)
+    os.replace(json_file + ".tmp", json_file)
+
+
+def dump_type_counts(chain, coin=BITCOIN):
+    """
+    Saves the number of inputs and outputs of each address type found at each height (see type_counts.count_by_type)
+    in COIN_input_types.npy and COIN_output_types.npy, matrices of shape (number of heights, len(ADDRESS_TYPES)) with
+    a column per address type (in the order of type_counts.ADDRESS_TYPES). The totals of the input matrix (as returned
+    by blocksci_count_input_by_type) are dumped to COIN_input_types.json.
+
+    :param chain: blocksci chain object
+    :param coin: studied coin
+    """
+    for kind in ["input", "output"]:
+        counts = count_by_type(chain, kind + "s")
+        npy_file = coin_file(coin, "_{}_types.npy".format(kind))
+        with open(npy_file + ".tmp", "wb") as f:
+            np.save(f, counts)
+        os.replace(npy_file + ".tmp", npy_file)
+    dump_json(partial(type_totals, np.load(coin_file(coin, "_input_types.npy"))), coin_file(coin, "_input_types.json"))
+
+
+def journal_pipeline(chain, coin=BITCOIN, chain_path=None, num_processes=1, update=False, max_workers=4,
+                     executor=None):
+    """
+    Stages of the journal (extraction, script size resolution, STATUS json files and additional analysis), as a
+    Pipeline whose state is kept in COIN_pipeline.json. Stages are keyed by coin, chain tip height and code version,
+    so a run only executes the stages whose outputs are missing or stale, and the stages that do not depend on each
+    other (e.g. the json files of each input type) run concurrently.
+
+    :param chain: blocksci chain object
+    :param coin: studied coin
+    :param chain_path: path to the blocksci parsed data, needed when extracting in several processes
+    :param num_processes: number of processes scanning the chain (None uses all cores)
+    :param update: boolean, only scan the blocks added since the previous extraction, extending its results
+    :param max_workers: maximum number of stages running at the same time
+    :param executor: process pool where parallel scans and the block files index run, shared with other coins (see
+                     scan_pool). Process pools must not be created in stage threads, so it is needed with
+                     num_processes != 1 or RAW_BLOCKS_DIRS.
+    :return: Pipeline
+    """
+
+    def c(suffix):
+        return coin_file(coin, suffix)
+
+    extract_outputs = [c("_pk_sizes_in.pickle"), c("_pk_sizes_out.pickle"), c("_p2sh.pickle"), c("_p2sh_pending"),
+                       c("_non_std_inputs"), c("_p2wsh_inputs"), c("_nativesegwit_outputs"), c("_nativesegwit_inputs")]
+    resolve_outputs = [os.path.join(c("_non_std_inputs"), SCRIPTS_DIR), os.path.join(c("_p2wsh_inputs"), SCRIPTS_DIR)]
+
+    # Transaction index of the block files of the node, read instead of the external APIs (see RAW_BLOCKS_DIRS)
+    index_stages = []
+    if RAW_BLOCKS_DIRS.get(coin):
+        index_stages = [Stage("raw_blocks_index", partial(update_raw_blocks_index, coin, executor=executor),
+                              outputs=[c("_raw_blocks_index")], code=("raw_blocks.py",), uses_chain=True,
+                              resources=[CHAIN])]
+
+    stages = index_stages + [
+        # RSOS paper (P2PKH, P2SH, non-std and P2WSH inputs) and RECSI paper (native segwit outputs and inputs),
+        # all collected in a single traversal of the chain
+        Stage("extract", partial(blocksci_find_all, chain, coin=coin, chain_path=chain_path,
+                                 num_processes=num_processes, update=update, executor=executor),
+              outputs=extract_outputs, code=EXTRACT_CODE, uses_chain=True, resources=[CHAIN]),
+        # Script sizes not available in blocksci are obtained from external APIs (or the block files of the node)
+        Stage("resolve", partial(blocksci_resolve_script_sizes, coin=coin),
+              after=["extract"] + [stage.name for stage in index_stages], outputs=resolve_outputs,
+              code=RESOLVE_CODE),
+        Stage("p2sh_analysis", partial(p2sh_analysis, coin=coin), after=["resolve"],
+              outputs=[os.path.join(OUTPUT_DIRS.get(coin, ""), "p2sh_agg_data.pickle")], code=ANALYSIS_CODE,
+              resources=[MEMORY]),
+        Stage("non_std_analysis", partial(non_std_analysis, coin=coin), after=["resolve"], code=ANALYSIS_CODE),
+        # Prefix sums of the estimation data, for averages over any window of heights
+        Stage("range_index", partial(build_range_indexes, coin=coin), after=["resolve"],
+              outputs=[c("_range_index")], code=ANALYSIS_CODE, resources=[MEMORY]),
+        # Pre-aggregated series of every metric, for plots
+        Stage("rollups", partial(build_rollups, coin=coin), after=["resolve"], outputs=[c("_rollups.npz")],
+              code=ANALYSIS_CODE + ("rollups.py",), resources=[MEMORY]),
+        # Per height counts of inputs and outputs by address type, and input totals
+        Stage("input_types", partial(dump_type_counts, chain, coin),
+              outputs=[c("_input_types.json"), c("_input_types.npy"), c("_output_types.npy")], code=COUNT_CODE,
+              uses_chain=True, resources=[CHAIN]),
+        Stage("utxo_set_size", partial(dump_json, partial(blocksci_utxo_set_size, chain), c("_utxo_set_size.json")),
+              outputs=[c("_utxo_set_size.json")], code=COUNT_CODE, uses_chain=True, resources=[CHAIN]),
+        # Spent and spending heights of every input and output, for analyses by output height
+        Stage("spent_index", partial(build_spent_index, chain, c("_spent_index")), outputs=[c("_spent_index")],
+              code=SPENT_INDEX_CODE, uses_chain=True, resources=[CHAIN]),
+    ]
+    # Json files for STATUS (np_estimation), one per input type. P2PKH sizes do not need resolution.
+    for input_type in ESTIMATION_FILES:
+        stages.append(Stage("export_" + input_type, partial(dump_estimations_to_json, coin=coin, input_type=input_type),
+                            after=["extract" if input_type == "P2PKH" else "resolve"],
+                            outputs=[estimation_file(coin, input_type, STATUS_COMPACT_EXPORT)], code=ANALYSIS_CODE,
+                            resources=[MEMORY] if input_type in ["P2PKH", "P2SH"] else []))
+
+    return Pipeline(stages, c("_pipeline.json"), tip_height=len(chain) - 1, context={"coin": coin},
+                    max_workers=max_workers, name=COIN_STR[coin])
+
+
+def scan_pool(num_processes=None, min_processes=1):
+    """
+    Process pool for chain scans and the block files index, with all its workers started. It has to be created before
+    any stage thread is running: forking a process while other threads hold locks can deadlock the child.
 
-    coin = BITCOIN  # BITCOIN, BITCOIN_CASH, LITECOIN
-    chain = None
+    :param num_processes: number of processes (None uses all cores)
+    :param min_processes: minimum number of processes
+    :return: ProcessPoolExecutor
+    """
+    executor = ProcessPoolExecutor(max_workers=max(num_processes or os.cpu_count(), min_processes))
+    # With the fork start method, every worker is forked at the first submission
+    executor.submit(int).result()
+    return executor
 
+
+def run_journals(coins, chain_paths, num_processes=None, update=False, max_workers=8, targets=None, force=()):
+    """
+    Runs the journal of several coins at the same time, so a refresh of all of them takes about as long as the
+    slowest one. Results of each coin are written in its own folder (named after COIN_STR, see OUTPUT_DIRS).
+
+    Stages of all the coins run in a shared pool of max_workers threads, and chain scans in a shared pool of
+    num_processes processes (at least one per coin, so scans do not compete for the GIL). External API requests of
+    all the coins go through the same per-provider rate limiters and explorer cache (see external_apis), so rate
+    limits hold for the whole run.
+
+    :param coins: list of coins (BITCOIN, BITCOIN_CASH, LITECOIN)
+    :param chain_paths: dictionary, keys are coins and values paths to their blocksci parsed data
+    :param num_processes: number of processes scanning the chains (None uses all cores, 1 scans each chain in a
+                          single process)
+    :param update: boolean, only scan the blocks added since the previous extraction, extending its results
+    :param max_workers: maximum number of stages (of any coin) running at the same time
+    :param targets: names of the stages to bring up to date (see Pipeline.run)
+    :param force: names of stages run even if they are fresh
+    :return: dictionary, keys are coins and values the status of their stages (see Pipeline.run)
+    """
+
+    for coin in coins:
+        OUTPUT_DIRS[coin] = COIN_STR[coin]
+        os.makedirs(OUTPUT_DIRS[coin], exist_ok=True)
+
+    # At least one process per coin, so the scans of all the coins run at the same time
+    scan_executor = scan_pool(num_processes, min_processes=len(coins))
+    stage_executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    statuses, failed = {}, []
+    try:
+        pipelines = dict([(coin, journal_pipeline(blocksci.Blockchain(chain_paths[coin]), coin, chain_paths[coin],
+                                                  num_processes, update, executor=scan_executor)) for coin in coins])
+        with ThreadPoolExecutor(max_workers=len(coins)) as runners:
+            futures = dict([(coin, runners.submit(pipelines[coin].run, targets, force, stage_executor))
+                            for coin in coins])
+            for coin, future in futures.items():
+                try:
+                    statuses[coin] = future.result()
+                except Exception as e:
+                    failed.append(COIN_STR[coin])
+                    print("Journal of {} failed: {}".format(COIN_STR[coin], e))
+    finally:
+        stage_executor.shutdown()
+        if scan_executor:
+            scan_executor.shutdown()
+
+    if failed:
+        raise Exception("Failed coins: {}".format(", ".join(failed)))
+    return statuses
+
+
+def default_chain_path(coin):
+    """
+    :param coin: studied coin
+    :return: path to the blocksci parsed data of the coin in the known hosts (None elsewhere)
+    """
+
+    folders = {BITCOIN: "bitcoin", BITCOIN_CASH: "bitcoincash", LITECOIN: "litecoin"}
     if os.path.isdir("/home/ubuntu"):
         # AWS
-        folders = {BITCOIN: "bitcoin", BITCOIN_CASH: "bitcoincash", LITECOIN: "litecoin"}
-        chain = blocksci.Blockchain("/home/ubuntu/{}".format(folders[coin]))
+        return "/home/ubuntu/{}".format(folders[coin])
     elif os.path.isdir("/home/bitcoin/BlockSci"):
         # satoshi
-        folders = {BITCOIN: "bitcoin", BITCOIN_CASH: "bitcoincash", LITECOIN: "litecoin"}
-        chain = blocksci.Blockchain("/mnt/data/parsed-data-{}".format(folders[coin]))
+        return "/mnt/data/parsed-data-{}".format(folders[coin])
     elif os.path.isdir("/mnt/bsafe/"):
         # blade
-        folders = {BITCOIN: "bitcoin", BITCOIN_CASH: "bitcoincash", LITECOIN: "litecoin"}
-        chain = blocksci.Blockchain("/mnt/bsafe/blocksci-parsed-data-{}".format(folders[coin]))
-
-    # Get data and store it in pickle files
-    print("Getting data from blocksci")
-    # RSOS paper
-    blocksci_find_pk_in_p2pkh(chain, restart_from_height=None, coin=coin)
-    blocksci_find_p2sh_inputs(chain, restart_from_height=None, coin=coin)
-    blocksci_find_nonstd_inputs(chain, restart_from_height=None, coin=coin)
-    blocksci_find_p2wsh_inputs(chain, restart_from_height=None, coin=coin)
-
-    # RECSI paper
-    blocksci_find_native_segwit_outputs(chain, restart_from_height=None, coin=coin)
-    blocksci_find_native_segwit_inputs(chain, restart_from_height=None, coin=coin)
-
-    # Read pickle files and create json files for STATUS (np_estimation)
-    print("Dumping estimations to json files")
-    dump_estimations_to_json(coin=coin, input_type="ALL")
-
-    # Additional analysis
-    print("Maybe you're interested in kwnowing")
-    non_std_analysis(coin=coin)
-    p2sh_analysis(coin=BITCOIN)
-    input_spending_type = blocksci_count_input_by_type(chain)
-    utxo_set_size = blocksci_utxo_set_size(chain)
+        return "/mnt/bsafe/blocksci-parsed-data-{}".format(folders[coin])
+    return None
+
+
+if __name__ == "__main__":
+
+    # Studied coins (BITCOIN, BITCOIN_CASH, LITECOIN). With several coins, they are processed at the same time and the
+    # results of each one are written in its own folder (see run_journals)
+    coins = [BITCOIN]
+    num_processes = 1  # number of processes scanning the chain (None uses all cores)
+    update = False  # only scan the blocks added since the previous run, extending its results
+
+    # Run report with per-stage timings and memory snapshots (e.g. "instrumentation_%Y%m%d-%H%M%S.json", None disables
+    # it), profiler (None, "cprofile" or "sampling") and allocation tracing with tracemalloc (see instrumented_run)
+    instrumentation_report = None
+    profiler = None
+    trace_memory = False
+
+    # Stages run even if their outputs are up to date (e.g. ["non_std_analysis"] to print it again), and stages to
+    # bring up to date (None runs the whole journal, e.g. ["export_P2SH"] only runs that stage and the stale stages
+    # it depends on)
+    force = []
+    targets = None
+
+    with instrumented_run(instrumentation_report, profiler, trace_memory):
+        if len(coins) == 1:
+            coin = coins[0]
+            chain_path = default_chain_path(coin)
+            executor = scan_pool(num_processes) if num_processes != 1 or RAW_BLOCKS_DIRS.get(coin) else None
+            try:
+                pipeline = journal_pipeline(blocksci.Blockchain(chain_path), coin=coin, chain_path=chain_path,
+                                            num_processes=num_processes, update=update, executor=executor)
+                pipeline.run(targets=targets, force=force)
+            finally:
+                if executor:
+                    executor.shutdown()
+        else:
+            run_journals(coins, dict([(coin, default_chain_path(coin)) for coin in coins]),
+                         num_processes=num_processes, update=update, targets=targets, force=force)
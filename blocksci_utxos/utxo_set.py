@@ -0,0 +1,135 @@
+import os
+
+import blocksci
+import numpy as np
+
+from type_counts import ADDRESS_TYPES, address_type_codes, block_ranges
+
+# Width (in blocks) of the creation height buckets used to break down the UTXO set by age (about one year of Bitcoin
+# blocks)
+AGE_BUCKET_SIZE = 52560
+
+# Code of the address type of null data outputs, which are not part of the UTXO set
+NULLDATA_CODE = int(blocksci.address_type.nulldata)
+
+
+class UTXOSetEvolution(object):
+    """
+    Exact composition of the UTXO set at each block height: number of UTXOs and their value, both in total and broken
+    down by address type and by creation height bucket (UTXOs created in heights [b * bucket_size, (b + 1) *
+    bucket_size) are in bucket b).
+
+    The UTXO set at height h contains the spendable outputs created at heights <= h that are not spent at heights <=
+    h. Null data (OP_RETURN) outputs are provably unspendable, and nodes never add them to their UTXO set, so they are
+    not counted in any series (they are, in blocksci_utxo_set_size and type_counts.utxo_set_size_by_type). Each
+    output adds +1 (and +value) at its creation height and -1 (and -value) at its spend height to a difference array
+    indexed by height, so the UTXO set at every height is the cumulative sum of the difference array. All series are
+    numpy arrays indexed by height, so querying a height is O(1).
+    """
+
+    names = ["count", "value", "by_type", "by_age"]
+
+    def __init__(self, count, value, by_type, by_age, bucket_size=AGE_BUCKET_SIZE):
+        """
+        :param count: numpy array, number of UTXOs at each height
+        :param value: numpy array, total value (in satoshis) of the UTXOs at each height
+        :param by_type: numpy array of shape (number of heights, len(ADDRESS_TYPES)), number of UTXOs of each type
+        :param by_age: numpy array of shape (number of heights, number of buckets), number of UTXOs created in each
+                       creation height bucket
+        :param bucket_size: width of the creation height buckets, in blocks
+        """
+        self.count = count
+        self.value = value
+        self.by_type = by_type
+        self.by_age = by_age
+        self.bucket_size = bucket_size
+
+    @property
+    def num_heights(self):
+        return len(self.count)
+
+    def at(self, h):
+        """
+        :param h: block height
+        :return: dictionary with the UTXO count, value, counts by address type and counts by creation height bucket
+                 (keys are the first height of each bucket) at height h
+        """
+        return {"count": int(self.count[h]), "value": int(self.value[h]),
+                "by_type": {ty: int(n) for ty, n in zip(ADDRESS_TYPES, self.by_type[h]) if n},
+                "by_age": {b * self.bucket_size: int(n) for b, n in enumerate(self.by_age[h]) if n}}
+
+    def save(self, path):
+        """
+        :param path: directory, one .npy file is saved per series
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in self.names:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+        np.save(os.path.join(path, "bucket_size.npy"), np.array(self.bucket_size))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        :param path: directory written by save
+        :param mmap_mode: numpy mmap_mode
+        :return: UTXOSetEvolution object
+        """
+        series = [np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in cls.names]
+        bucket_size = int(np.load(os.path.join(path, "bucket_size.npy")))
+        return cls(*series, bucket_size=bucket_size)
+
+
+def utxo_set_evolution(chain, bucket_size=AGE_BUCKET_SIZE, chunk_size=1000):
+    """
+    Computes the composition of the UTXO set at each height of a chain (see UTXOSetEvolution) in a single pass.
+
+    Both the creation event of an output and its spend event are found in the block being read: outputs are created
+    at their own height, and inputs spend an output (of the same address type and value) created age blocks before.
+    Null data outputs are skipped (see UTXOSetEvolution), so nulldata columns of by_type are always 0.
+    Inputs, outputs and their attributes are read as numpy arrays from blocksci block ranges (chunk_size blocks at a
+    time), and the difference arrays are filled with bincount.
+
+    :param chain: blocksci chain object
+    :param bucket_size: width of the creation height buckets, in blocks
+    :param chunk_size: number of blocks read at once
+    :return: UTXOSetEvolution object
+    """
+
+    num_heights, num_types = len(chain), len(ADDRESS_TYPES)
+    num_buckets = (num_heights - 1) // bucket_size + 1
+    count = np.zeros(num_heights, dtype=np.int64)
+    value = np.zeros(num_heights, dtype=np.int64)
+    by_type = np.zeros((num_heights, num_types), dtype=np.int64)
+    by_age = np.zeros((num_heights, num_buckets), dtype=np.int64)
+
+    for first, blocks in block_ranges(chain, chunk_size):
+        num_blocks = len(blocks)
+        heights = np.arange(first, first + num_blocks)
+
+        for kind, sign in [("outputs", 1), ("inputs", -1)]:
+            per_block = np.asarray(blocks.output_count if kind == "outputs" else blocks.input_count, dtype=np.int64)
+            rows = np.repeat(np.arange(num_blocks), per_block)
+            items = getattr(blocks, kind)
+            types = address_type_codes(items.address_type)
+            values = np.asarray(items.value, dtype=np.int64)
+            if kind == "outputs":
+                creation_heights = heights[rows]
+            else:
+                creation_heights = heights[rows] - np.asarray(items.age, dtype=np.int64)
+            spendable = types != NULLDATA_CODE
+            rows, types, values, creation_heights = (rows[spendable], types[spendable], values[spendable],
+                                                     creation_heights[spendable])
+
+            count[first:first + num_blocks] += sign * np.bincount(rows, minlength=num_blocks)
+            # float64 weights are exact for values below 2**53 satoshis (the 21M BTC supply is ~2**51)
+            value[first:first + num_blocks] += sign * np.bincount(rows, weights=values,
+                                                                  minlength=num_blocks).astype(np.int64)
+            by_type[first:first + num_blocks] += sign * np.bincount(
+                rows * num_types + types, minlength=num_blocks * num_types).reshape(-1, num_types)
+            by_age[first:first + num_blocks] += sign * np.bincount(
+                rows * num_buckets + creation_heights // bucket_size,
+                minlength=num_blocks * num_buckets).reshape(-1, num_buckets)
+
+    return UTXOSetEvolution(np.cumsum(count), np.cumsum(value), np.cumsum(by_type, axis=0),
+                            np.cumsum(by_age, axis=0), bucket_size)